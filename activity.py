@@ -0,0 +1,70 @@
+"""
+Activity detection from counter deltas.
+
+Checking only "I/Os currently in progress" at the instant of a sample
+misses every burst that starts and completes between two samples, so it
+only works when polling very fast. ActivityDetector keeps the previous
+snapshot of the completion counters and treats any movement of reads or
+writes completed, sectors read or written, or time spent doing I/O as
+activity, in addition to a non-zero in-flight count. Polling can then slow
+down without losing blinks.
+
+'missed' counts the samples that were active only by their deltas, i.e.
+the bursts the old in-flight check would not have seen.
+"""
+
+from diskstats import (FIRSTCOUNTER, READS, WRITES, SECTORSREAD, SECTORSWRITTEN,
+                       IOINPROGRESS, IOTIME)
+
+# Counters whose movement since the last sample means I/O happened.
+DELTAFIELDS = tuple(field - FIRSTCOUNTER for field in (READS, WRITES, SECTORSREAD, SECTORSWRITTEN, IOTIME))
+INFLIGHT = IOINPROGRESS - FIRSTCOUNTER
+
+
+class ActivityDetector(object):
+    """Compares consecutive counter snapshots of one sampler."""
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        # Two lists swapped on every sample so no snapshot is allocated per tick.
+        self._previous = None
+        self._current = []
+        self.inflight = 0
+        self.samples = 0
+        self.active = 0
+        self.missed = 0
+
+    @property
+    def counters(self):
+        # Counter snapshot of the last sample, None before the first. Valid
+        # until the next sample, which may reuse the list.
+        return self._previous
+
+    def sample(self):
+        # Refresh the sampler and return True if the device did any I/O since
+        # the last sample or has I/O in flight now. The first sample only
+        # establishes the baseline.
+        if not self.sampler.refresh():
+            return False
+        current = self.sampler.counters(self._current)
+        if current is None or len(current) <= INFLIGHT:
+            return False
+        previous = self._previous
+        self._previous, self._current = current, previous if previous is not None else []
+        self.inflight = current[INFLIGHT]
+        if previous is None:
+            return self.inflight > 0
+        self.samples += 1
+        moved = False
+        for field in DELTAFIELDS:
+            if current[field] != previous[field]:
+                moved = True
+                break
+        if self.inflight > 0:
+            self.active += 1
+            return True
+        if moved:
+            self.active += 1
+            self.missed += 1
+            return True
+        return False
@@ -0,0 +1,314 @@
+"""
+Run the sampling engine, the blink deadlines and the wakeup sources on one
+asyncio event loop.
+
+With threads, the daemon has a sampling loop that sleeps in time.sleep()
+or poll(), one BlinkScheduler thread per LED, and a tray thread on top, and
+the latency of a blink depends on how those threads are scheduled.
+AsyncEngine puts all of it on a single event loop, which becomes the one
+place where wakeups happen:
+
+  - Ticks of engine.SamplingEngine are loop.call_later() callbacks, paced
+    by the engine's AdaptivePoller (only its update() is used).
+  - LoopBlinker is scheduler.BlinkScheduler on the loop: the "turn off at
+    time T" deadline is a timer handle, not a thread.
+  - The PSI trigger fd signals with POLLPRI, which loop.add_reader() does
+    not wait for, so it is registered for EPOLLPRI in an epoll object of its
+    own whose fd, readable while the trigger is pending, is added to the
+    loop instead. A trigger cuts the idle sleep short like
+    psievents.PsiEventSource.sleep() does.
+  - The inotify fd of devwatch.DeviceWatcher is added to the loop too, so a
+    device that is plugged in while the disk is idle is sampled at once.
+  - Outputs that block, such as UI libraries or network writes, are wrapped
+    in ExecutorOutput, which runs their updates with run_in_executor() and
+    folds the updates that arrive while one is running into the next one.
+    The executor thread only sees copies made on the loop: of the pattern
+    states, their IoMetrics, and the detector counters the output reads
+    through its 'engine'.
+
+Network or socket outputs can be coroutines scheduled from their update().
+"""
+
+import asyncio
+import select
+import sys
+
+from engine import Output, PatternState
+from iometrics import IoMetrics
+from scheduler import LATEOFF
+
+
+class LoopBlinker(object):
+    """BlinkScheduler interface, with the deadline kept on the event loop."""
+
+    def __init__(self, duration, on, off, loop=None):
+        self.duration = duration
+        self.on = on
+        self.off = off
+        self.loop = loop
+        self._deadline = 0.0
+        self._lit = False
+        self._handle = None
+        self.blinks = 0
+        self.late = 0
+
+    def start(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        return self
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._lit:
+            self._lit = False
+            self._call(self.off)
+
+    @property
+    def lit(self):
+        return self._lit
+
+    def _call(self, action):
+        try:
+            action()
+        except Exception as e:
+            # Log error if an output callback fails.
+            # Recovery: Keep blinking, the next transition retries the output.
+            sys.stderr.write(f"Error in blink callback: {e}\n")
+
+    def trigger(self):
+        # Keep the output on until 'duration' after this call. While it is on,
+        # only the deadline moves; the timer checks it when it expires.
+        self._deadline = self.loop.time() + self.duration
+        if not self._lit:
+            self._lit = True
+            self.blinks += 1
+            self._call(self.on)
+        if self._handle is None:
+            self._handle = self.loop.call_at(self._deadline, self._expire)
+
+    def _expire(self):
+        now = self.loop.time()
+        if now < self._deadline:
+            self._handle = self.loop.call_at(self._deadline, self._expire)
+            return
+        if now - self._deadline > LATEOFF:
+            self.late += 1
+        self._handle = None
+        self._lit = False
+        self._call(self.off)
+
+
+# IoMetrics attributes copied for executor outputs.
+METRICATTRIBUTES = ('interval', 'reads', 'writes', 'readmb', 'writemb', 'readawait', 'writeawait',
+                    'queuesize', 'utilization', 'inflight')
+
+
+class DetectorCopy(object):
+    """The counters and in-flight count of an activity.ActivityDetector at one tick."""
+
+    __slots__ = ('counters', 'inflight')
+
+    def __init__(self):
+        self.counters = []
+        self.inflight = 0
+
+
+class EngineCopy(object):
+    """What an executor output reads from its engine, copied on the loop."""
+
+    def __init__(self, engine):
+        self.clock = engine.clock
+        self.detectors = {}  # DetectorCopy, keyed by device
+
+
+class ExecutorOutput(Output):
+    """Runs the updates of a blocking output in an executor, one at a time."""
+
+    def __init__(self, output, executor=None, loop=None):
+        self.output = output
+        self.interval = output.interval
+        self.executor = executor
+        self.loop = loop
+        self._states = {}  # Copy of the states the output is updated with
+        self._next = {}  # Copy the states of the loop are folded into meanwhile
+        self._engine = self._nextengine = None  # EngineCopy of each
+        self._running = False
+        self._pending = False
+        self._now = 0.0
+        self.folded = 0  # Updates that arrived while one was running
+
+    def start(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self._engine = EngineCopy(self.engine)
+        self._nextengine = EngineCopy(self.engine)
+        self.output.engine = self._engine
+        self.output.start()
+
+    def close(self):
+        self.output.close()
+
+    def _fold(self, states):
+        # Fold 'states' into the next copy: activity is ORed until the output sees it,
+        # everything else is the latest. The copies are reused, so folding allocates
+        # only for new patterns and devices.
+        detectors = self.engine.detectors
+        copies = self._nextengine.detectors
+        for pattern, state in states.items():
+            copy = self._next.get(pattern)
+            if copy is None:
+                copy = self._next[pattern] = PatternState(pattern)
+            copy.active = copy.active or state.active
+            copy.devices = list(state.devices)
+            for device, metrics in state.metrics.items():
+                target = copy.metrics.get(device)
+                if target is None:
+                    target = copy.metrics[device] = IoMetrics(device)
+                for attribute in METRICATTRIBUTES:
+                    setattr(target, attribute, getattr(metrics, attribute))
+            copy.readmb = state.readmb
+            copy.writemb = state.writemb
+            copy.utilization = state.utilization
+            copy.inflight = state.inflight
+            for device in state.devices:
+                detector = detectors.get(device)
+                counters = detector.counters if detector is not None else None
+                if counters is None:
+                    continue
+                target = copies.get(device)
+                if target is None:
+                    target = copies[device] = DetectorCopy()
+                target.counters[:] = counters
+                target.inflight = detector.inflight
+
+    def update(self, states, now):
+        self._fold(states)
+        self._now = now
+        if self._running:
+            self._pending = True
+            self.folded += 1
+            return
+        self._submit()
+
+    def _submit(self):
+        self._running = True
+        self._pending = False
+        self._states, self._next = self._next, self._states
+        self._engine, self._nextengine = self._nextengine, self._engine
+        self.output.engine = self._engine
+        future = self.loop.run_in_executor(self.executor, self._update, self._now)
+        future.add_done_callback(self._done)
+
+    def _update(self, now):
+        # Runs in the executor. The loop folds into the other copy meanwhile.
+        try:
+            self.output.update(self._states, now)
+        finally:
+            for state in self._states.values():
+                state.active = False
+
+    def _done(self, future):
+        self._running = False
+        error = future.exception()
+        if error is not None:
+            # Log error if the output fails.
+            # Recovery: Keep the output registered, the next update retries it.
+            sys.stderr.write(f"Error in output {self.output.__class__.__name__}: {error}\n")
+        if self._pending:
+            self._submit()
+
+
+class AsyncEngine(object):
+    """Drives an engine.SamplingEngine from an asyncio event loop."""
+
+    def __init__(self, engine, psi=None, idle=None):
+        # 'psi' is an open psievents.PsiEventSource, or None. 'idle' replaces the
+        # poller's idle interval, e.g. a longer one when PSI can wake the loop.
+        self.engine = engine
+        self.psi = psi
+        if idle is not None:
+            engine.poller.idle = max(idle, engine.poller.fast)
+        self.loop = None
+        self._handle = None
+        self._epoll = None
+        self._fds = []
+        self._done = None
+
+    def start(self):
+        # Must run in the loop's thread, after any fork().
+        self.loop = asyncio.get_running_loop()
+        self.engine.start()
+        if self.psi is not None and self.psi.available:
+            self._epoll = select.epoll()
+            self._epoll.register(self.psi.fileno(), select.EPOLLPRI)
+            self._add_reader(self._epoll.fileno(), self._pressure)
+        watcher = self.engine.monitor.watcher if self.engine.monitor is not None else None
+        if watcher is not None and watcher.fileno() is not None:
+            self._add_reader(watcher.fileno(), self._hotplug)
+        self._handle = self.loop.call_soon(self._tick)
+        return self
+
+    def _add_reader(self, fd, callback):
+        self.loop.add_reader(fd, callback)
+        self._fds.append(fd)
+
+    def _tick(self):
+        stats = self.engine.stats
+        if stats is not None and isinstance(self._handle, asyncio.TimerHandle):
+            stats.wakeup(self.loop.time() - self._handle.when())
+        active = self.engine.tick()
+        self.engine.poller.record()
+        self._handle = self.loop.call_later(self.engine.poller.update(active), self._tick)
+
+    def wake(self):
+        # Sample now and go back to the fast rate, e.g. on an I/O pressure trigger.
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self.engine.poller.update(True)
+        self._tick()
+
+    def _hotplug(self):
+        # Drain the inotify fd here: a tick that fails to read the table never gets to
+        # the watcher, and a readable fd that is not read makes the loop spin.
+        monitor = self.engine.monitor
+        if monitor.watcher.changed():
+            monitor.invalidate()
+        self.wake()
+
+    def _pressure(self):
+        for fd, event in self._epoll.poll(0):
+            if event & select.EPOLLERR:
+                # The monitor goes away with the cgroup or on kernel errors.
+                # Recovery: Drop the trigger and continue with timed polling.
+                sys.stderr.write("Error: PSI trigger failed, continuing with timed polling.\n")
+                self.loop.remove_reader(self._epoll.fileno())
+                self._fds.remove(self._epoll.fileno())
+                self.psi.close()
+                return
+        # Checking the nested epoll already consumes the trigger event on some kernels,
+        # so every readiness counts as one event.
+        self.psi.events += 1
+        self.wake()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for fd in self._fds:
+            self.loop.remove_reader(fd)
+        self._fds = []
+        if self._epoll is not None:
+            self._epoll.close()
+            self._epoll = None
+        self.engine.close()
+        if self._done is not None and not self._done.done():
+            self._done.set_result(None)
+
+    async def run(self):
+        # Run until stop() is called.
+        self.start()
+        self._done = self.loop.create_future()
+        await self._done
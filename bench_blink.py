@@ -0,0 +1,86 @@
+"""
+Thread and context switch cost of blinking under sustained I/O.
+
+Simulates a disk that is busy on every sample: the sampler loop runs at
+BLINKRATE / 4.0 and signals activity every time, first with the original
+Timer-per-blink design from main.py, then with scheduler.BlinkScheduler.
+The outputs are no-ops so only the scheduling cost is measured. Threads
+created and voluntary plus involuntary context switches of the whole
+process are reported per minute.
+
+usage: python3 bench_blink.py [--seconds N]
+"""
+
+import argparse
+import resource
+import threading
+import time
+
+from scheduler import BlinkScheduler
+
+BLINKRATE = 0.065
+
+threads_started = 0
+_start = threading.Thread.start
+
+
+def _counting_start(self):
+    global threads_started
+    threads_started += 1
+    return _start(self)
+
+
+threading.Thread.start = _counting_start
+
+
+def noop():
+    pass
+
+
+def legacy(seconds):
+    # setled() as it was in main.py before the blink scheduler.
+    timer = None
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        if timer is not None and timer.is_alive():
+            timer.cancel()
+        timer = threading.Timer(BLINKRATE, noop)
+        timer.start()
+        noop()
+        time.sleep(BLINKRATE / 4.0)
+    timer.cancel()
+
+
+def scheduled(seconds):
+    blinker = BlinkScheduler(BLINKRATE, noop, noop).start()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        blinker.trigger()
+        time.sleep(BLINKRATE / 4.0)
+    blinker.stop()
+
+
+def measure(fn, seconds):
+    global threads_started
+    threads_started = 0
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    fn(seconds)
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    switches = (after.ru_nvcsw - before.ru_nvcsw) + (after.ru_nivcsw - before.ru_nivcsw)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    scale = 60.0 / seconds
+    return threads_started * scale, switches * scale, cpu * scale
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seconds', type=float, default=10.0)
+    args = parser.parse_args()
+    print(f"{'design':20s} {'threads/min':>12s} {'ctx switches/min':>17s} {'cpu s/min':>10s}")
+    for name, fn in (('Timer per blink', legacy), ('BlinkScheduler', scheduled)):
+        threads, switches, cpu = measure(fn, args.seconds)
+        print(f"{name:20s} {threads:12.0f} {switches:17.0f} {cpu:10.3f}")
+
+
+if __name__ == '__main__':
+    run()
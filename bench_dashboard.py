@@ -0,0 +1,123 @@
+"""
+Bytes sent to the terminal by the dashboard, with and without diff-only redraw.
+
+A child process runs dashboard.DashboardOutput on a pseudo terminal of
+'lines' x 'columns' against a fixtures.DiskStatsFixture of 'devices'
+devices, a 'busy' share of which does I/O on every tick. The parent reads
+the terminal and reports frames per second, bytes per frame and second
+(what an SSH link would carry), and the dashboard thread's CPU time per
+frame. --full clears the screen before every frame, which is what
+redrawing everything costs.
+
+usage: python3 bench_dashboard.py [--devices N] [--busy FRACTION] [--fps N] [--seconds N] [--full]
+"""
+
+import argparse
+import fcntl
+import os
+import pty
+import random
+import select
+import struct
+import tempfile
+import termios
+import threading
+import time
+
+from dashboard import DashboardOutput
+from engine import SamplingEngine
+from fixtures import DiskStatsFixture
+
+
+class FullRedraw(DashboardOutput):
+    """Redraws every cell of every frame."""
+
+    def _draw(self):
+        self.screen.shown.clear()
+        self.screen.window.clear()
+        DashboardOutput._draw(self)
+
+
+def simulate(args, report):
+    # Runs in the child, on the pseudo terminal.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'diskstats')
+        fixture = DiskStatsFixture(path, args.devices)
+        rnd = random.Random(0)
+        busy = [name for name in fixture.names if rnd.random() < args.busy]
+        engine = SamplingEngine(path, 0.065 / 4.0, 1.0, hotplug=False, sysfs=None)
+        output = engine.add((FullRedraw if args.full else DashboardOutput)(args.fps), ['*'])
+        engine.start()
+        stop = threading.Event()
+
+        def bump():
+            while not stop.wait(0.065 / 4.0):
+                for name in busy:
+                    fixture.bump(name, rnd.randrange(8), rnd.randrange(8))
+
+        bumper = threading.Thread(target=bump, daemon=True)
+        bumper.start()
+        timer = threading.Timer(args.seconds, engine.stop)
+        timer.start()
+        engine.run()
+        stop.set()
+        bumper.join()
+        engine.close()
+        os.write(report, f"{output.frames} {output.screen.fields} {output.screen.cells} {output.cpu} "
+                         f"{len(busy)}".encode())
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--devices', type=int, default=300)
+    parser.add_argument('--busy', type=float, default=0.1, help='share of the devices doing I/O')
+    parser.add_argument('--fps', type=float, default=10.0)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--lines', type=int, default=50)
+    parser.add_argument('--columns', type=int, default=132)
+    parser.add_argument('--full', action='store_true', help='clear and redraw the whole screen every frame')
+    args = parser.parse_args()
+
+    reader, writer = os.pipe()
+    pid, master = pty.fork()
+    if pid == 0:
+        try:
+            os.close(reader)
+            os.environ['TERM'] = 'xterm-256color'
+            fcntl.ioctl(0, termios.TIOCSWINSZ, struct.pack('HHHH', args.lines, args.columns, 0, 0))
+            simulate(args, writer)
+        finally:
+            os._exit(0)
+    os.close(writer)
+    received = 0
+    start = time.monotonic()
+    while True:
+        if not select.select([master], [], [], 1.0)[0]:
+            continue
+        try:
+            data = os.read(master, 65536)
+        except OSError:
+            # EIO once the child closed the terminal.
+            break
+        if not data:
+            break
+        received += len(data)
+    elapsed = time.monotonic() - start
+    os.waitpid(pid, 0)
+    result = os.read(reader, 1024).split()
+    os.close(reader)
+    if len(result) != 5:
+        print('the dashboard did not report, see above')
+        return
+    frames, fields, cells, cpu, busy = int(result[0]), int(result[1]), int(result[2]), float(result[3]), \
+        int(result[4])
+    print(f"{args.devices} devices ({busy} busy) on {args.lines}x{args.columns}, "
+          f"{'full redraw' if args.full else 'diff-only redraw'}, at most {args.fps:g} fps")
+    print(f"{frames} frames ({frames / elapsed:.1f}/s), {fields / max(1, frames):.1f} fields and "
+          f"{cells / max(1, frames):.0f} cells changed per frame")
+    print(f"{received / max(1, frames):.0f} bytes per frame, {received / elapsed / 1024:.1f} KB/s to the terminal, "
+          f"{cpu / max(1, frames) * 1e3:.2f} ms dashboard CPU per frame")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,94 @@
+"""
+Fleet collector throughput with many simulated agents on localhost.
+
+A child process plays 'agents' hosts with 'devices' busy devices each:
+every host adds an entry per device and tick (BLINKRATE / 4.0) to its own
+fleet.FleetPacker and sends a datagram 'rate' times a second, the same
+datagrams FleetOutput sends. The parent runs a fleetcollector.Collector
+for the duration and reports datagrams and entries per second, the CPU
+time spent per datagram, and datagrams lost, then prints the heat map.
+
+usage: python3 bench_fleet.py [--agents N] [--devices N] [--rate N] [--seconds N]
+"""
+
+import argparse
+import os
+import random
+import resource
+import signal
+import socket
+import time
+
+from fleet import FleetPacker, RATE
+from fleetcollector import Collector, HeatMap
+
+TICK = 0.065 / 4.0
+
+
+def simulate(address, agents, devices, rate, seconds):
+    # Runs in the child: send like 'agents' busy hosts until 'seconds' have passed.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rnd = random.Random(0)
+    packers = [FleetPacker(f"rack1-host{i:04d}") for i in range(agents)]
+    names = [f"nvme{d}n1" for d in range(devices)]
+    # Each host is busy for a different share of the time, so the heat map has a shape.
+    duty = [rnd.random() ** 2 for _ in range(agents)]
+    ticks = max(1, int(1.0 / rate / TICK))
+    start = time.monotonic()
+    period = 0
+    while time.monotonic() - start < seconds:
+        period += 1
+        base = time.monotonic()
+        for i, packer in enumerate(packers):
+            for tick in range(ticks):
+                if rnd.random() < duty[i]:
+                    for name in names:
+                        packer.add(name, base + tick * TICK, rnd.randrange(101), rnd.randrange(4),
+                                   rnd.randrange(2048), rnd.randrange(2048))
+            if len(packer):
+                sock.sendto(packer.pack(), address)
+        delay = start + period / rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    sock.close()
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--agents', type=int, default=1000)
+    parser.add_argument('--devices', type=int, default=2)
+    parser.add_argument('--rate', type=float, default=RATE, help='datagrams per second and agent')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    args = parser.parse_args()
+
+    collector = Collector(('127.0.0.1', 0), HeatMap(columns=int(args.seconds) + 2))
+    address = collector.sock.getsockname()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            simulate(address, args.agents, args.devices, args.rate, args.seconds)
+        finally:
+            os._exit(0)
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.monotonic()
+    try:
+        while time.monotonic() - start < args.seconds + 0.5:
+            collector.receive(0.1)
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    elapsed = time.monotonic() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+    print(f"{args.agents} agents x {args.devices} devices at {args.rate:g} datagrams/s for {args.seconds:g} s")
+    print(f"received {collector.datagrams} datagrams ({collector.datagrams / elapsed:.0f}/s), "
+          f"{collector.entries} entries ({collector.entries / elapsed:.0f}/s), {collector.lost} lost, "
+          f"{collector.invalid} invalid")
+    print(f"collector CPU {cpu:.2f} s, {cpu / max(1, collector.datagrams) * 1e6:.1f} us per datagram, "
+          f"{len(collector.heatmap.names)} heat map rows\n")
+    print(collector.heatmap.render(10))
+    collector.close()
+
+
+if __name__ == '__main__':
+    run()
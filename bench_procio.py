@@ -0,0 +1,71 @@
+"""
+Cost of a procio.ProcessIoScanner scan with many processes.
+
+Forks 'processes' idle children, then times scans of /proc: the first one
+(opening every io file), steady state scans with the cached fds, and the
+same with no fds cached (every io file opened and closed per scan), and
+reports the CPU time of each per scan and per process.
+
+usage: python3 bench_procio.py [--processes N] [--scans N]
+"""
+
+import argparse
+import os
+import signal
+import time
+
+from procio import ProcessIoScanner
+
+
+def cpu():
+    return time.process_time()
+
+
+def measure(scanner, scans):
+    # CPU seconds of one scan, the best of 'scans'.
+    best = None
+    for _ in range(scans):
+        start = cpu()
+        scanner.scan()
+        elapsed = cpu() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--processes', type=int, default=5000)
+    parser.add_argument('--scans', type=int, default=10)
+    args = parser.parse_args()
+
+    children = []
+    try:
+        for _ in range(args.processes):
+            pid = os.fork()
+            if pid == 0:
+                signal.pause()
+                os._exit(0)
+            children.append(pid)
+        cached = ProcessIoScanner()
+        start = cpu()
+        cached.scan()
+        first = cpu() - start
+        steady = measure(cached, args.scans)
+        uncached = ProcessIoScanner(maxfds=0)
+        uncached.scan()
+        reopened = measure(uncached, args.scans)
+        total = len(cached.processes)
+        print(f"{total} processes, {cached.openfds} io fds cached")
+        for label, seconds in (('first scan', first), ('cached fds', steady), ('no fds cached', reopened)):
+            print(f"{label:14s} {seconds * 1e3:8.2f} ms CPU per scan, {seconds / total * 1e6:6.2f} us per process")
+        cached.close()
+        uncached.close()
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        for pid in children:
+            os.waitpid(pid, 0)
+
+
+if __name__ == '__main__':
+    run()
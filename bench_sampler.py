@@ -0,0 +1,126 @@
+"""
+Microbenchmark of one /proc/diskstats sample.
+
+Compares the original getstat()/getioinprogress() from main.py, kept here
+verbatim apart from its error logging, which reopens the file, calls
+readlines() and split()s every line, against diskstats.DiskStatsSampler,
+which keeps the fd open and preads into a reused buffer. With --real the
+per-device diskstats.SysBlockSampler is measured as well when the device
+has /sys/block/<dev>/inflight. When NumPy is installed, snapshot.Snapshotter
+is measured too; note that it parses every counter of every device.
+
+By default a synthetic table with the target device at the end is written
+to a temporary file so the result does not depend on the host. Use
+--real to sample the live /proc/diskstats instead.
+
+usage: python3 bench_sampler.py [--devices N] [--samples N] [--real]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import diskstats
+
+try:
+    import snapshot
+except ImportError:
+    snapshot = None
+
+DEVICE = 'sda'
+STATSFILE = diskstats.STATSFILE
+
+
+def getstat(device):
+    with open(STATSFILE, 'r') as f:
+        stats = f.readlines()
+    for stat_line in stats:
+        lstat = stat_line.split()
+        if len(lstat) > diskstats.DEVICENAME and lstat[diskstats.DEVICENAME] == device:
+            return lstat
+    return None
+
+
+def getioinprogress(device):
+    stat_data = getstat(device)
+    if stat_data and len(stat_data) > diskstats.IOINPROGRESS:
+        return int(stat_data[diskstats.IOINPROGRESS])
+    return 0
+
+
+def write_table(path, ndevices, device=DEVICE):
+    # Loop, dm and nvme partitions first, the monitored device last, which is
+    # the worst case for a linear scan.
+    with open(path, 'w') as f:
+        for i in range(ndevices - 1):
+            f.write(f"{259:4d} {i:7d} nvme0n1p{i} 1234 5 67890 12 3456 7 89012 34 0 56 78 0 0 0 0 0 0\n")
+        f.write(f"{8:4d} {0:7d} {device} 687090 112702 58638000 6132652 1812074 3208268 "
+                f"192392230 45087140 1 15660532 51216212 0 0 0 0 0 0\n")
+
+
+def per_sample(fn, samples):
+    fn()
+    start = time.perf_counter()
+    for _ in range(samples):
+        fn()
+    return (time.perf_counter() - start) / samples
+
+
+def peak_bytes(fn, samples):
+    # Peak traced allocation while sampling, i.e. the transient garbage one
+    # sample creates.
+    fn()
+    tracemalloc.start()
+    for _ in range(samples):
+        fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--samples', type=int, default=5000)
+    parser.add_argument('--real', action='store_true', help='sample the live ' + diskstats.STATSFILE)
+    parser.add_argument('--device', default=DEVICE)
+    args = parser.parse_args()
+
+    tmp = None
+    if args.real:
+        path = diskstats.STATSFILE
+    else:
+        tmp = tempfile.NamedTemporaryFile('w', suffix='.diskstats', delete=False)
+        tmp.close()
+        path = tmp.name
+        write_table(path, args.devices, args.device)
+
+    global STATSFILE
+    STATSFILE = path
+    sampler = diskstats.DiskStatsSampler(args.device, path)
+    try:
+        legacy = lambda: getioinprogress(args.device)
+        current = sampler.ioinprogress
+        assert legacy() == current(), 'samplers disagree'
+        print(f"table: {path} ({os.path.getsize(path)} bytes)")
+        candidates = [('getioinprogress()', legacy), ('DiskStatsSampler', current)]
+        if args.real:
+            sysfs = diskstats.open_sampler(args.device, path)
+            if isinstance(sysfs, diskstats.SysBlockSampler):
+                candidates.append(('SysBlockSampler', sysfs.ioinprogress))
+        if snapshot is not None:
+            candidates.append(('Snapshotter (all)', snapshot.Snapshotter(path).snapshot))
+        for name, fn in candidates:
+            cost = per_sample(fn, args.samples)
+            peak = peak_bytes(fn, min(args.samples, 1000))
+            print(f"{name:20s} {cost * 1e6:9.2f} us/sample  peak {peak:8d} bytes allocated")
+    finally:
+        sampler.close()
+        if tmp is not None:
+            os.unlink(tmp.name)
+
+
+if __name__ == '__main__':
+    run()
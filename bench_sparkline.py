@@ -0,0 +1,80 @@
+"""
+Render time per frame of the sparkline tray icon.
+
+Compares sparkline.Sparkline, which scrolls its shared pixel buffer in
+place and draws only the new column, with redrawing the whole graph from
+the history with ImageDraw into a new image every frame. Every frame
+advances the graph by one column, the worst case for the in place render;
+frames where only the newest bar grows cost less. The PNG encoding a tray
+backend does on each update is measured too, for scale.
+
+usage: python3 bench_sparkline.py [--frames N] [--width W] [--height H]
+"""
+
+import argparse
+import io
+import random
+import time
+
+from PIL import Image, ImageDraw
+
+from sparkline import Sparkline, BARCOLOUR, BACKGROUND
+
+
+def redraw(history, width, height, scale):
+    # The straightforward renderer: a new image and one rectangle per bar.
+    image = Image.new('RGBA', (width, height), BACKGROUND)
+    dc = ImageDraw.Draw(image)
+    for x, value in enumerate(history):
+        bar = min(height, int(value * scale + 0.5))
+        if bar:
+            dc.rectangle([x, height - bar, x, height - 1], fill=BARCOLOUR)
+    return image
+
+
+def inplace(frames, width, height, values):
+    now = [0.0]
+    sparkline = Sparkline(width, height, seconds=width, clock=lambda: now[0])
+    start = time.perf_counter()
+    for frame in range(frames):
+        now[0] = frame + 1.0
+        sparkline.add(values[frame % len(values)])
+        sparkline.image()
+    return (time.perf_counter() - start) / frames
+
+
+def full(frames, width, height, values):
+    history = [0.0] * width
+    scale = height / 100.0
+    start = time.perf_counter()
+    for frame in range(frames):
+        history.pop(0)
+        history.append(values[frame % len(values)])
+        redraw(history, width, height, scale)
+    return (time.perf_counter() - start) / frames
+
+
+def encode(frames, width, height, values):
+    image = redraw(values[:width], width, height, height / 100.0)
+    start = time.perf_counter()
+    for frame in range(frames):
+        image.save(io.BytesIO(), 'PNG')
+    return (time.perf_counter() - start) / frames
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--frames', type=int, default=10000)
+    parser.add_argument('--width', type=int, default=32)
+    parser.add_argument('--height', type=int, default=32)
+    args = parser.parse_args()
+    random.seed(1)
+    values = [random.choice((0.0, 0.0, random.uniform(0.0, 100.0))) for _ in range(997)]
+    print(f"{'renderer':28s} {'us/frame':>10s}")
+    for name, fn in (('Sparkline, in place', inplace), ('ImageDraw, full redraw', full),
+                     ('PNG encode (tray backend)', encode)):
+        print(f"{name:28s} {fn(args.frames, args.width, args.height, values) * 1e6:10.1f}")
+
+
+if __name__ == '__main__':
+    run()
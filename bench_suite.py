@@ -0,0 +1,207 @@
+"""
+Benchmark suite for the sampling hot path, on synthetic fixtures.
+
+Needs no root and no real disks: every diskstats table, /sys/block tree
+and LED is written by fixtures.py into a temporary directory, so it runs
+the same on a laptop and on a CI box.
+
+  parse     time per sample and peak bytes allocated per sample, for
+            DiskStatsSampler (one device, last in the table), MultiSampler
+            (4 devices spread over the table), SysBlockSampler and, when
+            NumPy is installed, Snapshotter (every device), for every
+            table size with old (11) and current (17) counter columns
+  syscalls  system calls per SamplingEngine tick, counted by wrapping the
+            os functions the samplers and the LED driver use
+  latency   time from a counter change in the table to the LED write,
+            through SamplingEngine, BlinkOutput, BlinkScheduler and
+            LedDriver, with the poller at its fast rate and backed off to
+            its idle interval
+
+usage: python3 bench_suite.py [--sizes 10,100,1000,10000] [--samples N]
+                              [--trials N] [--only parse|syscalls|latency]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+import diskstats
+from bench_sampler import per_sample, peak_bytes
+from engine import SamplingEngine, BlinkOutput
+from fixtures import DiskStatsFixture, FakeLed, OLDCOUNTERS, FLUSHCOUNTERS
+from ledcontrol import LedDriver
+from scheduler import BlinkScheduler
+
+try:
+    import snapshot
+except ImportError:
+    snapshot = None
+
+BLINKRATE = 0.065
+SIZES = (10, 100, 1000, 10000)
+SYSCALLS = ('open', 'close', 'read', 'pread', 'preadv', 'write', 'pwrite', 'lseek', 'fstat', 'stat',
+            'access')
+
+
+def fixture(directory, ndevices, counters):
+    return DiskStatsFixture(os.path.join(directory, f"diskstats-{ndevices}-{counters}"), ndevices,
+                            counters, sysfs=os.path.join(directory, f"block-{ndevices}-{counters}"))
+
+
+def bench_parse(directory, sizes, samples):
+    print(f"{'table':>14s} {'sampler':24s} {'us/sample':>10s} {'peak bytes':>11s}")
+    for counters in (OLDCOUNTERS, FLUSHCOUNTERS):
+        for size in sizes:
+            table = fixture(directory, size, counters)
+            last = table.names[-1]
+            spread = [table.names[i * (len(table.names) - 1) // 3] for i in range(4)]
+            single = diskstats.DiskStatsSampler(last, table.path)
+            multi = diskstats.MultiSampler(spread, table.path)
+            views = [multi.sampler(device) for device in spread]
+            sysfs = diskstats.SysBlockSampler(last, table.sysfs)
+            counts = []
+
+            def sample_multi():
+                multi.refresh()
+                for view in views:
+                    view.counters(counts)
+
+            candidates = [('DiskStatsSampler', lambda: (single.refresh(), single.counters(counts))),
+                          ('MultiSampler (4)', sample_multi),
+                          ('SysBlockSampler', lambda: (sysfs.refresh(), sysfs.counters(counts)))]
+            if snapshot is not None:
+                candidates.append(('Snapshotter (all)', snapshot.Snapshotter(table.path).snapshot))
+            for name, fn in candidates:
+                cost = per_sample(fn, samples)
+                peak = peak_bytes(fn, min(samples, 500))
+                print(f"{size:6d} x {counters:2d}    {name:24s} {cost * 1e6:10.2f} {peak:11d}")
+            single.close()
+            multi.close()
+
+
+class SyscallCounter(object):
+    """Counts calls of the os functions in SYSCALLS while active."""
+
+    def __init__(self):
+        self.counts = dict((name, 0) for name in SYSCALLS)
+        self._saved = {}
+
+    def __enter__(self):
+        for name in SYSCALLS:
+            original = getattr(os, name, None)
+            if original is None:
+                continue
+            self._saved[name] = original
+
+            def counted(*args, _name=name, _original=original, **kwargs):
+                self.counts[_name] += 1
+                return _original(*args, **kwargs)
+            setattr(os, name, counted)
+        return self
+
+    def __exit__(self, *exc):
+        for name, original in self._saved.items():
+            setattr(os, name, original)
+        return False
+
+
+def bench_syscalls(directory, sizes, samples):
+    print(f"{'table':>14s} {'engine':24s} {'syscalls/tick':>14s}  by call")
+    for size in sizes:
+        table = fixture(directory, size, FLUSHCOUNTERS)
+        last = table.names[-1]
+        spread = [table.names[i * (len(table.names) - 1) // 3] for i in range(4)]
+        for name, patterns, sysfs in (('1 device, sysfs', [last], table.sysfs),
+                                      ('1 device, diskstats', [last], None),
+                                      ('4 devices, diskstats', spread, table.sysfs)):
+            engine = SamplingEngine(table.path, hotplug=False, sysfs=sysfs)
+            engine.add(BlinkOutput(BlinkScheduler(BLINKRATE, lambda: None, lambda: None)), patterns)
+            engine.start()
+            engine.tick()
+            with SyscallCounter() as counter:
+                for _ in range(samples):
+                    engine.tick()
+            engine.close()
+            total = sum(counter.counts.values()) / samples
+            calls = ', '.join(f"{call} {count / samples:g}" for call, count in counter.counts.items() if count)
+            print(f"{size:6d} x {FLUSHCOUNTERS:2d}    {name:24s} {total:14.2f}  {calls}")
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench_latency(directory, sizes, trials, idle):
+    print(f"{'table':>14s} {'poller':24s} {'median ms':>10s} {'p95 ms':>8s} {'max ms':>8s}")
+    led = FakeLed(os.path.join(directory, 'leds'))
+    rnd = random.Random(0)
+    for size in sizes:
+        table = fixture(directory, size, FLUSHCOUNTERS)
+        device = table.names[-1]
+        driver = LedDriver(led.brightness)
+        lit = threading.Event()
+        dark = threading.Event()
+
+        def turnon():
+            driver.on()
+            dark.clear()
+            lit.set()
+
+        def turnoff():
+            driver.off()
+            lit.clear()
+            dark.set()
+
+        engine = SamplingEngine(table.path, BLINKRATE / 4.0, idle, hotplug=False, sysfs=None)
+        engine.add(BlinkOutput(BlinkScheduler(BLINKRATE, turnon, turnoff)), [device])
+        engine.start()
+        thread = threading.Thread(target=engine.run, daemon=True)
+        thread.start()
+        # The change lands at a random phase of the poller: right after the blink of
+        # the previous one ended, or once the poller has backed off to 'idle'.
+        for name, pause in (('fast', 0.0), (f"idle ({idle:g} s)", idle * 4)):
+            latencies = []
+            for _ in range(trials):
+                dark.wait(idle * 2)
+                time.sleep(pause + rnd.uniform(0.0, BLINKRATE / 4.0 if pause == 0.0 else idle))
+                table.bump(device)
+                changed = time.monotonic()
+                if lit.wait(idle * 2):
+                    latencies.append(time.monotonic() - changed)
+            if latencies:
+                print(f"{size:6d} x {FLUSHCOUNTERS:2d}    {name:24s} {statistics.median(latencies) * 1e3:10.2f} "
+                      f"{percentile(latencies, 0.95) * 1e3:8.2f} {max(latencies) * 1e3:8.2f}")
+        engine.stop()
+        thread.join()
+        engine.close()
+        driver.close()
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated numbers of devices in the tables')
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--trials', type=int, default=10)
+    parser.add_argument('--idle', type=float, default=0.25, help='idle interval of the latency runs')
+    parser.add_argument('--only', choices=('parse', 'syscalls', 'latency'))
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    with tempfile.TemporaryDirectory(prefix='dsklite-bench-') as directory:
+        if args.only in (None, 'parse'):
+            bench_parse(directory, sizes, args.samples)
+            print()
+        if args.only in (None, 'syscalls'):
+            bench_syscalls(directory, sizes, args.samples)
+            print()
+        if args.only in (None, 'latency'):
+            bench_latency(directory, sizes, args.trials, args.idle)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,352 @@
+"""
+Terminal dashboard of every monitored device, for servers without an LED.
+
+DashboardOutput is an engine.SamplingEngine output that shows a line per
+device: an activity lamp (green for reads, red for writes, yellow for
+both, like the tray icon), the read and write MB/s with a bar each, %util
+and a history of the peak %util of the last HISTORY seconds. It runs off
+the same sampling loop as the LED and tray outputs, at most 'fps' frames a
+second.
+
+Drawing is kept cheap for slow SSH links and hundreds of devices:
+
+  - The sampling thread only copies the numbers of every device into a
+    list and wakes the dashboard thread, which does all curses work. A
+    terminal that cannot keep up only delays frames, never samples.
+  - Every line is a set of fixed width fields. DiffScreen remembers the
+    text and attribute of each field on screen and only hands curses the
+    ones that changed, and curses in turn only sends the changed cells.
+    An idle device whose lamp stays dark, whose rates stay 0 and whose
+    history does not move costs nothing per frame.
+  - The history moves one column per HISTORYSTEP seconds, not per frame,
+    so busy devices rewrite their history field at most once a second.
+  - Bars follow the square root of the throughput up to 'fullscale', as
+    the tray icon's brightness does, so light I/O is still visible.
+
+Keys: q quits, the arrow and page keys scroll when there are more devices
+than lines. Run it with main.py --dashboard [FPS].
+"""
+
+import curses
+import locale
+import sys
+import threading
+import time
+
+from engine import Output
+
+FPS = 10.0
+FULLSCALE = 200.0  # MB/s drawn as a full bar
+HISTORY = 30  # Columns of history
+HISTORYSTEP = 1.0  # Seconds per history column
+KEYPOLL = 0.1  # Longest time a key press waits while no frame is due
+NAMEWIDTH = 12
+MAXBAR = 20
+TOPROWS = 2  # Title and column headings
+# Partial blocks for bars and levels for the history, with ASCII fallbacks.
+UNICODEBAR = ' ▏▎▍▌▋▊▉█'
+ASCIIBAR = ' ' + '#' * 8
+UNICODESPARK = ' ▁▂▃▄▅▆▇█'
+ASCIISPARK = ' .:-=+*#%@'
+UNICODELAMP = '●'
+ASCIILAMP = '*'
+READING, WRITING, BOTH = 0, 1, 2  # Lamp colours
+
+
+class DeviceRow(object):
+    """Displayed state of one device."""
+
+    __slots__ = ('device', 'readmb', 'writemb', 'utilization', 'lamp', 'history', 'peak', 'spark')
+
+    def __init__(self, device, history):
+        self.device = device
+        self.readmb = self.writemb = self.utilization = 0.0
+        self.lamp = None  # Lamp colour: READING, WRITING, BOTH or None when dark
+        self.history = [0.0] * history  # Peak %util of every column, oldest first
+        self.peak = 0.0  # Peak %util of the current column
+        self.spark = None  # History field text, rebuilt when a column is added
+
+
+class DiffScreen(object):
+    """Writes fixed position fields to a curses window, skipping unchanged ones."""
+
+    def __init__(self, window):
+        self.window = window
+        self.shown = {}  # (text, attribute) of every field on screen, by row and column
+        self.fields = 0  # Fields written, for the statistics
+        self.cells = 0
+
+    def put(self, row, column, text, attribute=0):
+        line = self.shown.get(row)
+        if line is None:
+            line = self.shown[row] = {}
+        value = (text, attribute)
+        if line.get(column) == value:
+            return
+        line[column] = value
+        self.fields += 1
+        self.cells += len(text)
+        try:
+            self.window.addstr(row, column, text, attribute)
+        except curses.error:
+            # Writing the bottom right cell moves the cursor off the screen, and a field
+            # may be cut by a terminal that shrank since the layout was computed.
+            pass
+
+    def clear(self, row):
+        # Blank a whole line, e.g. one a device that went away was shown on.
+        if self.shown.get(row) == {}:
+            return
+        self.shown[row] = {}
+        self.fields += 1
+        try:
+            self.window.move(row, 0)
+            self.window.clrtoeol()
+        except curses.error:
+            pass
+
+    def reset(self):
+        # Forget what is on screen, e.g. after a resize, so the next frame draws everything.
+        self.shown.clear()
+        self.window.erase()
+
+    def flush(self):
+        self.window.noutrefresh()
+        curses.doupdate()
+
+
+class DashboardOutput(Output):
+    """Draws every device in a curses screen, from a thread of its own."""
+
+    def __init__(self, fps=FPS, fullscale=FULLSCALE, history=HISTORY, step=HISTORYSTEP):
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.fullscale = fullscale
+        self.historylength = history
+        self.step = step
+        self.rows = {}  # DeviceRow of every device, keyed by name
+        self.order = []  # Device names in display order
+        self.frames = 0
+        self.cpu = 0.0  # CPU seconds of the dashboard thread
+        self.screen = None
+        self.offset = 0  # First device shown, when scrolled
+        self._cond = threading.Condition()
+        self._snapshot = None  # Latest snapshot not drawn yet
+        self._stopped = False
+        self._thread = None
+        self._due = None  # Engine time at which the next history column starts
+        self._layout = None
+
+    def start(self):
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='dsklite-dashboard', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def update(self, states, now):
+        # Sampling thread: copy the numbers and wake the dashboard thread.
+        snapshot = []
+        seen = set()
+        for state in states.values():
+            for device in state.devices:
+                if device in seen:
+                    continue
+                seen.add(device)
+                metrics = state.metrics.get(device)
+                if metrics is None:
+                    continue
+                snapshot.append((device, metrics.readmb, metrics.writemb, metrics.utilization,
+                                 bool(metrics.reads), bool(metrics.writes), bool(metrics.inflight)))
+        with self._cond:
+            self._snapshot = (snapshot, now)
+            self._cond.notify()
+
+    def _run(self):
+        try:
+            self._open()
+        except curses.error as e:
+            # Recovery: Not a terminal curses can drive. Stop the engine so the
+            # foreground dashboard ends instead of sampling for nothing.
+            sys.stderr.write(f"Error starting the dashboard: {e}\n")
+            self.engine.stop()
+            return
+        try:
+            while True:
+                with self._cond:
+                    if self._snapshot is None and not self._stopped:
+                        self._cond.wait(KEYPOLL)
+                    if self._stopped:
+                        return
+                    snapshot, self._snapshot = self._snapshot, None
+                redraw = self._keys()
+                if snapshot is not None:
+                    self._apply(*snapshot)
+                    redraw = True
+                if redraw:
+                    self._draw()
+                    self.cpu = time.thread_time()
+        finally:
+            curses.endwin()
+
+    def _open(self):
+        locale.setlocale(locale.LC_ALL, '')
+        unicode = locale.getpreferredencoding(False).upper().replace('-', '') == 'UTF8'
+        self.bar = UNICODEBAR if unicode else ASCIIBAR
+        self.spark = UNICODESPARK if unicode else ASCIISPARK
+        self.lamp = UNICODELAMP if unicode else ASCIILAMP
+        window = curses.initscr()
+        try:
+            curses.noecho()
+            curses.cbreak()
+            window.keypad(True)
+            window.nodelay(True)
+            try:
+                curses.curs_set(0)
+            except curses.error:
+                pass
+            self.colours = [0, 0, 0]  # Lamp attribute of READING, WRITING and BOTH
+            if curses.has_colors():
+                curses.start_color()
+                try:
+                    curses.use_default_colors()
+                    background = -1
+                except curses.error:
+                    background = curses.COLOR_BLACK
+                for number, colour in enumerate((curses.COLOR_GREEN, curses.COLOR_RED, curses.COLOR_YELLOW), 1):
+                    curses.init_pair(number, colour, background)
+                    self.colours[number - 1] = curses.color_pair(number) | curses.A_BOLD
+        except curses.error:
+            curses.endwin()
+            raise
+        self.screen = DiffScreen(window)
+        self._relayout()
+
+    def _relayout(self):
+        # Column of every field for the current terminal width.
+        lines, columns = self.screen.window.getmaxyx()
+        # Lamp, name, two rates with their bars and %util; the history gets what is left.
+        fixed = 2 + NAMEWIDTH + 1 + 2 * 10 + 7
+        bar = max(4, min(MAXBAR, (columns - 1 - fixed - self.historylength) // 2))
+        history = max(0, min(self.historylength, columns - 1 - fixed - 2 * bar))
+        name = 2
+        read = name + NAMEWIDTH + 1
+        write = read + 9 + bar + 1
+        utilization = write + 9 + bar + 1
+        spark = utilization + 7
+        self._layout = (lines, columns, bar, history, name, read, write, utilization, spark)
+        self.screen.reset()
+        for row in self.rows.values():
+            row.spark = None
+
+    def _keys(self):
+        # Handle pending key presses. Returns True if the screen must be redrawn.
+        window = self.screen.window
+        redraw = False
+        while True:
+            key = window.getch()
+            if key == -1:
+                return redraw
+            if key in (ord('q'), ord('Q')):
+                self.engine.stop()
+            elif key == curses.KEY_RESIZE:
+                curses.update_lines_cols()
+                self._relayout()
+                redraw = True
+            elif key in (curses.KEY_DOWN, curses.KEY_UP, curses.KEY_NPAGE, curses.KEY_PPAGE):
+                page = max(1, self._layout[0] - TOPROWS)
+                delta = {curses.KEY_DOWN: 1, curses.KEY_UP: -1, curses.KEY_NPAGE: page,
+                         curses.KEY_PPAGE: -page}[key]
+                offset = max(0, min(len(self.order) - page, self.offset + delta))
+                if offset != self.offset:
+                    self.offset = offset
+                    redraw = True
+
+    def _apply(self, snapshot, now):
+        rows = self.rows
+        added = False
+        for device, readmb, writemb, utilization, reading, writing, inflight in snapshot:
+            row = rows.get(device)
+            if row is None:
+                row = rows[device] = DeviceRow(device, self.historylength)
+                added = True
+            row.readmb, row.writemb, row.utilization = readmb, writemb, utilization
+            if reading or writing or inflight:
+                if reading and not writing:
+                    row.lamp = READING
+                elif writing and not reading:
+                    row.lamp = WRITING
+                else:
+                    # I/O in flight without completions shows both colours, like the tray icon.
+                    row.lamp = BOTH
+            else:
+                row.lamp = None
+            if utilization > row.peak:
+                row.peak = utilization
+        if len(rows) > len(snapshot):
+            # Devices that were unplugged.
+            present = set(entry[0] for entry in snapshot)
+            for device in [device for device in rows if device not in present]:
+                del rows[device]
+            added = True
+        if added:
+            # Devices stay on their line as long as the set does not change.
+            self.order = sorted(rows)
+            self.offset = min(self.offset, max(0, len(self.order) - 1))
+        if self._due is None:
+            self._due = now + self.step
+        elif now >= self._due:
+            columns = min(self.historylength, int((now - self._due) / self.step) + 1)
+            self._due += columns * self.step
+            if self._due <= now:
+                self._due = now + self.step
+            for row in rows.values():
+                if row.peak or any(row.history):
+                    row.history = row.history[columns:] + [row.peak] + [0.0] * (columns - 1)
+                    row.peak = 0.0
+                    row.spark = None
+
+    def _draw(self):
+        screen = self.screen
+        lines, columns, bar, history, name, read, write, utilization, spark = self._layout
+        put = screen.put
+        put(0, 0, f"dsklite {time.strftime('%H:%M:%S')}  {len(self.order)} devices  "
+                  f"q quits, arrows scroll"[:columns - 1].ljust(columns - 1), curses.A_BOLD)
+        put(1, 0, (f"  {'device':{NAMEWIDTH}s} {'read MB/s':{9 + bar}s} {'write MB/s':{9 + bar}s} "
+                   f"{'%util':>6s} history")[:columns - 1].ljust(columns - 1), curses.A_UNDERLINE)
+        shown = self.order[self.offset:self.offset + max(0, lines - TOPROWS)]
+        for line, device in enumerate(shown, TOPROWS):
+            row = self.rows[device]
+            lamp = row.lamp
+            put(line, 0, self.lamp if lamp is not None else ' ', self.colours[lamp] if lamp is not None else 0)
+            put(line, name, device[:NAMEWIDTH].ljust(NAMEWIDTH))
+            put(line, read, f"{row.readmb:8.1f} " + self._bar(row.readmb, bar))
+            put(line, write, f"{row.writemb:8.1f} " + self._bar(row.writemb, bar))
+            put(line, utilization, f"{row.utilization:5.1f}%")
+            if history:
+                if row.spark is None:
+                    levels = len(self.spark) - 1
+                    row.spark = ''.join(self.spark[min(levels, int(value * levels / 100.0 + 0.999))]
+                                        for value in row.history[-history:])
+                put(line, spark, row.spark)
+        for line in range(TOPROWS + len(shown), lines):
+            # Lines left by devices that went away or by scrolling to the end.
+            screen.clear(line)
+        screen.flush()
+        self.frames += 1
+
+    def _bar(self, mbps, width):
+        # 'width' cells filled in eighths, following the square root of the throughput.
+        if mbps <= 0:
+            return ' ' * width
+        eighths = max(1, min(width * 8, int((mbps / self.fullscale) ** 0.5 * width * 8)))
+        full, part = divmod(eighths, 8)
+        text = self.bar[8] * full
+        if part:
+            text += self.bar[part]
+        return text.ljust(width)
@@ -0,0 +1,154 @@
+"""
+Block device hotplug notifications with inotify.
+
+This is the inotify code of tryinotify.py turned into a watcher that is
+actually useful: procfs never reports changes to /proc/diskstats, but
+devices being added or removed do show up as directory entries created or
+deleted in /sys/block and, on devtmpfs, in /dev. DeviceWatcher watches
+both (whichever can be watched) and changed() tells the samplers when to
+rebuild their cached device index, instead of rediscovering devices on
+every poll.
+
+The inotify instance is opened through libc with ctypes, non-blocking, so
+changed() costs one read() per tick that fails with EAGAIN while nothing
+happened, and fileno() is a real fd an event loop can wait on. When libc
+has no inotify or no path can be watched, 'available' is False and callers
+keep their timed rescans.
+
+Run this file directly to log hotplug events, like tryinotify.py.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import time
+
+_DEFAULT_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_LOGGER = logging.getLogger(__name__)
+WATCHPATHS = ('/sys/block', '/dev')
+
+# From <sys/inotify.h>.
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len of struct inotify_event, then the name
+READSIZE = 64 * 1024
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.inotify_init1.argtypes = [ctypes.c_int]
+    _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+except (OSError, AttributeError):
+    _libc = None
+
+
+class DeviceWatcher(object):
+    """Non-blocking inotify watch on the directories block devices appear in."""
+
+    def __init__(self, paths=WATCHPATHS):
+        self.paths = []
+        self.events = 0
+        self._fd = None
+        self._watches = {}  # Watched path, keyed by watch descriptor
+        if _libc is None:
+            _LOGGER.info("libc has no inotify, devices are rediscovered on a timer.")
+            return
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            # Recovery: Run without hotplug notifications, callers fall back to timed rescans.
+            _LOGGER.error("Failed to initialize inotify: %s", os.strerror(ctypes.get_errno()))
+            return
+        self._fd = fd
+        mask = IN_CREATE | IN_DELETE | IN_MOVED_TO | IN_MOVED_FROM
+        for path in paths:
+            wd = _libc.inotify_add_watch(fd, os.fsencode(path), mask)
+            if wd < 0:
+                # Not every path exists everywhere, e.g. /dev may not be devtmpfs.
+                _LOGGER.info("Cannot watch '%s' for hotplug: %s", path, os.strerror(ctypes.get_errno()))
+                continue
+            self._watches[wd] = path
+            self.paths.append(path)
+        if not self.paths:
+            self.close()
+
+    @property
+    def available(self):
+        return bool(self.paths)
+
+    def fileno(self):
+        # The inotify fd, readable while events are pending, for event loops. None
+        # when not watching.
+        return self._fd if self.paths else None
+
+    def changed(self):
+        # True if any device was added or removed since the last call.
+        if not self.paths:
+            return False
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, READSIZE)
+            except BlockingIOError:
+                return changed
+            except OSError as e:
+                # Recovery: Report a change so that callers rebuild their index once;
+                # the watch itself is kept and retried on the next call.
+                _LOGGER.error("Error reading hotplug events: %s", e)
+                return True
+            pos = 0
+            while pos + EVENT.size <= len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, pos)
+                pos += EVENT.size
+                if mask & IN_Q_OVERFLOW:
+                    _LOGGER.debug("Hotplug event queue overflowed")
+                else:
+                    filename = data[pos:pos + length].rstrip(b'\0').decode('utf-8', 'replace')
+                    _LOGGER.debug("Hotplug %#x %s/%s", mask, self._watches.get(wd), filename)
+                pos += length
+                self.events += 1
+                changed = True
+
+    def close(self):
+        # Closing the fd removes its watches.
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self.paths = []
+        self._watches.clear()
+
+
+def _configure_logging():
+    _LOGGER.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    formatter = logging.Formatter(_DEFAULT_LOG_FORMAT)
+    ch.setFormatter(formatter)
+    _LOGGER.addHandler(ch)
+
+
+def _main():
+    watcher = DeviceWatcher()
+    if not watcher.available:
+        return
+    _LOGGER.info("Watching %s for block devices...", ', '.join(watcher.paths))
+    try:
+        while True:
+            if watcher.changed():
+                _LOGGER.info("Block devices changed (%d events so far).", watcher.events)
+            time.sleep(1.0)
+    finally:
+        watcher.close()
+
+
+if __name__ == '__main__':
+    _configure_logging()
+    try:
+        _main()
+    except KeyboardInterrupt:
+        pass
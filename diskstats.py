@@ -0,0 +1,474 @@
+"""
+Low overhead readers for the kernel block device statistics.
+
+/proc/diskstats is read through a file descriptor that stays open for the
+life of the sampler. Every sample rereads it from offset 0 with os.preadv()
+into a bytearray that is reused between samples, and only the fields that
+are asked for are converted to int, straight out of that buffer. No line
+list, no split() and no per-device strings are built on the hot path.
+
+When the kernel exposes the same counters per device in
+/sys/block/<dev>/stat and /sys/block/<dev>/inflight, SysBlockSampler reads
+those small files instead, so the cost of a sample does not grow with the
+number of block devices. open_sampler() picks it automatically and falls
+back to /proc/diskstats otherwise.
+
+MultiSampler monitors several devices, or globs like 'nvme*n1', and fills
+all of them in from a single read of /proc/diskstats per sample. Given a
+devwatch.DeviceWatcher it only rebuilds its device index when devices are
+added or removed, so devices that appear later are picked up at once and
+devices that are gone cost nothing per sample.
+
+Field numbers follow the same convention as main.py: they are indexes into
+a whitespace split line, so DEVICENAME is 2 and IOINPROGRESS is 11.
+"""
+
+import fnmatch
+import os
+import sys
+import time
+
+STATSFILE = '/proc/diskstats'
+SYSBLOCK = '/sys/block'
+# Partitions only have a stat file under /sys/class/block.
+SYSCLASSBLOCK = '/sys/class/block'
+DEVICENAME = 2
+READS = 3
+READSMERGED = 4
+SECTORSREAD = 5
+READTIME = 6
+WRITES = 7
+WRITESMERGED = 8
+SECTORSWRITTEN = 9
+WRITETIME = 10
+IOINPROGRESS = 11
+IOTIME = 12
+WEIGHTEDTIME = 13
+FIRSTCOUNTER = READS
+
+INITIALBUFSIZE = 64 * 1024
+SYSFSBUFSIZE = 512
+RESCANINTERVAL = 5.0  # Seconds between glob resolutions in MultiSampler
+SPACE = ord(' ')
+NEWLINE = ord('\n')
+
+
+class DiskStatsTable(object):
+    """The whole of /proc/diskstats, reread into one reusable buffer."""
+
+    def __init__(self, path=STATSFILE, bufsize=INITIALBUFSIZE):
+        self.path = path
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.len = 0
+        # Bumped whenever the buffer is replaced, so that cached offsets into
+        # the old one are not trusted.
+        self.generation = 0
+        self._fd = None
+
+    def _open(self):
+        try:
+            self._fd = os.open(self.path, os.O_RDONLY)
+        except OSError as e:
+            # Log error if STATSFILE cannot be opened.
+            # Recovery: Leave the fd unset, the next sample will retry the open.
+            sys.stderr.write(f"Error opening STATSFILE '{self.path}': {e}\n")
+            self._fd = None
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+
+    def refresh(self):
+        # Reread the whole file into the reusable buffer. Returns False when
+        # no data could be read.
+        if self._fd is None and self._open() is None:
+            return False
+        try:
+            while True:
+                n = os.preadv(self._fd, [self.buf], 0)
+                if n < len(self.buf):
+                    break
+                # The table did not fit. Grow the buffer once and read again,
+                # later samples then reuse the bigger buffer.
+                self.buf = bytearray(len(self.buf) * 2)
+                self.view = memoryview(self.buf)
+                self.generation += 1
+        except OSError as e:
+            # Log error if STATSFILE cannot be read. This is a non-critical error for a single read attempt.
+            # Recovery: Drop the fd so the next sample reopens the file.
+            sys.stderr.write(f"Error reading STATSFILE '{self.path}': {e}\n")
+            self.close()
+            self.len = 0
+            return False
+        self.len = n
+        return True
+
+    def names(self):
+        # Every device name in the current buffer. This splits every line and
+        # is only meant for (re)discovering devices, not for the sampling path.
+        names = []
+        for line in self.view[:self.len].tobytes().split(b'\n'):
+            fields = line.split(None, DEVICENAME + 1)
+            if len(fields) > DEVICENAME:
+                names.append(fields[DEVICENAME].decode('ascii', 'replace'))
+        return names
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class DiskStatsSampler(object):
+    """Samples one device from /proc/diskstats through a persistent fd.
+
+    When 'table' is given the sampler is a view on a table shared with other
+    devices: refresh() then does not reread the file, it only reports whether
+    the device is present in the table's last read, see MultiSampler.
+    """
+
+    def __init__(self, device, path=STATSFILE, bufsize=INITIALBUFSIZE, table=None):
+        self.device = device
+        self.path = path
+        self._owner = table is None
+        self.table = DiskStatsTable(path, bufsize) if table is None else table
+        # The name is matched with its surrounding separators so that 'sda'
+        # never matches 'sda1'.
+        self._key = b' ' + device.encode('ascii') + b' '
+        # Byte offset of the first counter of the device line in the last
+        # sample. The table rarely changes, so it is tried before a search.
+        self._start = -1
+        self._generation = self.table.generation
+        # Set by MultiSampler while a hotplug watcher says the device is not
+        # in the table, so that it is not searched for on every sample.
+        self.absent = False
+
+    def close(self):
+        if self._owner:
+            self.table.close()
+
+    def refresh(self):
+        # True when the device is in the table, reread first unless it is shared.
+        if self._owner and not self.table.refresh():
+            return False
+        return self._locate() >= 0
+
+    def _locate(self):
+        # Returns the offset of the first counter of the device line, or -1.
+        table = self.table
+        buf = table.buf
+        start = self._start
+        # Only bytes before table.len are from the last read: past it are leftovers of
+        # an earlier, longer table, where the key of a device that moved up still is.
+        if (0 < start < table.len and self._generation == table.generation
+                and buf.startswith(self._key, start - len(self._key), start)):
+            return start
+        if self.absent:
+            return -1
+        self._generation = table.generation
+        pos = buf.find(self._key, 0, table.len)
+        if pos < 0:
+            self._start = -1
+            return -1
+        self._start = pos + len(self._key)
+        return self._start
+
+    def _span(self, start, field):
+        # Counters after the device name are separated by a single space.
+        buf = self.table.buf
+        limit = buf.find(NEWLINE, start, self.table.len)
+        if limit < 0:
+            limit = self.table.len
+        pos = start
+        for _ in range(field - FIRSTCOUNTER):
+            pos = buf.find(SPACE, pos, limit) + 1
+            if pos == 0:
+                return -1, -1
+        end = buf.find(SPACE, pos, limit)
+        return pos, limit if end < 0 else end
+
+    def field(self, field):
+        # Value of one counter from the current buffer contents, or None if
+        # the device or the field is missing.
+        start = self._locate()
+        if start < 0:
+            return None
+        pos, end = self._span(start, field)
+        if pos < 0 or end == pos:
+            return None
+        try:
+            return int(self.table.view[pos:end])
+        except ValueError as e:
+            sys.stderr.write(f"Error converting field {field} to int for device '{self.device}': {e}\n")
+            return None
+
+    def sample(self, field=IOINPROGRESS):
+        # Reread the file and return a single counter, 0 when unavailable.
+        if not self.refresh():
+            return 0
+        value = self.field(field)
+        return 0 if value is None else value
+
+    def ioinprogress(self):
+        return self.sample(IOINPROGRESS)
+
+    def counters(self, out=None):
+        # Fill 'out' (a list, reused if given) with every counter of the
+        # device line from the current buffer. Returns None if not found.
+        start = self._locate()
+        if start < 0:
+            return None
+        buf = self.table.buf
+        view = self.table.view
+        end = buf.find(NEWLINE, start, self.table.len)
+        if end < 0:
+            end = self.table.len
+        if out is None:
+            out = []
+        del out[:]
+        pos = start
+        while pos < end:
+            stop = buf.find(SPACE, pos, end)
+            if stop < 0:
+                stop = end
+            if stop > pos:
+                out.append(int(view[pos:stop]))
+            pos = stop + 1
+        return out
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class MultiSampler(object):
+    """Any number of devices, all filled in from one read of /proc/diskstats.
+
+    Devices are given as names or fnmatch globs such as 'nvme*n1'. Globs are
+    resolved against the table on the first sample and again whenever
+    'watcher' (a devwatch.DeviceWatcher) reports a device added or removed,
+    or every 'rescan' seconds without a usable watcher. The per-sample cost
+    is a single pread plus a few find() calls per monitored device, whatever
+    the size of the table.
+    """
+
+    def __init__(self, patterns, path=STATSFILE, bufsize=INITIALBUFSIZE, rescan=RESCANINTERVAL,
+                 clock=time.monotonic, watcher=None):
+        self.patterns = list(patterns)
+        self.table = DiskStatsTable(path, bufsize)
+        self.rescan = rescan
+        self.clock = clock
+        self.watcher = watcher if watcher is not None and watcher.available else None
+        self.resolves = 0
+        self._samplers = {}  # Devices currently matched, name -> view
+        self._views = {}  # Every view handed out or created, name -> view
+        self._present = set()  # Every device name in the table at the last resolve
+        self._matches = dict((pattern, []) for pattern in self.patterns)
+        self._resolved = None  # Time of the last resolve(), None before the first
+
+    def close(self):
+        self.table.close()
+
+    def resolve(self):
+        # Match the patterns against the device names in the current table.
+        # Samplers are kept for devices that are still present, and views
+        # handed out for devices that are gone are marked absent.
+        names = self.table.names()
+        samplers = {}
+        for pattern in self.patterns:
+            if any(c in pattern for c in '*?['):
+                matched = fnmatch.filter(names, pattern)
+            else:
+                matched = [pattern] if pattern in names else []
+            self._matches[pattern] = matched
+            for name in matched:
+                samplers[name] = self._views.get(name) or DiskStatsSampler(name, table=self.table)
+        self._present = set(names)
+        for name, view in self._views.items():
+            view.absent = self.watcher is not None and name not in self._present
+        self._samplers = samplers
+        self._views.update(samplers)
+        self._resolved = self.clock()
+        self.resolves += 1
+
+    def invalidate(self):
+        # Resolve the patterns again on the next refresh(), e.g. when the owner of an
+        # event loop read the watcher's events itself.
+        self._resolved = None
+
+    def _stale(self):
+        if self._resolved is None:
+            return True
+        if self.watcher is not None:
+            return self.watcher.changed()
+        return self.rescan is not None and self.clock() - self._resolved >= self.rescan
+
+    def refresh(self):
+        if not self.table.refresh():
+            return False
+        if self._stale():
+            self.resolve()
+        return True
+
+    def devices(self, pattern=None):
+        # Devices currently matched by 'pattern', or by any pattern.
+        if pattern is not None:
+            return self._matches.get(pattern, [])
+        return list(self._samplers)
+
+    def sampler(self, device):
+        # Per-device view on the shared table. Unknown devices get a view too,
+        # which reports the device as missing until it shows up.
+        sampler = self._views.get(device)
+        if sampler is None:
+            sampler = self._views[device] = DiskStatsSampler(device, table=self.table)
+            sampler.absent = self.watcher is not None and device not in self._present
+        return sampler
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class SysBlockSampler(object):
+    """Samples one device from its own /sys/block/<dev>/{stat,inflight}."""
+
+    def __init__(self, device, sysfs=SYSBLOCK):
+        self.device = device
+        self.statpath = sysfs_path(device, 'stat', sysfs)
+        self.inflightpath = sysfs_path(device, 'inflight', sysfs)
+        self._failing = False  # Only the first of a run of read errors is logged
+        self._buf = bytearray(SYSFSBUFSIZE)
+        self._view = memoryview(self._buf)
+        self._len = 0
+        self._statfd = None
+        self._inflightfd = None
+
+    def _pread(self, fd, path):
+        # Read a small sysfs attribute into the shared buffer, opening it on
+        # first use. Returns the fd (None on failure) so callers can cache it.
+        try:
+            if fd is None:
+                fd = os.open(path, os.O_RDONLY)
+            self._len = os.preadv(fd, [self._buf], 0)
+            self._failing = False
+            return fd
+        except OSError as e:
+            # Log error if the sysfs file cannot be read, e.g. the device was removed.
+            # Recovery: Close the fd, the next sample retries the open, so a device
+            # that comes back is picked up again. Repeats of the error are not logged.
+            if not self._failing:
+                sys.stderr.write(f"Error reading '{path}': {e}\n")
+                self._failing = True
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            self._len = 0
+            return None
+
+    def close(self):
+        for fd in (self._statfd, self._inflightfd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._statfd = self._inflightfd = None
+
+    def refresh(self):
+        self._statfd = self._pread(self._statfd, self.statpath)
+        return self._statfd is not None
+
+    def counters(self, out=None):
+        # Every counter from the last refresh(), in diskstats order starting
+        # with READS. The stat file pads its columns with runs of spaces.
+        if self._len == 0:
+            return None
+        if out is None:
+            out = []
+        del out[:]
+        buf = self._buf
+        view = self._view
+        pos = 0
+        limit = self._len
+        while pos < limit:
+            while pos < limit and buf[pos] in b' \n':
+                pos += 1
+            stop = buf.find(SPACE, pos, limit)
+            if stop < 0:
+                stop = buf.find(NEWLINE, pos, limit)
+                if stop < 0:
+                    stop = limit
+            if stop > pos:
+                out.append(int(view[pos:stop]))
+            pos = stop
+        return out
+
+    def field(self, field):
+        values = self.counters()
+        if values is None or field - FIRSTCOUNTER >= len(values):
+            return None
+        return values[field - FIRSTCOUNTER]
+
+    def sample(self, field=IOINPROGRESS):
+        if field == IOINPROGRESS:
+            return self.ioinprogress()
+        if not self.refresh():
+            return 0
+        value = self.field(field)
+        return 0 if value is None else value
+
+    def ioinprogress(self):
+        # The inflight attribute holds just the in-flight reads and writes,
+        # which is cheaper for the kernel to produce than the full stat line.
+        self._inflightfd = self._pread(self._inflightfd, self.inflightpath)
+        if self._inflightfd is None:
+            return 0
+        try:
+            reads, writes = self._view[:self._len].tobytes().split()
+            return int(reads) + int(writes)
+        except ValueError as e:
+            sys.stderr.write(f"Error parsing '{self.inflightpath}' for device '{self.device}': {e}\n")
+            return 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def sysfs_path(device, name, sysfs=SYSBLOCK):
+    # Whole disks live in /sys/block, partitions only in /sys/class/block.
+    path = os.path.join(sysfs, device, name)
+    if sysfs == SYSBLOCK and not os.path.exists(path):
+        path = os.path.join(SYSCLASSBLOCK, device, name)
+    return path
+
+
+def open_sampler(device, path=STATSFILE, sysfs=SYSBLOCK):
+    # Prefer the per-device sysfs files, whose cost is independent of the
+    # number of block devices, and fall back to parsing /proc/diskstats.
+    if sysfs is not None:
+        statpath = sysfs_path(device, 'stat', sysfs)
+        inflightpath = sysfs_path(device, 'inflight', sysfs)
+        if os.access(statpath, os.R_OK) and os.access(inflightpath, os.R_OK):
+            return SysBlockSampler(device, sysfs)
+    return DiskStatsSampler(device, path)
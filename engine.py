@@ -0,0 +1,264 @@
+"""
+One sampling engine shared by every output.
+
+main.py, main_stray.py and simplegtkapp.py used to carry their own
+samplers, activity detectors and polling loop, and differed only in what
+they did with the result. SamplingEngine reads the kernel once per tick,
+from one MultiSampler (or one sysfs sampler for a single device), runs
+the activity detection of every device once, and fans the result out to
+any number of registered outputs: a keyboard LED, a tray icon, the
+terminal, a metrics exporter. Running the LED and the tray together
+costs one set of reads and one sampling thread.
+
+An output subclasses Output and implements update(states, now). 'states'
+maps each device pattern the output was registered for to a PatternState
+with the devices that matched it, whether any of them was active, and
+iostat style metrics. Every output has its own rate limit ('interval'):
+between two updates the engine only ORs the activity of the ticks in
+between into the output's states, so a slow output never misses a burst,
+and the metrics it gets cover the whole time since its previous update.
+
+The engine paces itself with scheduler.AdaptivePoller. run() blocks in
+the calling thread; event loop backends call tick() from a timer instead
+and use poller.update() for the next interval. instrument() makes it
+record its wakeup jitter and CPU time per tick in a selfstats.LoopStats.
+"""
+
+import sys
+import time
+
+from diskstats import open_sampler, MultiSampler, STATSFILE, SYSBLOCK
+from activity import ActivityDetector
+from devwatch import DeviceWatcher
+from iometrics import IoMetrics, HEADER
+from scheduler import AdaptivePoller, IDLEINTERVAL
+from selfstats import LoopStats
+
+FASTINTERVAL = 0.065 / 4.0  # A quarter of the blink duration, as the daemons always sampled
+
+
+class PatternState(object):
+    """What one output learns about one device pattern per update."""
+
+    __slots__ = ('pattern', 'active', 'devices', 'metrics', 'readmb', 'writemb', 'utilization',
+                 'inflight')
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.active = False  # Any I/O since the previous update of the output
+        self.devices = []  # Devices the pattern matched at the last tick
+        self.metrics = {}  # IoMetrics since the previous update, keyed by device
+        self.readmb = self.writemb = 0.0  # Sums over the devices
+        self.utilization = 0.0  # Of the busiest device
+        self.inflight = 0
+
+
+class Output(object):
+    """Base class of the outputs of a SamplingEngine."""
+
+    interval = 0.0  # Shortest time between two updates, 0 for every tick
+    engine = None  # The SamplingEngine the output was added to
+
+    def start(self):
+        # Called by SamplingEngine.start(), in the process and thread that samples.
+        pass
+
+    def update(self, states, now):
+        # 'states' maps each pattern of the output to its PatternState.
+        pass
+
+    def close(self):
+        pass
+
+
+class BlinkOutput(Output):
+    """Triggers a scheduler.BlinkScheduler while any of its patterns is active."""
+
+    def __init__(self, blinker):
+        self.blinker = blinker
+
+    def start(self):
+        self.blinker.off()  # Known off state before the thread runs
+        self.blinker.start()
+
+    def update(self, states, now):
+        for state in states.values():
+            if state.active:
+                self.blinker.trigger()
+                return
+
+    def close(self):
+        self.blinker.stop()
+
+
+class StatsOutput(Output):
+    """Prints iostat style metrics of every device, every 'interval' seconds."""
+
+    def __init__(self, interval, stream=None):
+        self.interval = interval
+        self.stream = stream or sys.stdout
+
+    def update(self, states, now):
+        lines = []
+        for state in states.values():
+            for device in state.devices:
+                metrics = state.metrics.get(device)
+                if metrics is not None and metrics.interval:
+                    lines.append(metrics.format())
+        if lines:
+            self.stream.write(HEADER + '\n' + '\n'.join(lines) + '\n\n')
+            self.stream.flush()
+
+
+class _Route(object):
+    # An output with its patterns, rate limit and the states it is handed.
+
+    __slots__ = ('output', 'patterns', 'interval', 'due', 'states')
+
+    def __init__(self, output, patterns, interval):
+        self.output = output
+        self.patterns = patterns
+        self.interval = interval
+        self.due = 0.0
+        self.states = dict((pattern, PatternState(pattern)) for pattern in patterns)
+
+
+class SamplingEngine(object):
+    """Samples every device of every registered output once per tick."""
+
+    def __init__(self, path=STATSFILE, fast=FASTINTERVAL, idle=IDLEINTERVAL, sleep=time.sleep,
+                 hotplug=True, clock=time.monotonic, sysfs=SYSBLOCK):
+        # 'path' and 'sysfs' are the diskstats file and the /sys/block directory; a
+        # sysfs of None always reads 'path'.
+        self.path = path
+        self.sysfs = sysfs
+        self.clock = clock
+        self.hotplug = hotplug
+        self.poller = AdaptivePoller(fast, idle, clock=clock, sleep=sleep)
+        self.patterns = []
+        self.monitor = None
+        self.samplers = {}  # Persistent samplers, keyed by device name
+        self.detectors = {}  # Counter delta activity detectors, keyed by device name
+        self.ticks = 0
+        self.stats = None  # selfstats.LoopStats, set by instrument()
+        self._routes = []
+        self._active = {}  # Activity of every device at the current tick, reused
+        self._stopped = False
+
+    def add(self, output, patterns, interval=None):
+        # Register 'output' for the device names or globs in 'patterns'. 'interval'
+        # overrides the output's own rate limit. Returns the output.
+        patterns = list(patterns)
+        output.engine = self
+        for pattern in patterns:
+            if pattern not in self.patterns:
+                self.patterns.append(pattern)
+        self._routes.append(_Route(output, patterns, output.interval if interval is None else interval))
+        return output
+
+    def instrument(self, stats=None):
+        # Record wakeup jitter and CPU time per tick from now on. Returns the LoopStats.
+        self.stats = self.poller.stats = stats or LoopStats(self.clock)
+        return self.stats
+
+    @property
+    def outputs(self):
+        return [route.output for route in self._routes]
+
+    def start(self):
+        # Must be called after any fork(): outputs start their threads here, and the
+        # inotify watch is created in the process that reads it, so devices plugged in
+        # later (USB disks, dm/LUKS mappings) are picked up at once.
+        if len(self.patterns) > 1 or any(c in pattern for pattern in self.patterns for c in '*?['):
+            self.monitor = MultiSampler(self.patterns, self.path,
+                                        watcher=DeviceWatcher() if self.hotplug else None)
+        for route in self._routes:
+            route.output.start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+
+    def close(self):
+        for route in self._routes:
+            route.output.close()
+        if self.monitor is not None:
+            self.monitor.close()
+
+    def devices(self, pattern):
+        return self.monitor.devices(pattern) if self.monitor is not None else [pattern]
+
+    def detector(self, device):
+        detector = self.detectors.get(device)
+        if detector is None:
+            # A single device reads /sys/block/<dev>/stat when the kernel provides it and
+            # /proc/diskstats otherwise; with several devices every sampler is a view on
+            # the one read the monitor does per tick.
+            if self.monitor is not None:
+                sampler = self.monitor.sampler(device)
+            else:
+                sampler = open_sampler(device, self.path, self.sysfs)
+            self.samplers[device] = sampler
+            detector = self.detectors[device] = ActivityDetector(sampler)
+        return detector
+
+    def tick(self):
+        # Sample every device once and update the outputs that are due. Returns
+        # True if any device was active.
+        stats = self.stats
+        if stats is not None:
+            cpu = time.thread_time_ns()
+        if self.monitor is not None:
+            self.monitor.refresh()
+        active = self._active
+        active.clear()
+        anyactive = False
+        for pattern in self.patterns:
+            for device in self.devices(pattern):
+                if device not in active:
+                    # Every device is sampled once, even after one was found active, to keep
+                    # its snapshot current.
+                    active[device] = self.detector(device).sample()
+                    anyactive = anyactive or active[device]
+        now = self.clock()
+        for route in self._routes:
+            due = now >= route.due
+            for pattern, state in route.states.items():
+                devices = self.devices(pattern)
+                for device in devices:
+                    if active[device]:
+                        state.active = True
+                if due:
+                    self._fill(state, devices, now)
+            if due:
+                route.due = now + route.interval
+                route.output.update(route.states, now)
+                for state in route.states.values():
+                    state.active = False
+        self.ticks += 1
+        if stats is not None:
+            stats.cpu.record(time.thread_time_ns() - cpu)
+        return anyactive
+
+    def _fill(self, state, devices, now):
+        # Bring the metrics of a pattern up to date for an output that is due.
+        state.devices = devices
+        state.readmb = state.writemb = state.utilization = 0.0
+        state.inflight = 0
+        for device in devices:
+            metrics = state.metrics.get(device)
+            if metrics is None:
+                metrics = state.metrics[device] = IoMetrics(device)
+            counters = self.detectors[device].counters
+            if counters is not None:
+                metrics.update(counters, now)
+            state.readmb += metrics.readmb
+            state.writemb += metrics.writemb
+            state.inflight += metrics.inflight
+            if metrics.utilization > state.utilization:
+                state.utilization = metrics.utilization
+
+    def run(self):
+        # Sample until stop() is called, fast while any device is busy.
+        while not self._stopped:
+            self.poller.wait(self.tick())
@@ -0,0 +1,237 @@
+"""
+Prometheus text exposition of the sampled counters and iostat style rates.
+
+node_exporter next to dsklite parses /proc/diskstats a second time on
+every scrape. PrometheusOutput is an engine.SamplingEngine output instead:
+it exports the counters the engine already read, and never reads /proc
+itself.
+
+  - Every 'interval' seconds the engine hands the output its states. The
+    sampling thread only copies the counters and the rates of each device
+    into a snapshot, and wakes the exporter thread.
+  - The exporter thread renders the snapshot into the response body once,
+    and writes it to the textfile collector file if one is configured
+    (to a temporary file that is renamed over it, so node_exporter never
+    reads half a file).
+  - Scrapes are served by an HTTP server with a thread per connection
+    that sends the last rendered body. Every scraper of the same snapshot
+    gets the same bytes, and a slow or frequent scraper only ever waits on
+    its own socket, never on the sampling loop.
+
+Metrics are named like node_exporter's node_disk_*, with a dsklite_disk_
+prefix and a 'device' label, so dashboards carry over.
+"""
+
+import http.server
+import os
+import socket
+import sys
+import threading
+import time
+
+from engine import Output
+from iometrics import SECTORSIZE, MB
+
+EXPORTINTERVAL = 1.0
+PORT = 9469
+CONTENTTYPE = 'text/plain; version=0.0.4; charset=utf-8'
+SCRAPETIMEOUT = 10.0  # Seconds a scraper may take to send its request and read the body
+PREFIX = 'dsklite_disk_'
+
+# (name, counter index, scale, type, help) of every diskstats counter, up to the 17 of kernel 5.5.
+COUNTERS = (
+    ('reads_completed_total', 0, 1, 'counter', 'Reads completed successfully.'),
+    ('reads_merged_total', 1, 1, 'counter', 'Reads merged.'),
+    ('read_bytes_total', 2, SECTORSIZE, 'counter', 'Bytes read.'),
+    ('read_time_seconds_total', 3, 0.001, 'counter', 'Time spent reading.'),
+    ('writes_completed_total', 4, 1, 'counter', 'Writes completed successfully.'),
+    ('writes_merged_total', 5, 1, 'counter', 'Writes merged.'),
+    ('written_bytes_total', 6, SECTORSIZE, 'counter', 'Bytes written.'),
+    ('write_time_seconds_total', 7, 0.001, 'counter', 'Time spent writing.'),
+    ('io_now', 8, 1, 'gauge', 'I/Os currently in progress.'),
+    ('io_time_seconds_total', 9, 0.001, 'counter', 'Time spent doing I/Os.'),
+    ('io_time_weighted_seconds_total', 10, 0.001, 'counter', 'Weighted time spent doing I/Os.'),
+    ('discards_completed_total', 11, 1, 'counter', 'Discards completed successfully.'),
+    ('discards_merged_total', 12, 1, 'counter', 'Discards merged.'),
+    ('discarded_sectors_total', 13, 1, 'counter', 'Sectors discarded.'),
+    ('discard_time_seconds_total', 14, 0.001, 'counter', 'Time spent discarding.'),
+    ('flush_requests_total', 15, 1, 'counter', 'Flush requests completed successfully.'),
+    ('flush_requests_time_seconds_total', 16, 0.001, 'counter', 'Time spent flushing.'),
+)
+# (name, IoMetrics attribute, scale, help) of the rates over the export interval.
+RATES = (
+    ('reads_per_second', 'reads', 1, 'Reads completed per second.'),
+    ('writes_per_second', 'writes', 1, 'Writes completed per second.'),
+    ('read_bytes_per_second', 'readmb', MB, 'Bytes read per second.'),
+    ('written_bytes_per_second', 'writemb', MB, 'Bytes written per second.'),
+    ('read_await_seconds', 'readawait', 0.001, 'Average time per read.'),
+    ('write_await_seconds', 'writeawait', 0.001, 'Average time per write.'),
+    ('queue_size', 'queuesize', 1, 'Average number of I/Os queued.'),
+    ('utilization_ratio', 'utilization', 0.01, 'Fraction of the time the device was doing I/O.'),
+)
+_RATEATTRIBUTES = tuple(attribute for name, attribute, scale, text in RATES)
+
+
+def render(snapshot, timestamp):
+    # Exposition text of 'snapshot', a list of (device, counters, rates) tuples.
+    lines = []
+    for name, index, scale, kind, text in COUNTERS:
+        samples = [(device, counters[index]) for device, counters, rates in snapshot if index < len(counters)]
+        if not samples:
+            continue
+        lines.append(f"# HELP {PREFIX}{name} {text}\n# TYPE {PREFIX}{name} {kind}\n")
+        # Integers stay exact: bytes are multiplied, milliseconds divided (repr of n / 1000 is exact).
+        if scale >= 1:
+            lines.extend(f'{PREFIX}{name}{{device="{device}"}} {value * scale}\n' for device, value in samples)
+        else:
+            divisor = round(1 / scale)
+            lines.extend(f'{PREFIX}{name}{{device="{device}"}} {value / divisor!r}\n' for device, value in samples)
+    for i, (name, attribute, scale, text) in enumerate(RATES):
+        lines.append(f"# HELP {PREFIX}{name} {text}\n# TYPE {PREFIX}{name} gauge\n")
+        lines.extend(f'{PREFIX}{name}{{device="{device}"}} {rates[i] * scale:.9g}\n'
+                     for device, counters, rates in snapshot)
+    lines.append(f"# HELP dsklite_snapshot_timestamp_seconds When the exported counters were sampled.\n"
+                 f"# TYPE dsklite_snapshot_timestamp_seconds gauge\n"
+                 f"dsklite_snapshot_timestamp_seconds {timestamp:.3f}\n")
+    return ''.join(lines).encode('utf-8')
+
+
+class HTTPServer6(http.server.ThreadingHTTPServer):
+    """ThreadingHTTPServer on an IPv6 address."""
+
+    address_family = socket.AF_INET6
+
+
+class PrometheusOutput(Output):
+    """Serves the engine's latest counters over HTTP and/or a textfile collector file."""
+
+    def __init__(self, address=None, textfile=None, interval=EXPORTINTERVAL):
+        # 'address' is a (host, port) pair to serve /metrics on, 'textfile' a *.prom path
+        # for node_exporter's textfile collector. Either may be None.
+        self.address = address
+        self.textfile = textfile
+        self.interval = interval
+        self.body = render([], 0.0)  # Replaced, never modified, so scrapers can send it unlocked
+        self.renders = 0
+        self.scrapes = 0
+        self._scrapelock = threading.Lock()  # Scrapes are counted from the handler threads
+        self._cond = threading.Condition()
+        self._snapshot = None  # Latest snapshot not rendered yet
+        self._stopped = False
+        self._thread = None
+        self._server = None
+        self._serverthread = None
+
+    def start(self):
+        # Runs after any fork(), like every output's start().
+        if self.address is not None:
+            try:
+                family, kind, proto, canonname, sockaddr = socket.getaddrinfo(
+                    self.address[0], self.address[1], type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+                server = HTTPServer6 if family == socket.AF_INET6 else http.server.ThreadingHTTPServer
+                self._server = server(sockaddr, self._handler())
+            except OSError as e:
+                # Recovery: Run without the HTTP endpoint, the textfile (if any) is still written.
+                sys.stderr.write(f"Error listening on {self.address[0]}:{self.address[1]}: {e}\n")
+            else:
+                self._server.daemon_threads = True
+                self._serverthread = threading.Thread(target=self._server.serve_forever,
+                                                      name='dsklite-http', daemon=True)
+                self._serverthread.start()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='dsklite-exporter', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def update(self, states, now):
+        # Sampling thread: copy what the engine has and hand it to the exporter thread.
+        detectors = self.engine.detectors
+        snapshot = []
+        seen = set()
+        for state in states.values():
+            for device in state.devices:
+                if device in seen:
+                    continue
+                seen.add(device)
+                detector = detectors.get(device)
+                metrics = state.metrics.get(device)
+                if detector is None or detector.counters is None or metrics is None:
+                    continue
+                snapshot.append((device, tuple(detector.counters),
+                                 tuple(getattr(metrics, attribute) for attribute in _RATEATTRIBUTES)))
+        with self._cond:
+            self._snapshot = (snapshot, time.time())
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._snapshot is None and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                snapshot, timestamp = self._snapshot
+                self._snapshot = None
+            self.body = render(sorted(snapshot), timestamp)
+            self.renders += 1
+            if self.textfile is not None:
+                self._writetextfile()
+
+    def _writetextfile(self):
+        temporary = f"{self.textfile}.{os.getpid()}.tmp"
+        try:
+            with open(temporary, 'wb') as f:
+                f.write(self.body)
+            os.replace(temporary, self.textfile)
+        except OSError as e:
+            # Recovery: Keep the previous file, the next snapshot retries.
+            sys.stderr.write(f"Error writing textfile '{self.textfile}': {e}\n")
+
+    def _handler(self):
+        exporter = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            timeout = SCRAPETIMEOUT
+
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = exporter.body
+                with exporter._scrapelock:
+                    exporter.scrapes += 1
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENTTYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return MetricsHandler
+
+
+def parseaddress(spec):
+    # '[HOST:]PORT' -> (host, port). Without a host only local scrapers can connect. IPv6
+    # hosts go in brackets, '[::1]:9469'; a bare IPv6 address, '::1', listens on PORT.
+    if spec.startswith('['):
+        host, sep, rest = spec[1:].partition(']')
+        if not sep or (rest and not rest.startswith(':')):
+            raise ValueError(f"bad address '{spec}'")
+        return (host, int(rest[1:]) if rest else PORT)
+    if spec.count(':') > 1:
+        return (spec, PORT)
+    host, _, port = spec.rpartition(':')
+    return (host or '127.0.0.1', int(port))
@@ -0,0 +1,199 @@
+"""
+Synthetic /proc/diskstats, /sys/block and LED class files.
+
+Everything that samples takes its paths as arguments (diskstats.STATSFILE,
+diskstats.SYSBLOCK and ledcontrol.LEDFILE are only defaults, and main.py
+and main_stray.py take --diskstats and --sysfs), so the samplers, the
+engine and the LED drivers can run against these files on a machine with
+no root and no real disks, such as a CI box.
+
+DiskStatsFixture writes a realistic table of 10 to 10,000 devices (loop,
+sd, nvme with partitions, dm) with the counter columns of a given kernel
+generation: 11 counters up to 4.18, 15 with the discard counters, 17 with
+the flush counters from 5.5 on. With a sysfs directory it also writes the
+matching <dev>/stat and <dev>/inflight files. bump() changes the counters
+of one device and rewrites the files in place, as the kernel does, so
+samplers that keep their fds open see the change. remove() and replace()
+change the device list the way an unplug, a loop detach or a device taking
+the line of another one do.
+
+FakeLed is an LED class directory with brightness, trigger, delay_on and
+delay_off files.
+
+Run this file to write a fixture tree:
+
+usage: python3 fixtures.py DIR [--devices N] [--counters 11|15|17]
+"""
+
+import argparse
+import os
+import random
+import shutil
+
+OLDCOUNTERS = 11  # Kernels up to 4.18
+DISCARDCOUNTERS = 15  # 4.18 added discards
+FLUSHCOUNTERS = 17  # 5.5 added flushes
+INFLIGHT = 8  # Index of "I/Os currently in progress" among the counters
+LEDTRIGGERS = 'none kbd-scrolllock [kbd-numlock] kbd-capslock disk-activity timer'
+
+
+def devicenames(n):
+    # n realistic block device names: a few loop devices, sd disks with
+    # partitions, nvme namespaces with partitions and device mapper targets.
+    names = []
+    for i in range(min(8, n)):
+        names.append(f"loop{i}")
+    disk = 0
+    while len(names) < n:
+        kind = disk % 3
+        if kind == 0:
+            base = _sdname(disk // 3)
+            parts = [base] + [f"{base}{p}" for p in range(1, 4)]
+        elif kind == 1:
+            base = f"nvme{disk // 3}n1"
+            parts = [base] + [f"{base}p{p}" for p in range(1, 4)]
+        else:
+            parts = [f"dm-{disk // 3}"]
+        names.extend(parts[:n - len(names)])
+        disk += 1
+    return names
+
+
+def _sdname(index):
+    # sda ... sdz, sdaa ... like the kernel names SCSI disks.
+    letters = ''
+    index += 1
+    while index:
+        index, letter = divmod(index - 1, 26)
+        letters = chr(ord('a') + letter) + letters
+    return 'sd' + letters
+
+
+class DiskStatsFixture(object):
+    """A synthetic /proc/diskstats and, optionally, /sys/block tree."""
+
+    def __init__(self, path, ndevices, counters=FLUSHCOUNTERS, sysfs=None, seed=0):
+        self.path = path
+        self.sysfs = sysfs
+        self.counters = counters
+        self.names = devicenames(ndevices)
+        rnd = random.Random(seed)
+        self.values = {}
+        for name in self.names:
+            if name.startswith('loop'):
+                values = [0] * counters
+            else:
+                values = [rnd.randrange(10 ** rnd.randrange(1, 9)) for _ in range(counters)]
+                values[INFLIGHT] = 0
+            self.values[name] = values
+        self.write()
+
+    def _line(self, index, name):
+        major = 7 if name.startswith('loop') else 259 if name.startswith('nvme') else 253 \
+            if name.startswith('dm-') else 8
+        return f"{major:4d} {index:7d} {name} " + ' '.join(map(str, self.values[name])) + '\n'
+
+    def _writetable(self):
+        data = ''.join(self._line(i, name) for i, name in enumerate(self.names)).encode('ascii')
+        rewrite(self.path, data)
+
+    def write(self):
+        # Rewrite every file in place, keeping the inodes readers hold open.
+        self._writetable()
+        if self.sysfs is not None:
+            for name in self.names:
+                self._writesysfs(name)
+
+    def _writesysfs(self, name):
+        directory = os.path.join(self.sysfs, name)
+        os.makedirs(directory, exist_ok=True)
+        values = self.values[name]
+        # sysfs prints every counter right aligned in 8 columns.
+        stat = ' '.join(f"{value:8d}" for value in values) + '\n'
+        rewrite(os.path.join(directory, 'stat'), stat.encode('ascii'))
+        rewrite(os.path.join(directory, 'inflight'), f"{0:8d} {values[INFLIGHT]:8d}\n".encode('ascii'))
+
+    def bump(self, name, reads=1, writes=0, inflight=None):
+        # Complete 'reads' reads and 'writes' writes on device 'name' (8
+        # sectors and 1 ms each), optionally set its in-flight count, and
+        # rewrite the files.
+        values = self.values[name]
+        values[0] += reads
+        values[2] += 8 * reads
+        values[3] += reads
+        values[4] += writes
+        values[6] += 8 * writes
+        values[7] += writes
+        values[9] += reads + writes
+        values[10] += reads + writes
+        if inflight is not None:
+            values[INFLIGHT] = inflight
+        self._writetable()
+        if self.sysfs is not None:
+            self._writesysfs(name)
+
+    def remove(self, name):
+        # Unplug device 'name': its line goes away and the lines after it move up.
+        self.names.remove(name)
+        del self.values[name]
+        self._writetable()
+        if self.sysfs is not None:
+            shutil.rmtree(os.path.join(self.sysfs, name), ignore_errors=True)
+
+    def replace(self, name, new):
+        # Device 'new', with all counters at 0, takes the line of 'name', so the
+        # number of lines stays the same.
+        self.names[self.names.index(name)] = new
+        del self.values[name]
+        self.values[new] = [0] * self.counters
+        self._writetable()
+        if self.sysfs is not None:
+            shutil.rmtree(os.path.join(self.sysfs, name), ignore_errors=True)
+            self._writesysfs(new)
+
+
+class FakeLed(object):
+    """An LED class directory, like /sys/class/leds/input3::numlock."""
+
+    def __init__(self, directory, name='input3::numlock'):
+        self.directory = os.path.join(directory, name)
+        os.makedirs(self.directory, exist_ok=True)
+        self.brightness = os.path.join(self.directory, 'brightness')
+        for attribute, value in (('brightness', '0'), ('trigger', LEDTRIGGERS),
+                                 ('delay_on', '500'), ('delay_off', '500')):
+            with open(os.path.join(self.directory, attribute), 'w') as f:
+                f.write(value + '\n')
+
+    def read(self, attribute='brightness'):
+        with open(os.path.join(self.directory, attribute), 'r') as f:
+            return f.read().strip()
+
+
+def rewrite(path, data):
+    # Replace the contents of 'path' without replacing the file.
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.pwrite(fd, data, 0)
+        os.ftruncate(fd, len(data))
+    finally:
+        os.close(fd)
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Write synthetic diskstats, sysfs and LED fixtures.')
+    parser.add_argument('directory')
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--counters', type=int, choices=(OLDCOUNTERS, DISCARDCOUNTERS, FLUSHCOUNTERS),
+                        default=FLUSHCOUNTERS)
+    args = parser.parse_args()
+    os.makedirs(args.directory, exist_ok=True)
+    fixture = DiskStatsFixture(os.path.join(args.directory, 'diskstats'), args.devices, args.counters,
+                               sysfs=os.path.join(args.directory, 'block'))
+    led = FakeLed(os.path.join(args.directory, 'leds'))
+    print(f"{len(fixture.names)} devices in {fixture.path} and {fixture.sysfs}, LED {led.brightness}")
+    print(f"e.g. python3 main.py --diskstats {fixture.path} --sysfs {fixture.sysfs} "
+          f"--device '{fixture.names[-1]}={led.brightness}'")
+
+
+if __name__ == '__main__':
+    run()
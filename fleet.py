@@ -0,0 +1,232 @@
+"""
+Compact UDP stream of sampled activity, for watching a whole rack.
+
+FleetOutput is an engine.SamplingEngine output that packs, every tick,
+one ENTRY per device that did anything (per-tick %util, I/Os in flight,
+sectors read and written) and sends the entries of several ticks in one
+datagram, at most 'rate' datagrams a second. An idle host sends nothing.
+fleetcollector.py receives the datagrams of many agents and keeps a
+rolling heat map of the busy hosts and devices.
+
+A datagram is self-contained, so the collector keeps no per-agent protocol
+state and a lost datagram only loses its own ticks:
+
+  HEADER    magic, version, number of device names, number of entries,
+            sequence number (to count losses), wall clock time of the
+            first tick
+  host      1 byte length and the host name
+  devices   1 byte length and the name of every device the entries use
+  entries   ENTRY, 14 bytes each: ms since the first tick, device index,
+            %util, I/Os in flight, sectors read and sectors written
+
+Datagrams stay below MAXDATAGRAM so they are not fragmented on Ethernet.
+Entries that do not fit before the next send is due are dropped and
+counted in 'dropped'.
+"""
+
+import socket
+import struct
+import sys
+import time
+
+from diskstats import FIRSTCOUNTER, SECTORSREAD, SECTORSWRITTEN
+from engine import Output
+
+MAGIC = b'DSKF'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHId')
+ENTRY = struct.Struct('<HBBHII')
+MAXDATAGRAM = 1472  # Ethernet MTU minus the IP and UDP headers
+RATE = 4.0  # Datagrams per second and agent at most
+PORT = 9470
+MAXDEVICES = 255
+
+_SECTORSREAD = SECTORSREAD - FIRSTCOUNTER
+_SECTORSWRITTEN = SECTORSWRITTEN - FIRSTCOUNTER
+
+
+class FleetPacker(object):
+    """Builds one datagram of entries from several ticks."""
+
+    def __init__(self, host):
+        self.host = host.encode('utf-8')[:255]
+        self.sequence = 0
+        self._buf = bytearray(MAXDATAGRAM)
+        self._names = []
+        self._index = {}
+        self._entries = bytearray()
+        self._count = 0
+        self._namebytes = 0
+        self.started = None  # Wall clock time of the first entry
+        self._origin = 0.0  # The same on the monotonic clock
+
+    def __len__(self):
+        return self._count
+
+    def size(self, device=None):
+        # Bytes of the datagram so far, with one more entry (and its device name if new).
+        extra = 0
+        if device is not None:
+            extra = ENTRY.size
+            if device not in self._index:
+                extra += 1 + len(device.encode('utf-8'))
+        return HEADER.size + 1 + len(self.host) + self._namebytes + len(self._entries) + extra
+
+    def add(self, device, now, utilization, inflight, sectorsread, sectorswritten):
+        # Returns False if the entry does not fit in the datagram.
+        if self.size(device) > MAXDATAGRAM:
+            return False
+        index = self._index.get(device)
+        if index is None:
+            if len(self._names) >= MAXDEVICES:
+                return False
+            index = self._index[device] = len(self._names)
+            name = device.encode('utf-8')[:255]
+            self._names.append(name)
+            self._namebytes += 1 + len(name)
+        if not self._count:
+            self.started = time.time()
+            self._origin = now
+        offset = min(0xFFFF, int((now - self._origin) * 1000.0))
+        self._entries += ENTRY.pack(offset, index, min(255, int(utilization + 0.5)), min(0xFFFF, inflight),
+                                    sectorsread & 0xFFFFFFFF, sectorswritten & 0xFFFFFFFF)
+        self._count += 1
+        return True
+
+    def pack(self):
+        # The datagram, then starts a new one.
+        buf = self._buf
+        HEADER.pack_into(buf, 0, MAGIC, VERSION, len(self._names), self._count, self.sequence,
+                         self.started or 0.0)
+        pos = HEADER.size
+        for name in [self.host] + self._names:
+            buf[pos] = len(name)
+            buf[pos + 1:pos + 1 + len(name)] = name
+            pos += 1 + len(name)
+        buf[pos:pos + len(self._entries)] = self._entries
+        pos += len(self._entries)
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        self._names = []
+        self._index.clear()
+        del self._entries[:]
+        self._count = 0
+        self._namebytes = 0
+        return memoryview(buf)[:pos]
+
+
+def unpack_names(data):
+    # (header fields, host, device names, offset of the first entry) of a datagram.
+    # Raises ValueError if it is not a datagram of this version.
+    if len(data) < HEADER.size:
+        raise ValueError('short datagram')
+    magic, version, ndevices, nentries, sequence, started = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a dsklite fleet datagram')
+    pos = HEADER.size
+    names = []
+    for _ in range(ndevices + 1):
+        length = data[pos]
+        names.append(bytes(data[pos + 1:pos + 1 + length]).decode('utf-8', 'replace'))
+        pos += 1 + length
+    if pos + nentries * ENTRY.size > len(data):
+        raise ValueError('truncated datagram')
+    if nentries and not ndevices:
+        raise ValueError('entries without device names')
+    return (nentries, sequence, started), names[0], names[1:], pos
+
+
+class FleetOutput(Output):
+    """Sends the per-tick activity of its devices to a collector over UDP."""
+
+    def __init__(self, address, host=None, rate=RATE):
+        self.address = address
+        self.host = host or socket.gethostname()
+        self.period = 1.0 / rate if rate > 0 else 0.0
+        self.packer = FleetPacker(self.host)
+        self.sent = 0
+        self.dropped = 0
+        self._sock = None
+        self._sockaddr = None  # 'address' resolved by start(), so sendto() never resolves
+        self._due = 0.0
+        self._previous = {}  # (sectors read, sectors written) of every device at its last tick
+
+    def start(self):
+        # Resolve once: sendto() with a host name would run the resolver on every datagram,
+        # on the sampling thread. The family comes with the address, also for IPv6-only names.
+        try:
+            family, kind, proto, canonname, self._sockaddr = socket.getaddrinfo(
+                self.address[0], self.address[1], type=socket.SOCK_DGRAM)[0]
+            self._sock = socket.socket(family, kind, proto)
+            self._sock.setblocking(False)
+        except OSError as e:
+            # Recovery: Run without the stream, the other outputs are not affected.
+            sys.stderr.write(f"Error creating the fleet socket for {self.address[0]}: {e}\n")
+            self._sock = None
+
+    def close(self):
+        if self._sock is not None:
+            if len(self.packer):
+                self._send()
+            self._sock.close()
+            self._sock = None
+
+    def update(self, states, now):
+        if self._sock is None:
+            return
+        detectors = self.engine.detectors
+        packer = self.packer
+        previous = self._previous
+        seen = set()
+        for state in states.values():
+            for device in state.devices:
+                if device in seen:
+                    continue
+                seen.add(device)
+                detector = detectors.get(device)
+                counters = detector.counters if detector is not None else None
+                if counters is None:
+                    continue
+                sectors = counters[_SECTORSREAD], counters[_SECTORSWRITTEN]
+                last = previous.get(device)
+                previous[device] = sectors
+                if last is None or (last == sectors and not detector.inflight):
+                    # Idle ticks are not sent.
+                    continue
+                metrics = state.metrics.get(device)
+                # A counter that went backwards (wrapped, or the device was removed and
+                # added again) counts as nothing moved rather than as ~2 TB.
+                read = max(0, sectors[0] - last[0])
+                written = max(0, sectors[1] - last[1])
+                if not packer.add(device, now, metrics.utilization if metrics is not None else 0.0,
+                                  detector.inflight, read, written):
+                    self.dropped += 1
+        if len(packer) and now >= self._due:
+            self._send()
+            self._due = now + self.period
+
+    def _send(self):
+        try:
+            self._sock.sendto(self.packer.pack(), self._sockaddr)
+            self.sent += 1
+        except OSError as e:
+            # A full socket buffer or an unreachable collector. Recovery: Drop this
+            # datagram, the next one is self-contained.
+            self.dropped += 1
+            if not isinstance(e, BlockingIOError):
+                sys.stderr.write(f"Error sending to fleet collector {self.address[0]}:{self.address[1]}: {e}\n")
+
+
+def parseaddress(spec, port=PORT):
+    # 'HOST[:PORT]' -> (host, port). IPv6 addresses go in brackets when a port follows,
+    # '[fd00::1]:9470'; a bare one, 'fd00::1', uses 'port'.
+    if spec.startswith('['):
+        host, sep, rest = spec[1:].partition(']')
+        if not sep or (rest and not (rest.startswith(':') and rest[1:].isdigit())):
+            raise ValueError(f"bad address '{spec}'")
+        return (host, int(rest[1:]) if rest else port)
+    if spec.count(':') > 1:
+        return (spec, port)
+    host, sep, portspec = spec.rpartition(':')
+    if not sep or not portspec.isdigit():
+        return (spec, port)
+    return (host, int(portspec))
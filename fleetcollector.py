@@ -0,0 +1,238 @@
+"""
+Collector of fleet.FleetOutput datagrams: a rolling heat map of a rack.
+
+Every agent (main.py --fleet HOST[:PORT]) sends datagrams of per-tick
+entries. The collector drains its socket in batches of up to BATCH
+datagrams, decodes the entries of each datagram with one
+numpy.frombuffer() over the received bytes (the only per-datagram Python
+work is the header and the device names), and adds the whole batch to the
+heat map with two numpy ufunc.at() calls.
+
+The heat map has a row per host and device and a column per 'step'
+seconds, COLUMNS wide, kept as a ring: peak %util and bytes moved per
+column. Columns are placed by the time the datagram arrived minus the age
+of each entry within it, so agent clocks do not need to be in sync. The
+busiest rows of the window are printed every 'step' seconds.
+
+Run it and point agents at it, or try it on one machine with
+bench_fleet.py, which simulates thousands of agents sending to localhost:
+
+usage: python3 fleetcollector.py [--listen [HOST:]PORT] [--columns N] [--rows N]
+"""
+
+import argparse
+import select
+import socket
+import sys
+import time
+
+import numpy
+
+from fleet import ENTRY, PORT, unpack_names, parseaddress
+
+BATCH = 256  # Datagrams decoded and added to the heat map at once
+COLUMNS = 60
+STEP = 1.0
+ROWS = 20  # Rows printed
+SHADES = ' .:-=+*#%@'
+SECTORSIZE = 512
+MAXGAP = 1000  # Sequence gaps counted as lost datagrams
+
+ENTRYDTYPE = numpy.dtype([('offset', '<u2'), ('device', 'u1'), ('utilization', 'u1'), ('inflight', '<u2'),
+                          ('read', '<u4'), ('written', '<u4')])
+assert ENTRYDTYPE.itemsize == ENTRY.size
+
+
+class HeatMap(object):
+    """Peak %util and bytes per (host, device) row and time column, over a rolling window."""
+
+    def __init__(self, columns=COLUMNS, step=STEP, clock=time.monotonic):
+        self.columns = columns
+        self.step = step
+        self.clock = clock
+        self.rows = {}  # Row of every (host, device)
+        self.names = []
+        self.utilization = numpy.zeros((16, columns), numpy.uint8)
+        self.bytes = numpy.zeros((16, columns), numpy.float64)
+        self.current = int(clock() // step)  # Absolute number of the newest column
+
+    def row(self, host, device):
+        key = (host, device)
+        row = self.rows.get(key)
+        if row is None:
+            row = self.rows[key] = len(self.names)
+            self.names.append(key)
+            if row >= len(self.utilization):
+                # Double the rows, keeping the ring positions.
+                self.utilization = numpy.vstack((self.utilization, numpy.zeros_like(self.utilization)))
+                self.bytes = numpy.vstack((self.bytes, numpy.zeros_like(self.bytes)))
+        return row
+
+    def advance(self, now):
+        # Clear the columns that scrolled into the window since the last call.
+        column = int(now // self.step)
+        if column <= self.current:
+            return
+        expired = min(column - self.current, self.columns)
+        cleared = (numpy.arange(self.current + 1, self.current + 1 + expired)) % self.columns
+        self.utilization[:, cleared] = 0
+        self.bytes[:, cleared] = 0
+        self.current = column
+
+    def add(self, rows, times, utilization, sectors):
+        # Entry arrays: row, clock() time, %util and sectors moved of every entry.
+        columns = (times // self.step).astype(numpy.int64)
+        keep = (columns > self.current - self.columns) & (columns <= self.current)
+        if not keep.all():
+            rows, columns, utilization, sectors = rows[keep], columns[keep], utilization[keep], sectors[keep]
+        columns %= self.columns
+        numpy.maximum.at(self.utilization, (rows, columns), utilization)
+        numpy.add.at(self.bytes, (rows, columns), sectors * float(SECTORSIZE))
+
+    def ordered(self):
+        # Columns oldest first.
+        start = (self.current + 1) % self.columns
+        order = numpy.r_[start:self.columns, 0:start]
+        return self.utilization[:len(self.names), order], self.bytes[:len(self.names), order]
+
+    def render(self, rows=ROWS):
+        utilization, moved = self.ordered()
+        if not len(self.names):
+            return 'no activity\n'
+        busy = utilization.astype(numpy.int64).sum(axis=1)
+        top = numpy.argsort(-busy, kind='stable')[:rows]
+        scale = (len(SHADES) - 1) / 100.0
+        lines = [f"{'host':20s} {'device':12s} {'MB/s':>8s}  last {self.columns * self.step:g} s, %util peak"]
+        for row in top:
+            if not busy[row]:
+                break
+            host, device = self.names[row]
+            shades = ''.join(SHADES[min(len(SHADES) - 1, int(value * scale + 0.999))] for value in utilization[row])
+            mbps = moved[row].sum() / (self.columns * self.step) / 2 ** 20
+            lines.append(f"{host[:20]:20s} {device[:12]:12s} {mbps:8.2f}  |{shades}|")
+        return '\n'.join(lines) + '\n'
+
+
+class Collector(object):
+    """Receives fleet datagrams into a HeatMap."""
+
+    def __init__(self, address=('0.0.0.0', PORT), heatmap=None, clock=time.monotonic):
+        self.clock = clock
+        self.heatmap = heatmap or HeatMap(clock=clock)
+        family, kind, proto, canonname, sockaddr = socket.getaddrinfo(
+            address[0], address[1], type=socket.SOCK_DGRAM, flags=socket.AI_PASSIVE)[0]
+        self.sock = socket.socket(family, kind, proto)
+        # A large receive buffer rides out bursts while the heat map is being printed.
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        self.sock.bind(sockaddr)
+        self.sock.setblocking(False)
+        self.datagrams = 0
+        self.entries = 0
+        self.invalid = 0
+        self.lost = 0
+        self._sequences = {}  # Last sequence number of every host
+
+    def close(self):
+        self.sock.close()
+
+    def receive(self, timeout):
+        # Wait up to 'timeout' for datagrams and add everything that arrived. Returns the
+        # number of datagrams.
+        if not select.select([self.sock], [], [], timeout)[0]:
+            return 0
+        received = 0
+        while True:
+            batch = self._drain()
+            if not batch:
+                return received
+            received += len(batch)
+            self._add(batch)
+
+    def _drain(self):
+        batch = []
+        recv = self.sock.recv
+        while len(batch) < BATCH:
+            try:
+                batch.append((recv(65536), self.clock()))
+            except BlockingIOError:
+                break
+        return batch
+
+    def _add(self, batch):
+        heatmap = self.heatmap
+        rows, times, utilization, sectors = [], [], [], []
+        for data, arrived in batch:
+            try:
+                (nentries, sequence, started), host, devices, pos = unpack_names(data)
+            except (ValueError, IndexError):
+                self.invalid += 1
+                continue
+            last = self._sequences.get(host)
+            if last is not None:
+                gap = (sequence - last - 1) & 0xFFFFFFFF
+                if gap < MAXGAP:
+                    # Larger gaps are a restarted agent or a datagram that arrived late.
+                    self.lost += gap
+            self._sequences[host] = sequence
+            if not nentries:
+                continue
+            entries = numpy.frombuffer(data, ENTRYDTYPE, nentries, pos)
+            if int(entries['device'].max()) >= len(devices):
+                # An entry names a device the datagram does not list.
+                self.invalid += 1
+                continue
+            rowmap = numpy.fromiter((heatmap.row(host, device) for device in devices), numpy.int64, len(devices))
+            offsets = entries['offset']
+            rows.append(rowmap[entries['device']])
+            # The newest entry was taken about when the datagram was sent.
+            times.append(arrived - (int(offsets[-1]) - offsets.astype(numpy.float64)) * 0.001)
+            utilization.append(entries['utilization'])
+            sectors.append(entries['read'].astype(numpy.float64) + entries['written'])
+            self.datagrams += 1
+            self.entries += nentries
+        heatmap.advance(self.clock())
+        if rows:
+            heatmap.add(numpy.concatenate(rows), numpy.concatenate(times), numpy.concatenate(utilization),
+                        numpy.concatenate(sectors))
+
+    def run(self, rows=ROWS, duration=None, stream=None):
+        # Receive and print the heat map every 'step' seconds, for 'duration' seconds or forever.
+        stream = stream or sys.stdout
+        clear = '\x1b[H\x1b[2J' if stream.isatty() else ''
+        start = self.clock()
+        due = start + self.heatmap.step
+        while duration is None or self.clock() - start < duration:
+            self.receive(max(0.0, due - self.clock()))
+            now = self.clock()
+            if now >= due:
+                due = now + self.heatmap.step
+                self.heatmap.advance(now)
+                stream.write(f"{clear}{self.datagrams} datagrams, {self.entries} entries, {self.lost} lost, "
+                             f"{self.invalid} invalid, {len(self._sequences)} hosts\n" + self.heatmap.render(rows))
+                stream.flush()
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Heat map of the disk activity sent by dsklite agents.')
+    parser.add_argument('--listen', default=f"0.0.0.0:{PORT}", metavar='[HOST:]PORT',
+                        help=f"address to receive on (default: 0.0.0.0:{PORT})")
+    parser.add_argument('--columns', type=int, default=COLUMNS, help=f"seconds of history (default: {COLUMNS})")
+    parser.add_argument('--rows', type=int, default=ROWS, help=f"busiest rows printed (default: {ROWS})")
+    parser.add_argument('--duration', type=float, metavar='SECONDS', help='stop after SECONDS')
+    args = parser.parse_args()
+    host, port = ('', int(args.listen)) if args.listen.isdigit() else parseaddress(args.listen)
+    try:
+        collector = Collector((host or '0.0.0.0', port), HeatMap(args.columns))
+    except OSError as e:
+        sys.stderr.write(f"Error listening on {args.listen}: {e}\n")
+        sys.exit(1)
+    try:
+        collector.run(args.rows, args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.close()
+
+
+if __name__ == '__main__':
+    run()
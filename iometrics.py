@@ -0,0 +1,86 @@
+"""
+iostat style metrics derived from two consecutive counter snapshots.
+
+For an interval of dt seconds between two samples of a device:
+
+    r/s, w/s        reads and writes completed per second
+    rMB/s, wMB/s    sectors read and written, 512 bytes each, in MB (2**20) per second
+    r_await         average time per read, in ms: time spent reading / reads completed
+    w_await         the same for writes
+    aqu-sz          average queue size: weighted time doing I/O / elapsed time
+    %util           time doing I/O / elapsed time, in percent
+
+The fields used are the diskstats counters 4 to 14 described in main.py;
+the main loop's in-flight check uses field 12 and these metrics add 13
+(time doing I/O) and 14 (weighted time doing I/O). Everything is plain
+arithmetic on counters that are already parsed for activity detection,
+so updating the metrics costs a few microseconds per device and tick.
+"""
+
+from diskstats import (FIRSTCOUNTER, READS, WRITES, SECTORSREAD, SECTORSWRITTEN, READTIME,
+                       WRITETIME, IOINPROGRESS, IOTIME, WEIGHTEDTIME)
+
+SECTORSIZE = 512
+MB = 1024 * 1024
+HEADER = f"{'Device':16s} {'r/s':>9s} {'w/s':>9s} {'rMB/s':>9s} {'wMB/s':>9s} " \
+         f"{'r_await':>8s} {'w_await':>8s} {'aqu-sz':>7s} {'%util':>6s}"
+
+_READS = READS - FIRSTCOUNTER
+_WRITES = WRITES - FIRSTCOUNTER
+_SECTORSREAD = SECTORSREAD - FIRSTCOUNTER
+_SECTORSWRITTEN = SECTORSWRITTEN - FIRSTCOUNTER
+_READTIME = READTIME - FIRSTCOUNTER
+_WRITETIME = WRITETIME - FIRSTCOUNTER
+_INFLIGHT = IOINPROGRESS - FIRSTCOUNTER
+_IOTIME = IOTIME - FIRSTCOUNTER
+_WEIGHTEDTIME = WEIGHTEDTIME - FIRSTCOUNTER
+
+
+class IoMetrics(object):
+    """Metrics of one device over the interval between its last two updates."""
+
+    __slots__ = ('device', 'interval', 'reads', 'writes', 'readmb', 'writemb', 'readawait',
+                 'writeawait', 'queuesize', 'utilization', 'inflight', '_previous', '_time')
+
+    def __init__(self, device):
+        self.device = device
+        self._previous = []
+        self._time = None
+        self.interval = 0.0
+        self.reads = self.writes = 0.0
+        self.readmb = self.writemb = 0.0
+        self.readawait = self.writeawait = 0.0
+        self.queuesize = self.utilization = 0.0
+        self.inflight = 0
+
+    def update(self, counters, now):
+        # Fold in a new counter snapshot taken at 'now' (seconds, monotonic).
+        # Returns False for the first snapshot, which only sets the baseline,
+        # and for malformed input; the metrics are then left unchanged.
+        previous = self._previous
+        if counters is None or len(counters) <= _WEIGHTEDTIME:
+            return False
+        ready = self._time is not None and now > self._time and len(previous) == len(counters)
+        if ready:
+            dt = now - self._time
+            reads = counters[_READS] - previous[_READS]
+            writes = counters[_WRITES] - previous[_WRITES]
+            self.interval = dt
+            self.reads = reads / dt
+            self.writes = writes / dt
+            self.readmb = (counters[_SECTORSREAD] - previous[_SECTORSREAD]) * SECTORSIZE / MB / dt
+            self.writemb = (counters[_SECTORSWRITTEN] - previous[_SECTORSWRITTEN]) * SECTORSIZE / MB / dt
+            self.readawait = (counters[_READTIME] - previous[_READTIME]) / reads if reads > 0 else 0.0
+            self.writeawait = (counters[_WRITETIME] - previous[_WRITETIME]) / writes if writes > 0 else 0.0
+            self.queuesize = (counters[_WEIGHTEDTIME] - previous[_WEIGHTEDTIME]) / (dt * 1000.0)
+            self.utilization = min(100.0, (counters[_IOTIME] - previous[_IOTIME]) / (dt * 10.0))
+            self.inflight = counters[_INFLIGHT]
+        # Keep a private copy, callers usually reuse their counters list.
+        previous[:] = counters
+        self._time = now
+        return ready
+
+    def format(self):
+        return (f"{self.device:16s} {self.reads:9.2f} {self.writes:9.2f} {self.readmb:9.2f} "
+                f"{self.writemb:9.2f} {self.readawait:8.2f} {self.writeawait:8.2f} "
+                f"{self.queuesize:7.2f} {self.utilization:6.1f}")
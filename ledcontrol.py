@@ -0,0 +1,173 @@
+"""
+Keyboard LED output through the sysfs LED class.
+
+LedDriver keeps the LED's brightness file open for the life of the process
+and remembers the last value it wrote, so sysfs is only touched on a real
+on/off transition. Repeated requests for the state the LED is already in
+are counted in 'skipped' instead of costing an open/write/close triple.
+
+The driver assumes it is the only writer. Call invalidate() when something
+else may have changed the brightness (for example the num lock key) to make
+the next set() write unconditionally.
+
+LedTrigger hands the blinking to the kernel instead. It reads the triggers
+the LED offers from /sys/class/leds/<device>/trigger and can select one,
+e.g. 'disk-activity', after which no userspace process needs to wake up at
+all, or 'timer', whose delay_on/delay_off attributes are then only written
+when the requested blink rate actually changes.
+"""
+
+import glob
+import os
+import sys
+
+LEDFILE = '/sys/devices/platform/i8042/serio0/input/input3/input3::numlock/brightness'
+LEDCLASS = '/sys/class/leds'
+LOCKLEDS = ('numlock', 'capslock', 'scrolllock')
+LEDON = '1'
+LEDOFF = '0'
+DISKTRIGGER = 'disk-activity'
+TIMERTRIGGER = 'timer'
+
+
+class LedDriver(object):
+    """Deduplicating writer for /sys/class/leds/<device>/brightness."""
+
+    def __init__(self, path=LEDFILE, on=LEDON, off=LEDOFF):
+        self.path = path
+        self._values = (off.encode('ascii'), on.encode('ascii'))
+        self._fd = None
+        self._state = None  # Last state written, None when unknown
+        self.writes = 0
+        self.skipped = 0
+
+    @property
+    def state(self):
+        return self._state
+
+    def _open(self):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_WRONLY)
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+
+    def invalidate(self):
+        self._state = None
+
+    def set(self, on):
+        # Returns True if the LED is known to be in the requested state.
+        on = bool(on)
+        if self._state is on:
+            self.skipped += 1
+            return True
+        try:
+            # sysfs attributes are always stored from offset 0.
+            os.pwrite(self._open(), self._values[on], 0)
+        except (IOError, OSError) as e:
+            # Log error if LEDFILE cannot be written.
+            # Recovery: Forget the fd and the state so the next call reopens the file and retries.
+            # This assumes the issue might be transient (e.g., permissions temporarily changed).
+            sys.stderr.write(f"Error writing to LEDFILE '{self.path}': {e}\n")
+            self.close()
+            self._state = None
+            return False
+        self._state = on
+        self.writes += 1
+        return True
+
+    def on(self):
+        return self.set(True)
+
+    def off(self):
+        return self.set(False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class LedTrigger(object):
+    """Kernel side blinking through /sys/class/leds/<device>/trigger."""
+
+    def __init__(self, leddir):
+        self.leddir = leddir
+        self.triggerpath = os.path.join(leddir, 'trigger')
+        self._delays = None  # Last (delay_on, delay_off) written
+        self.writes = 0
+        self.skipped = 0
+
+    @classmethod
+    def for_brightness(cls, path=LEDFILE):
+        return cls(os.path.dirname(path))
+
+    def _read(self):
+        # The trigger file lists every trigger, the active one in brackets:
+        # "none kbd-scrolllock [kbd-numlock] disk-activity timer"
+        try:
+            with open(self.triggerpath, 'r') as f:
+                return f.read().split()
+        except (IOError, OSError) as e:
+            # Log error if the trigger file cannot be read, e.g. the kernel has no LED triggers.
+            # Recovery: Report no triggers, callers fall back to userspace blinking.
+            sys.stderr.write(f"Error reading LED triggers '{self.triggerpath}': {e}\n")
+            return []
+
+    def available(self):
+        return [name.strip('[]') for name in self._read()]
+
+    def current(self):
+        for name in self._read():
+            if name.startswith('['):
+                return name.strip('[]')
+        return None
+
+    def _write(self, name, value):
+        path = os.path.join(self.leddir, name)
+        try:
+            with open(path, 'w') as f:
+                f.write(value)
+        except (IOError, OSError) as e:
+            # Log error if a trigger attribute cannot be written.
+            # Recovery: Return False so the caller can fall back to userspace blinking.
+            sys.stderr.write(f"Error writing '{value}' to '{path}': {e}\n")
+            return False
+        self.writes += 1
+        return True
+
+    def select(self, trigger):
+        # Selecting a trigger recreates its attributes, so forget the delays.
+        self._delays = None
+        return self._write('trigger', trigger)
+
+    def set_delays(self, delay_on, delay_off):
+        # Blink period of the timer trigger in milliseconds. A delay_on of 0
+        # keeps the LED off without leaving the trigger. Only written when changed.
+        delays = (int(delay_on), int(delay_off))
+        if delays == self._delays:
+            self.skipped += 1
+            return True
+        # Write delay_on first so that going idle switches the LED off at once.
+        if not (self._write('delay_on', str(delays[0])) and self._write('delay_off', str(delays[1]))):
+            self._delays = None
+            return False
+        self._delays = delays
+        return True
+
+
+def find_led(name, ledclass=LEDCLASS):
+    # Brightness file of a keyboard lock LED such as 'capslock', found as
+    # /sys/class/leds/<input>::<name>. A path is returned unchanged.
+    if os.sep in name:
+        return name
+    matches = sorted(glob.glob(os.path.join(ledclass, '*::' + name, 'brightness')))
+    return matches[0] if matches else None
@@ -75,93 +75,256 @@ write to /sys/devices/platform/i8042/serio0/input/input3/input3::numlock/brightn
 NOTE: MUST be root
 """
 
-import threading
+import argparse
+import asyncio
+import signal
 import time
 import os
 import sys
+from diskstats import open_sampler, IOTIME, SYSBLOCK
+from engine import SamplingEngine, BlinkOutput, StatsOutput
+from aioengine import AsyncEngine, ExecutorOutput, LoopBlinker
+from psievents import PsiEventSource
+from scheduler import BlinkScheduler
+from selfstats import StatsSocket
+from recorder import Recorder, MAXBYTES
+from exporter import PrometheusOutput, parseaddress, EXPORTINTERVAL, PORT
+import fleet
+from dashboard import DashboardOutput, FPS, FULLSCALE
+from ledcontrol import LedDriver, LedTrigger, find_led, LOCKLEDS, DISKTRIGGER, TIMERTRIGGER
 
 STATSFILE = '/proc/diskstats'
+SYSFS = SYSBLOCK
 LEDFILE = '/sys/devices/platform/i8042/serio0/input/input3/input3::numlock/brightness'
 BLINKRATE = 0.065
-DEVICENAME = 2
-IOINPROGRESS = 11
 LEDON = '1'
 LEDOFF = '0'
 DEVICE = "sda"
+IDLEINTERVAL = 1.0  # Longest sleep between samples once the disk has been idle for a while
+PSIIDLEINTERVAL = 10.0  # The same when a PSI trigger on /proc/pressure/io can cut idle sleeps short
+TRIGGERPOLL = 0.5  # Seconds between utilization samples when the kernel timer trigger blinks
+# Timer trigger blink pattern (delay_on, delay_off in ms) by minimum utilization, busiest first.
+TRIGGERLEVELS = ((0.5, 65, 65), (0.1, 65, 200), (0.0, 65, 800))
 
-timer = None  # Initialize timer to None
+led = LedDriver(LEDFILE, LEDON, LEDOFF)  # Keeps LEDFILE open and skips redundant writes
+drivers = {LEDFILE: led}  # Every LED driver by brightness file, for the sysfs write counts
 
 def resetled():
+    # Turn the LED off. Write errors are logged by the driver and retried on the
+    # next transition, as the issue might be transient (e.g., permissions temporarily changed).
+    led.off()
+
+def turnonled():
+    # Turn the LED on. Does not touch sysfs if the LED is already on.
+    led.on()
+
+blinker = BlinkScheduler(BLINKRATE, turnonled, resetled)
+# One blink scheduler per LED, by the real path of its brightness file, so routes that
+# share an LED (or name LEDFILE through its /sys/class/leds link) share its lit state.
+blinkers = {os.path.realpath(LEDFILE): blinker}
+
+def parseroute(spec):
+    # 'PATTERN[=LED]' -> (pattern, brightness file, blink scheduler). LED is one of
+    # LOCKLEDS or a brightness file path; without it the device drives LEDFILE.
+    pattern, _, name = spec.partition('=')
+    ledfile = find_led(name) if name else LEDFILE
+    if ledfile is None:
+        sys.stderr.write(f"Error: no LED named '{name}' under /sys/class/leds\n")
+        sys.exit(1)
+    ledfile = os.path.realpath(ledfile)
+    scheduler = blinkers.get(ledfile)
+    if scheduler is None:
+        output = drivers[ledfile] = LedDriver(ledfile, LEDON, LEDOFF)
+        scheduler = blinkers[ledfile] = BlinkScheduler(BLINKRATE, output.on, output.off)
+    return pattern, ledfile, scheduler
+
+def reportpoller(engine):
+    # SIGUSR1 handler body: print the current pacing so power savings can be checked,
+    # and how many active samples an in-flight only check would have missed.
+    poller = engine.poller
+    sys.stderr.write(f"dsklite: poll interval {poller.interval * 1000.0:.1f} ms, "
+                     f"{poller.wakeups_per_second:.1f} wakeups/s, {poller.wakeups} wakeups total\n")
+    for device, detector in engine.detectors.items():
+        sys.stderr.write(f"dsklite: {device}: {detector.active} active of {detector.samples} samples, "
+                         f"{detector.missed} seen only by counter deltas\n")
+    if engine.stats is not None:
+        for line in engine.stats.report(engine).splitlines():
+            sys.stderr.write(f"dsklite: {line}\n")
+
+def instrument(engine, path):
+    # Collect the daemon's own jitter, CPU time and LED writes, printed on SIGUSR1. With
+    # 'path' the report is also served on a UNIX socket; returns that StatsSocket or None.
+    stats = engine.instrument()
+    for driver in drivers.values():
+        stats.watch(driver)
+    if path is None:
+        return None
+    server = StatsSocket(path, lambda: stats.report(engine, buckets=True))
+    return server if server.open() else None
+
+def printstats(patterns, interval):
+    # --stats: print iostat style metrics of every monitored device every 'interval'
+    # seconds, from one read of the kernel's counters per interval. Leaves the LEDs alone.
+    engine = SamplingEngine(STATSFILE, interval, interval, hotplug=False, sysfs=SYSFS)
+    engine.add(StatsOutput(interval), patterns)
+    engine.start().run()
+
+def showdashboard(patterns, fps, fullscale):
+    # --dashboard: draw every monitored device in the terminal, sampled like the LEDs
+    # (fast while busy, IDLEINTERVAL while idle). Leaves the LEDs alone.
+    engine = SamplingEngine(STATSFILE, BLINKRATE / 4.0, IDLEINTERVAL, sysfs=SYSFS)
+    engine.add(DashboardOutput(fps, fullscale), patterns)
     try:
-        with open(LEDFILE, 'w') as f:
-            f.write(LEDOFF)
-    except (IOError, OSError) as e:
-        # Log error if LEDFILE cannot be written.
-        # Continue execution as the main loop will retry LED operations.
-        # This assumes the issue might be transient (e.g., permissions temporarily changed).
-        sys.stderr.write(f"Error writing to LEDFILE '{LEDFILE}' in resetled: {e}\n")
-
-def setled():
-    global timer
-    # Cancel any existing timer to ensure the LED-off action is correctly timed
-    # from this 'setled' call.
-    if timer is not None and timer.is_alive():
-        timer.cancel()
-    
-    try:
-        # Start a timer to call resetled, which will turn the LED off after BLINKRATE.
-        timer = threading.Timer(BLINKRATE, resetled)
-        timer.start()
-    except Exception as e: # Broad exception for timer start issues
-        # Log error if the timer cannot be started.
-        # This might mean the LED blinking behavior is compromised.
-        # Continue execution, as disk activity monitoring is still valuable.
-        sys.stderr.write(f"Error starting timer in setled: {e}\n")
-        # Potentially attempt to re-initialize or handle, for now, just log
+        engine.start().run()
+    finally:
+        engine.close()
 
+async def runasync(engine, routes, psi, server=None, blocking=()):
+    # --asyncio: the same LED routes, with the blink deadlines as timers on the event loop.
+    # An LED shared by several routes keeps one blinker. The 'blocking' outputs (file and
+    # socket writers) run in the loop's executor, on copies of the states.
+    blinkers = {}
+    for pattern, ledfile, output in routes:
+        blinker = blinkers.get(ledfile)
+        if blinker is None:
+            blinker = blinkers[ledfile] = LoopBlinker(BLINKRATE, output.on, output.off)
+        engine.add(BlinkOutput(blinker), [pattern])
+    for output in blocking:
+        engine.add(ExecutorOutput(output), [pattern for pattern, ledfile, led in routes])
+    runtime = AsyncEngine(engine, psi)
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGUSR1, reportpoller, engine)
+    loop.add_signal_handler(signal.SIGTERM, runtime.stop)
+    if server is not None:
+        loop.add_reader(server.fileno(), server.serve)
     try:
-        # Turn the LED on.
-        with open(LEDFILE, 'w') as f: # Changed 'a' to 'w' for overwriting
-            f.write(LEDON)
-    except (IOError, OSError) as e:
-        # Log error if LEDFILE cannot be written.
-        # Continue execution as the main loop will retry LED operations on next activity.
-        sys.stderr.write(f"Error writing to LEDFILE '{LEDFILE}' in setled: {e}\n")
-
-def getstat(device):
+        await runtime.run()
+    finally:
+        if server is not None:
+            loop.remove_reader(server.fileno())
+            server.close()
+
+def blinkdelays(utilization):
+    # (delay_on, delay_off) for the timer trigger. delay_on 0 keeps the LED off.
+    if utilization <= 0:
+        return 0, 1000
+    for threshold, delay_on, delay_off in TRIGGERLEVELS:
+        if utilization >= threshold:
+            return delay_on, delay_off
+    return TRIGGERLEVELS[-1][1:]
+
+def kernelblink(mode, device=DEVICE, ledfile=LEDFILE):
+    # Let the kernel blink the LED. With the disk-activity trigger (which follows
+    # every disk, not just 'device') this process only sleeps; with the timer trigger
+    # it samples the time spent doing I/O every TRIGGERPOLL seconds and rewrites
+    # delay_on/delay_off only when the activity level changes.
+    # Returns False without blocking if the kernel does not offer a usable trigger.
+    trigger = LedTrigger.for_brightness(ledfile)
+    available = trigger.available()
+    if mode in ('auto', DISKTRIGGER) and DISKTRIGGER in available:
+        chosen = DISKTRIGGER
+    elif mode in ('auto', TIMERTRIGGER) and TIMERTRIGGER in available:
+        chosen = TIMERTRIGGER
+    else:
+        sys.stderr.write(f"LED trigger '{mode}' is not available, falling back to userspace blinking\n")
+        return False
+    original = trigger.current()
+    if not trigger.select(chosen):
+        return False
+    # Restore the original trigger (e.g. kbd-numlock) when stopped.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
-        with open(STATSFILE, 'r') as f:
-            stats = f.readlines()
-        for stat_line in stats: # Renamed stat to stat_line to avoid conflict
-            lstat = stat_line.split()
-            # Check if the line is long enough and matches the target device.
-            if len(lstat) > DEVICENAME and lstat[DEVICENAME] == device:
-                return lstat
-    except (IOError, OSError) as e:
-        # Log error if STATSFILE cannot be read. This is a non-critical error for a single read attempt.
-        # Recovery: Return None, getioinprogress will then return 0, indicating no activity.
-        # The main loop will continue and retry reading on the next iteration.
-        sys.stderr.write(f"Error reading STATSFILE '{STATSFILE}': {e}\n")
-    return None # Return None on error or if device not found
-
-def getioinprogress(device):
-    stat_data = getstat(device) # Renamed stat to stat_data
-    if stat_data and len(stat_data) > IOINPROGRESS:
-        try:
-            return int(stat_data[IOINPROGRESS])
-        except ValueError as e:
-            # Log error if the I/O progress value is not a valid integer.
-            # Recovery: Return 0, treating malformed data as no current I/O activity.
-            # This prevents the application from crashing due to unexpected file content.
-            sys.stderr.write(f"Error converting IOINPROGRESS to int for device '{device}': {e}\nData: {stat_data}\n")
-            return 0
-    # If stat_data is None (due to read error in getstat) or not structured as expected,
-    # or if IOINPROGRESS index is out of bounds.
-    # Recovery: Return 0, indicating no I/O activity detected or data unavailable.
-    # This is a safe default, as it implies no need to blink the LED.
-    return 0
+        if chosen == DISKTRIGGER:
+            while True:
+                signal.pause()
+        sampler = open_sampler(device, STATSFILE, SYSFS)
+        busy = sampler.sample(IOTIME)
+        last = time.monotonic()
+        trigger.set_delays(*blinkdelays(0))
+        while True:
+            time.sleep(TRIGGERPOLL)
+            now = time.monotonic()
+            previous, busy = busy, sampler.sample(IOTIME)
+            # IOTIME is in ms, so this is the fraction of the interval the disk was busy.
+            trigger.set_delays(*blinkdelays((busy - previous) / ((now - last) * 1000.0)))
+            last = now
+    finally:
+        if original is not None:
+            trigger.select(original)
+    return True
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive activity light on the keyboard num lock LED.')
+    parser.add_argument('--trigger', choices=('auto', DISKTRIGGER, TIMERTRIGGER),
+                        help="let the kernel blink the LED through its trigger interface; "
+                             "'auto' prefers disk-activity and falls back to timer. "
+                             "Without a usable trigger the LED is blinked from userspace")
+    parser.add_argument('--device', action='append', metavar='PATTERN[=LED]',
+                        help=f"device name or glob such as 'nvme*n1' to monitor, optionally with the LED it "
+                             f"drives: {', '.join(LOCKLEDS)} or a brightness file (default: {DEVICE} on numlock). "
+                             f"May be repeated; all devices are read from one pass over /proc/diskstats")
+    parser.add_argument('--idle-interval', type=float, metavar='SECONDS',
+                        help=f"longest time between samples while the disk is idle (default: {PSIIDLEINTERVAL} "
+                             f"when I/O pressure (PSI) triggers are available, {IDLEINTERVAL} otherwise). "
+                             f"Send SIGUSR1 to print the current interval and wakeups per second")
+    parser.add_argument('--no-psi', action='store_true',
+                        help="don't wait for PSI I/O pressure triggers while idle, only poll on a timer")
+    parser.add_argument('--asyncio', action='store_true',
+                        help="run sampling, blink deadlines and PSI/hotplug wakeups on one asyncio event "
+                             "loop in a single thread, instead of a sampling loop and a thread per LED")
+    parser.add_argument('--stats', type=float, nargs='?', const=1.0, metavar='SECONDS',
+                        help="don't blink, print r/s, w/s, MB/s, await, queue size and %%util of "
+                             "every --device every SECONDS (default: 1) in the foreground")
+    parser.add_argument('--dashboard', type=float, nargs='?', const=FPS, metavar='FPS',
+                        help=f"don't blink, draw an activity lamp, MB/s bars, %%util and its recent history of "
+                             f"every --device in the terminal, at most FPS (default: {FPS:g}) frames a second, "
+                             f"redrawing only what changed; q quits")
+    parser.add_argument('--full-scale', type=float, default=FULLSCALE, metavar='MBPS',
+                        help=f"throughput in MB/s drawn as a full --dashboard bar (default: {FULLSCALE:g})")
+    parser.add_argument('--stats-socket', metavar='PATH',
+                        help="serve the daemon's own wakeup jitter and CPU time histograms, sysfs writes per "
+                             "second and late blinks on this UNIX socket (always printed on SIGUSR1)")
+    parser.add_argument('--record', metavar='LOG',
+                        help="append the counters of every sample of every --device to a compact binary log, "
+                             "rotated to LOG.1 ... LOG.3 by size; inspect and replay it with recorder.py")
+    parser.add_argument('--record-size', type=float, default=MAXBYTES / 2 ** 20, metavar='MB',
+                        help=f"size at which the --record log is rotated (default: {MAXBYTES // 2 ** 20})")
+    parser.add_argument('--exporter', type=parseaddress, nargs='?', const=('127.0.0.1', PORT),
+                        metavar='[HOST:]PORT',
+                        help=f"serve the counters and rates of every --device in the Prometheus text format "
+                             f"on http://HOST:PORT/metrics (default: 127.0.0.1:{PORT}; IPv6 hosts in brackets), "
+                             f"from the samples already taken, without reading /proc per scrape")
+    parser.add_argument('--textfile', metavar='PATH',
+                        help="write the same metrics to a node_exporter textfile collector file (*.prom)")
+    parser.add_argument('--export-interval', type=float, default=EXPORTINTERVAL, metavar='SECONDS',
+                        help=f"how often the exported metrics are refreshed (default: {EXPORTINTERVAL:g})")
+    parser.add_argument('--fleet', type=fleet.parseaddress, metavar='HOST[:PORT]',
+                        help=f"send the per-tick activity of every --device to a fleetcollector.py on HOST "
+                             f"(port {fleet.PORT} by default; IPv6 hosts in brackets), several ticks per UDP datagram")
+    parser.add_argument('--fleet-rate', type=float, default=fleet.RATE, metavar='N',
+                        help=f"most datagrams per second sent to --fleet (default: {fleet.RATE:g})")
+    parser.add_argument('--diskstats', default=STATSFILE, metavar='PATH',
+                        help=f"diskstats file to read (default: {STATSFILE}), e.g. one written by fixtures.py")
+    parser.add_argument('--sysfs', default=SYSFS, metavar='DIR',
+                        help=f"directory with the <device>/stat and inflight files (default: {SYSFS}); "
+                             f"'' to always read --diskstats")
+    args = parser.parse_args()
+    STATSFILE = args.diskstats
+    SYSFS = args.sysfs or None
+    if args.stats is not None:
+        try:
+            printstats([spec.partition('=')[0] for spec in (args.device or [DEVICE])], args.stats)
+        except KeyboardInterrupt:
+            sys.exit(0)
+    if args.dashboard is not None:
+        try:
+            showdashboard([spec.partition('=')[0] for spec in (args.device or [DEVICE])], args.dashboard,
+                          args.full_scale)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    routes = [parseroute(spec) for spec in (args.device or [DEVICE])]
+
     try:
         # Fork the process to run the LED monitoring in the background (child process).
         pid = os.fork()
@@ -173,13 +336,38 @@ if __name__ == '__main__':
         sys.exit(1) # Exit if fork fails
 
     if pid == 0:  # Child process
-        # Ensure the LED is in a known off state when the child process starts.
-        resetled() # Ensure LED is off at start
-        while True:
-            weightedtime = getioinprogress(DEVICE)
-            if weightedtime > 0:
-                setled()
-            # No need for an else to call resetled() here, as setled() schedules resetled() via timer
-            time.sleep(BLINKRATE / 4.0)
+        if args.trigger and kernelblink(args.trigger, routes[0][0], routes[0][1]):
+            sys.exit(0)
+        # Sample at BLINKRATE / 4.0 while the disk is busy and back off towards
+        # --idle-interval while it is not. Idle sleeps end early when the PSI trigger fires.
+        psi = PsiEventSource()
+        if args.no_psi or not psi.open():
+            psi = None
+        idle = args.idle_interval or (PSIIDLEINTERVAL if psi is not None else IDLEINTERVAL)
+        engine = SamplingEngine(STATSFILE, BLINKRATE / 4.0, idle, sleep=psi.sleep if psi is not None else time.sleep,
+                                sysfs=SYSFS)
+        server = instrument(engine, args.stats_socket)
+        blocking = []
+        if args.exporter or args.textfile:
+            blocking.append(PrometheusOutput(args.exporter, args.textfile, args.export_interval))
+        if args.fleet:
+            blocking.append(fleet.FleetOutput(args.fleet, rate=args.fleet_rate))
+        if args.record:
+            blocking.append(Recorder(args.record, int(args.record_size * 2 ** 20)))
+        if args.asyncio:
+            asyncio.run(runasync(engine, routes, psi, server, blocking))
+            sys.exit(0)
+        for output in blocking:
+            engine.add(output, [pattern for pattern, ledfile, led in routes])
+        for pattern, ledfile, output in routes:
+            engine.add(BlinkOutput(output), [pattern])
+        # Ensure the LEDs are in a known off state when the child process starts, then
+        # start their scheduler threads here because threads do not survive fork().
+        engine.start()
+        if server is not None:
+            server.start()
+        signal.signal(signal.SIGUSR1, lambda signum, frame: reportpoller(engine))
+        # No need to turn the LEDs off here, as the blink schedulers do it at the deadline
+        engine.run()
     else: # Parent process
         sys.exit(0) # Parent exits immediately
@@ -173,119 +173,136 @@ If this is set, the action will not be called.
 Once created, menus and menu items cannot be modified. All attributes except for the menu item callbacks can however be set to callables returning the current value. This also applies to the sequence of menu items belonging to a menu: this can be a callable returning the current sequence.
 """
 
-import threading
-import time
 import pystray
 from PIL import Image, ImageDraw, ImageColor
+import argparse
+import signal
+import math
+import resource
 import sys
+import time
+from engine import SamplingEngine, BlinkOutput
+from recorder import Recorder, MAXBYTES
+from ledcontrol import LedDriver, find_led
+from scheduler import BlinkScheduler
+from psievents import PsiEventSource
+from trayicon import IconCache, TrayIconUpdater, MAXFPS
+from sparkline import Sparkline, HISTORY
+from procio import ProcessIoOutput, TOP, formatrate
 
 STATSFILE = '/proc/diskstats'
+SYSFS = '/sys/block'
 BLINKRATE = 0.065
-DEVICENAME = 2
 DEVICE = 'sda'
-IOINPROGRESS = 11
+IDLEINTERVAL = 1.0 # Longest sleep between samples once the disk has been idle for a while
+PSIIDLEINTERVAL = 10.0 # The same when a PSI trigger on /proc/pressure/io can cut idle sleeps short
 ICONWIDTH = 32
 ICONHEIGHT = 32
+ICONLEVELS = 8 # Brightness steps of each colour channel, including off
+FULLSCALE = 200.0 # MB/s shown at full brightness
+LEVELSTEPS = 256 # Resolution of the throughput to brightness lookup table
+READCOLOUR = (0, 255, 0) # Reads light the green channel
+WRITECOLOUR = (255, 0, 0) # and writes the red one, both together show yellow
+MINBRIGHTNESS = 0.35 # Brightness of the lowest level that is not off
+OFFSTATE = (0, 0) # Icon states are (read level, write level) pairs
 
-timer = None # Initialize timer globally
 icon = None # Initialize icon globally, will be set in main
-iconon_img = None # Global for the 'on' image
 iconoff_img = None # Global for the 'off' image
-
-def resetled_icon_state():
-    global icon, iconoff_img
-    if icon and iconoff_img:
-        try:
-            icon.icon = iconoff_img
-            icon.visible = True
-            # print 'OFF' # Optional: for debugging
-        except Exception as e:
-            # Log error if updating the pystray icon fails during runtime.
-            # Recovery: Continue execution. The icon might be stale, but the monitoring loop proceeds.
-            # This prevents a runtime glitch in UI update from crashing the whole application.
-            sys.stderr.write(f"Error updating icon to OFF state: {e}\n")
-    elif not icon:
-        # This case should ideally not be reached if icon is initialized properly in startup_routine.
-        sys.stderr.write("Error: resetled_icon_state called before icon was initialized.\n")
-    elif not iconoff_img:
-        # This case indicates an issue with image creation at startup.
-        sys.stderr.write("Error: resetled_icon_state called before iconoff_img was created.\n")
-
-
-def setled_icon_state():
-    global timer, icon, iconon_img
-    # Cancel any existing timer to ensure the icon-off action is correctly timed
-    # from this 'setled_icon_state' call.
-    if timer is not None and timer.is_alive():
-        timer.cancel()
-    
-    try:
-        # Start a timer to call resetled_icon_state, which will set the icon to 'off' after BLINKRATE.
-        timer = threading.Timer(BLINKRATE, resetled_icon_state)
-        timer.start()
-    except Exception as e:
-        # Log error if the timer cannot be started.
-        # This compromises the blinking behavior (icon might stay 'on').
-        # Recovery: Continue execution. Disk activity monitoring is still valuable.
-        sys.stderr.write(f"Error starting timer in setled_icon_state: {e}\n")
-
-    if icon and iconon_img:
-        try:
-            # Set the icon to 'on' state.
-            icon.icon = iconon_img
-            icon.visible = True
-            # print 'ON' # Optional: for debugging
-        except Exception as e:
-            # Log error if updating the pystray icon fails during runtime.
-            # Recovery: Continue execution. The icon might not update to 'on', but the monitoring loop proceeds.
-            sys.stderr.write(f"Error updating icon to ON state: {e}\n")
-    elif not icon:
+iconcache = None # Images of every icon state, built once at startup
+levelof = [] # Brightness level of every step of the lookup table, see create_levels()
+levelscale = LEVELSTEPS / FULLSCALE # Lookup table steps per MB/s
+levels = {} # Icon state shown while lit, keyed by device pattern
+sparklines = {} # Activity history graph of every device pattern in --sparkline mode
+updater = None # Throttled, change-only updates of the global icon
+updaters = {} # Icon updater of every device pattern
+routes = [] # (device pattern, blink scheduler) pairs, the first one drives the global icon
+ledoutput = None # BlinkOutput of the --led LED
+leddriver = None # LedDriver of the --led LED
+engine = None # The sampling engine, once startup_routine() created it
+topitems = () # Menu items of the processes doing the most I/O, see update_topmenu()
+
+def resetled_icon_state(target=None):
+    # 'target' is the updater of an additional device pattern, the global icon's by default.
+    # The updater pushes the image only if the icon is not already showing 'off'.
+    target = target or updater
+    if target:
+        target.set(OFFSTATE)
+    else:
+        # This case should ideally not be reached if the updater is created in startup_routine.
+        sys.stderr.write("Error: resetled_icon_state called before the icon updater was created.\n")
+
+
+def turnon_icon_state(target=None, pattern=None):
+    # Lights the icon at the brightness of the throughput of 'pattern', the first one by default.
+    target = target or updater
+    if target:
+        target.set(levels.get(pattern or routes[0][0], OFFSTATE))
+    else:
         # This case should ideally not be reached.
-        sys.stderr.write("Error: setled_icon_state called before icon was initialized.\n")
-    elif not iconon_img:
-        # This case indicates an issue with image creation at startup.
-        sys.stderr.write("Error: setled_icon_state called before iconon_img was created.\n")
-
-
-def getstat(device):
-    try:
-        with open(STATSFILE, 'r') as f:
-            stats = f.readlines()
-        for stat_line in stats:
-            lstat = stat_line.split()
-            # Check if the line is long enough and matches the target device.
-            if len(lstat) > DEVICENAME and lstat[DEVICENAME] == device:
-                return lstat
-    except (IOError, OSError) as e:
-        # Log error if STATSFILE cannot be read. This is a non-critical error for a single read attempt.
-        # Recovery: Return None. getioinprogress will then return 0, indicating no activity.
-        # The main loop will continue and retry reading on the next iteration.
-        sys.stderr.write(f"Error reading STATSFILE '{STATSFILE}': {e}\n")
-    except Exception as e: # Catch any other unexpected errors
-        # Log unexpected errors during file processing.
-        # Recovery: Return None, similar to IOError/OSError.
-        sys.stderr.write(f"Unexpected error reading STATSFILE '{STATSFILE}': {e}\n")
-    return None # Return None on error or if device not found
-
-def getioinprogress(device):
-    stat_data = getstat(device)
-    if stat_data:
-        if len(stat_data) > IOINPROGRESS:
-            try:
-                return int(stat_data[IOINPROGRESS])
-            except ValueError as e:
-                # Log error if the I/O progress value is not a valid integer.
-                # Recovery: Return 0. Treating malformed data as no current I/O activity
-                # is a safe default, preventing crashes and implying no icon change.
-                sys.stderr.write(f"Error converting IOINPROGRESS to int for device '{device}': {e}\nData: {stat_data}\n")
-        else:
-            # Log if the expected field is missing.
-            # Recovery: Return 0, as data is incomplete.
-            sys.stderr.write(f"IOINPROGRESS index out of bounds for device '{device}'. Data: {stat_data}\n")
-    # If stat_data is None (due to read error in getstat) or not structured as expected.
-    # Recovery: Return 0. This is a safe default, indicating no I/O activity detected or data unavailable,
-    # thus no need to change the icon state to 'on'.
-    return 0
+        sys.stderr.write("Error: turnon_icon_state called before the icon updater was created.\n")
+
+
+def reportupdates(signum=None, frame=None):
+    # SIGUSR1 handler: print how many tray updates were pushed and how many were not needed,
+    # and the CPU time used, to compare with the AppIndicator backend in simplegtkapp.py.
+    for pattern, target in updaters.items():
+        sys.stderr.write(f"dsklite: {pattern}: {target.pushed} tray updates pushed, "
+                         f"{target.suppressed} suppressed\n")
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    sys.stderr.write(f"dsklite: {usage.ru_utime + usage.ru_stime:.2f} s CPU\n")
+    if engine is not None and engine.stats is not None:
+        for line in engine.stats.report(engine).splitlines():
+            sys.stderr.write(f"dsklite: {line}\n")
+
+
+def topitem(process):
+    # The text is a callable, so the rates stay current between ranking changes.
+    return pystray.MenuItem(lambda item: f"{process.name or process.pid} ({process.pid}): "
+                                         f"read {formatrate(process.readrate)}, "
+                                         f"write {formatrate(process.writerate)}",
+                            None, enabled=False)
+
+
+def update_topmenu(ranking):
+    # ProcessIoOutput thread: rebuild the menu, only called when the ranking changed.
+    global topitems
+    if ranking:
+        topitems = tuple(topitem(process) for process in ranking)
+    else:
+        topitems = (pystray.MenuItem('No process I/O in the last seconds', None, enabled=False),)
+    if icon is not None:
+        icon.update_menu()
+
+
+class TrayOutput(BlinkOutput):
+    """Engine output that blinks, grades or graphs the tray icon of one device pattern."""
+
+    def __init__(self, pattern, blinker):
+        BlinkOutput.__init__(self, blinker)
+        self.pattern = pattern
+
+    def update(self, states, now):
+        state = states[self.pattern]
+        graph = sparklines.get(self.pattern)
+        if graph is not None:
+            # The graph replaces the blinking: push its new version, the updater renders
+            # it at the icon's frame rate and skips versions in between.
+            updaters[self.pattern].set(graph.add(state.utilization))
+        elif state.active:
+            level = (getlevel(state.readmb), getlevel(state.writemb))
+            # Activity without throughput (e.g. only I/O in flight) shows the lowest level.
+            levels[self.pattern] = level if level != OFFSTATE else (1, 1)
+            self.blinker.trigger()
+            if self.blinker.lit:
+                # Already on: the scheduler will not call turnon_icon_state(), follow the level here.
+                updaters[self.pattern].set(levels[self.pattern])
+
+def getlevel(mbps):
+    # Brightness level for a throughput in MB/s, only 0 MB/s is off. A multiply and a
+    # list index, no PIL work.
+    return levelof[min(math.ceil(mbps * levelscale), LEVELSTEPS)]
+
+blinker = BlinkScheduler(BLINKRATE, turnon_icon_state, resetled_icon_state)
 
 def create_image(color_hex):
     try:
@@ -303,39 +320,145 @@ def create_image(color_hex):
         sys.stderr.write(f"Error creating image with color {color_hex}: {e}\n")
         return None
 
+def create_levels(steps):
+    # Lookup table from throughput steps to brightness levels. Follows the square root of
+    # the throughput so that light I/O is still visible, and only step 0 is off.
+    table = [0]
+    for step in range(1, LEVELSTEPS + 1):
+        table.append(min(steps - 1, 1 + int((step / LEVELSTEPS) ** 0.5 * (steps - 1))))
+    return table
+
+def create_palette(steps):
+    # One image per (read level, write level) state, created once at startup.
+    # Returns None if any image cannot be created.
+    palette = {}
+    for read in range(steps):
+        for write in range(steps):
+            colour = [0, 0, 0]
+            for level, channel in ((read, READCOLOUR), (write, WRITECOLOUR)):
+                if level:
+                    fraction = (level - 1) / (steps - 2) if steps > 2 else 1.0
+                    brightness = MINBRIGHTNESS + (1.0 - MINBRIGHTNESS) * fraction
+                    colour = [min(255, c + int(b * brightness)) for c, b in zip(colour, channel)]
+            image = create_image('#%02X%02X%02X' % tuple(colour))
+            if image is None:
+                return None
+            palette[(read, write)] = image
+    return palette
+
 def startup_routine(passed_icon): # pystray run() passes the icon as an argument
     # This function runs in a separate thread after the pystray icon is set up.
-    global icon # Ensure we are using the global icon variable
+    global icon, updater, engine # Ensure we are using the global variables
     icon = passed_icon # Assign the passed icon to our global var for other functions to use
-    
-    resetled_icon_state() # Set initial state
-    while True:
-        weightedtime = getioinprogress(DEVICE)
-        if weightedtime > 0:
-            setled_icon_state()
-        # If weightedtime is 0, the timer from the last setled_icon_state() will call resetled_icon_state()
-        time.sleep(BLINKRATE / 4.0)
+    updater = TrayIconUpdater(icon, sparklines.get(routes[0][0], iconcache), args.max_fps).start()
+    updaters[routes[0][0]] = updater
+
+    # Sample at BLINKRATE / 4.0 while the disk is busy and back off towards IDLEINTERVAL while it is not.
+    # If I/O pressure (PSI) triggers are available, idle sleeps are longer and end early when one fires.
+    # The history graph scrolls by a column per period, so it is sampled at least that often.
+    psi = PsiEventSource()
+    if psi.open():
+        idle = PSIIDLEINTERVAL
+    else:
+        idle = IDLEINTERVAL
+    if sparklines:
+        idle = min(idle, min(graph.period for graph in sparklines.values()))
+    engine = SamplingEngine(STATSFILE, BLINKRATE / 4.0, idle, sleep=psi.sleep if psi.available else time.sleep,
+                            sysfs=SYSFS)
+    for pattern, output in routes:
+        engine.add(TrayOutput(pattern, output), [pattern])
+    if args.record:
+        engine.add(Recorder(args.record, int(args.record_size * 2 ** 20)), [pattern for pattern, output in routes])
+    if args.top > 0:
+        # Scans /proc only while the disk is active, the menu is rebuilt when the ranking changes.
+        engine.add(ProcessIoOutput(n=args.top, onchange=update_topmenu), [pattern for pattern, output in routes])
+    if ledoutput is not None:
+        # The LED follows every pattern from the same samples as the icons.
+        engine.add(ledoutput, [pattern for pattern, output in routes])
+    # Jitter, CPU per tick, LED writes and late blinks for the SIGUSR1 report.
+    engine.instrument().watch(leddriver)
+    # Starts the blink schedulers with their outputs in a known off state.
+    engine.start()
+    # If not active, the blink schedulers call resetled_icon_state() at the deadline
+    engine.run()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive activity light in the system tray.')
+    parser.add_argument('devices', nargs='*', default=[DEVICE], metavar='PATTERN',
+                        help=f"device name or glob such as 'nvme*n1' (default: {DEVICE}). Each pattern gets "
+                             f"its own tray icon; all devices are read from one pass over /proc/diskstats")
+    parser.add_argument('--levels', type=int, default=ICONLEVELS, metavar='N',
+                        help=f"brightness steps of the read (green) and write (red) colours, including off "
+                             f"(default: {ICONLEVELS}, 2 for a plain on/off icon)")
+    parser.add_argument('--full-scale', type=float, default=FULLSCALE, metavar='MBPS',
+                        help=f"throughput in MB/s shown at full brightness (default: {FULLSCALE:g})")
+    parser.add_argument('--sparkline', type=float, nargs='?', const=HISTORY, metavar='SECONDS',
+                        help=f"draw the %%util of the last SECONDS (default: {HISTORY:g}) as a scrolling "
+                             f"bar graph instead of blinking")
+    parser.add_argument('--led', metavar='LED',
+                        help="also blink a keyboard LED (numlock, capslock, scrolllock or a brightness "
+                             "file) from the same samples as the tray icon")
+    parser.add_argument('--max-fps', type=float, default=MAXFPS, metavar='FPS',
+                        help=f"most tray icon updates per second and icon (default: {MAXFPS:g}, 0 for no limit)")
+    parser.add_argument('--record', metavar='LOG',
+                        help="append the counters of every sample to a compact binary log, rotated to "
+                             "LOG.1 ... LOG.3 by size; inspect and replay it with recorder.py")
+    parser.add_argument('--record-size', type=float, default=MAXBYTES / 2 ** 20, metavar='MB',
+                        help=f"size at which the --record log is rotated (default: {MAXBYTES // 2 ** 20})")
+    parser.add_argument('--top', type=int, default=TOP, metavar='N',
+                        help=f"list the N processes reading and writing the most in the tray menu, from "
+                             f"/proc/<pid>/io while the disk is active (default: {TOP}, 0 for no menu)")
+    parser.add_argument('--diskstats', default=STATSFILE, metavar='PATH',
+                        help=f"diskstats file to read (default: {STATSFILE}), e.g. one written by fixtures.py")
+    parser.add_argument('--sysfs', default=SYSFS, metavar='DIR',
+                        help=f"directory with the <device>/stat and inflight files (default: {SYSFS}); "
+                             f"'' to always read --diskstats")
+    args = parser.parse_args()
+    STATSFILE = args.diskstats
+    SYSFS = args.sysfs or None
+    if args.led is not None:
+        ledfile = find_led(args.led)
+        if ledfile is None:
+            sys.stderr.write(f"Error: no LED named '{args.led}' under /sys/class/leds\n")
+            sys.exit(1)
+        leddriver = LedDriver(ledfile)
+        ledoutput = BlinkOutput(BlinkScheduler(BLINKRATE, leddriver.on, leddriver.off))
+
     # Create images first
-    # Create images for 'on' and 'off' states at startup.
-    iconon_img = create_image("#FF0000") # Red for ON
-    iconoff_img = create_image("#000000") # Black for OFF (or a dim color)
+    # Create the images of every brightness state at startup, black for OFF.
+    steps = max(2, args.levels)
+    levelof = create_levels(steps)
+    levelscale = LEVELSTEPS / args.full_scale if args.full_scale > 0 else LEVELSTEPS / FULLSCALE
+    palette = create_palette(steps)
 
     # PIL/Pillow image creation is essential for the system tray icon.
     # If images cannot be created, the application cannot display its state.
     # Recovery: Log a critical error and exit, as the application is not viable without icons.
-    if iconon_img is None or iconoff_img is None:
+    if palette is None:
         sys.stderr.write("Critical error: Failed to create initial icon images. Exiting.\n")
         sys.exit(1)
+    iconoff_img = palette[OFFSTATE]
+    try:
+        # Encode every state once, so switching the icon never creates or converts an image.
+        iconcache = IconCache(palette)
+    except Exception as e:
+        sys.stderr.write(f"Critical error: Failed to prepare icon images: {e}\n")
+        sys.exit(1)
+    if args.sparkline:
+        for pattern in args.devices:
+            sparklines[pattern] = Sparkline(ICONWIDTH, ICONHEIGHT, args.sparkline)
+    signal.signal(signal.SIGUSR1, reportupdates)
 
     try:
         # Initialize the pystray.Icon object. This is a core part of the application's UI.
         # Use a temporary variable for the icon passed to run, then assign to global in startup_routine.
+        # The menu's items are a callable, so update_topmenu() can replace them.
+        update_topmenu([])
         temp_icon = pystray.Icon(
             'dsklite',
             iconoff_img, # Initial icon state is 'off'.
-            "Disk Activity"
+            "Disk Activity",
+            menu=pystray.Menu(lambda: topitems) if args.top > 0 else None
         )
     except Exception as e:
         # Failure to create the pystray.Icon object is a critical startup error.
@@ -343,6 +466,24 @@ if __name__ == '__main__':
         # Recovery: Log a critical error and exit.
         sys.stderr.write(f"Critical error: Failed to create pystray.Icon: {e}\n")
         sys.exit(1)
+
+    routes.append((args.devices[0], blinker))
+    for number, pattern in enumerate(args.devices[1:], 1):
+        try:
+            # Every further pattern gets an icon of its own. Detached icons are served by
+            # the main loop that temp_icon.run() starts below.
+            extra_icon = pystray.Icon(f'dsklite{number}', iconoff_img, f"Disk Activity: {pattern}")
+            extra_icon.run_detached()
+        except Exception as e:
+            # Recovery: Log the error and carry on with the icons that could be created.
+            sys.stderr.write(f"Error: Failed to create pystray.Icon for '{pattern}': {e}\n")
+            continue
+        extra_updater = TrayIconUpdater(extra_icon, sparklines.get(pattern, iconcache), args.max_fps).start()
+        updaters[pattern] = extra_updater
+        routes.append((pattern, BlinkScheduler(BLINKRATE,
+                                               lambda target=extra_updater, pattern=pattern:
+                                                   turnon_icon_state(target, pattern),
+                                               lambda target=extra_updater: resetled_icon_state(target))))
     
     try:
         # icon.run() is blocking and starts the system tray icon's event loop.
@@ -0,0 +1,295 @@
+"""
+Per-process storage I/O from /proc/<pid>/io, scanned incrementally.
+
+When the light is on, the question is "who is hitting the disk?". The
+kernel counts the bytes every process made the block layer read and write
+(read_bytes and write_bytes in /proc/<pid>/io, summed over its threads).
+ProcessIoScanner turns them into per-process rates over the last WINDOW
+seconds, cheaply enough for a box with thousands of processes:
+
+  - One os.scandir() of /proc per scan finds the pids; only names that
+    are numbers are looked at, and no per-entry stat() is made.
+  - Every pid keeps a ProcessState with its command name (read once) and
+    an open fd on its io file, so a scan is one pread() per process. At
+    most 'maxfds' fds are kept open, half the soft RLIMIT_NOFILE by
+    default; further processes are opened and closed per scan.
+  - Processes whose io file cannot be read (other users' processes
+    without root) are remembered and skipped until they exit.
+  - Pids that are gone from /proc are dropped and their fd closed. An
+    open io fd stays bound to the process it was opened for and fails
+    with ESRCH once that process exits; the state is then reset, so the
+    next scan opens the io file of whatever process has the pid by then.
+    Processes are also identified by their start time (field 22 of
+    /proc/<pid>/stat), read when their io file is opened, so a process
+    without a kept fd whose pid was reused between two scans starts over.
+
+ProcessIoOutput is the engine.SamplingEngine output: scans only run while
+one of its patterns is active (and until the ranking has emptied after
+it), at most every SCANINTERVAL seconds, in a thread of their own, so
+neither an idle disk nor the sampling loop pays for them. 'onchange' is
+called when the order of the top processes changes, e.g. to rebuild a
+tray menu.
+"""
+
+import os
+import resource
+import sys
+import threading
+import time
+
+from engine import Output
+
+PROC = '/proc'
+WINDOW = 5.0  # Seconds of I/O the rates cover
+SCANINTERVAL = 1.0  # Shortest time between two scans
+TOP = 5
+READBYTES = b'read_bytes: '
+WRITEBYTES = b'write_bytes: '
+IOFILESIZE = 256
+STARTTIME = 22  # Field of /proc/<pid>/stat, counted from 1
+
+
+class ProcessState(object):
+    """Cached state of one pid."""
+
+    __slots__ = ('pid', 'started', 'name', 'fd', 'denied', 'read', 'written', 'history', 'readrate',
+                 'writerate')
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.started = None  # Start time of the process in clock ticks since boot, when last opened
+        self.name = None
+        self.fd = None
+        self.denied = False  # io file not readable, skipped until the pid goes away
+        self.read = self.written = None  # Counters at the last scan
+        self.history = []  # (time, bytes read, bytes written) of the scans within WINDOW that saw I/O
+        self.readrate = self.writerate = 0.0
+
+
+class ProcessIoScanner(object):
+    """Per-process read and write rates, from incremental scans of /proc."""
+
+    def __init__(self, proc=PROC, window=WINDOW, maxfds=None, clock=time.monotonic):
+        self.proc = proc
+        self.window = window
+        if maxfds is None:
+            maxfds = resource.getrlimit(resource.RLIMIT_NOFILE)[0] // 2
+        self.maxfds = maxfds
+        self.clock = clock
+        self.processes = {}  # ProcessState of every pid seen, keyed by pid
+        self.openfds = 0
+        self.scans = 0
+        self.lastscan = None  # clock() of the last scan
+        self.duration = 0.0  # Seconds the last scan took
+
+    def close(self):
+        for state in self.processes.values():
+            self._close(state)
+        self.processes.clear()
+
+    def _close(self, state):
+        if state.fd is not None:
+            try:
+                os.close(state.fd)
+            except OSError:
+                pass
+            state.fd = None
+            self.openfds -= 1
+
+    def _forget(self, state):
+        # Reset 'state' to a pid seen for the first time, e.g. once its fd stopped
+        # working because the process exited.
+        self._close(state)
+        state.name = None
+        state.denied = False
+        state.read = state.written = None
+        del state.history[:]
+        state.readrate = state.writerate = 0.0
+
+    def _started(self, pid):
+        # Start time of process 'pid' from its stat file, None if it is gone. The
+        # command name in parentheses may contain spaces, fields are counted after it.
+        try:
+            with open(f"{self.proc}/{pid}/stat", 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        fields = data[data.rfind(b')') + 2:].split()
+        return int(fields[STARTTIME - 3]) if len(fields) > STARTTIME - 3 else None
+
+    def _read(self, state):
+        # Contents of the io file of 'state', None if it cannot be read.
+        fd = state.fd
+        if fd is None:
+            try:
+                fd = os.open(f"{self.proc}/{state.pid}/io", os.O_RDONLY)
+            except PermissionError:
+                state.denied = True
+                return None
+            except OSError:
+                return None
+            started = self._started(state.pid)
+            if state.started is not None and started != state.started:
+                # Not the process the state was made for: the pid was reused since the
+                # last scan that opened it.
+                self._forget(state)
+            state.started = started
+            if self.openfds < self.maxfds:
+                state.fd = fd
+                self.openfds += 1
+        try:
+            data = os.pread(fd, IOFILESIZE, 0)
+        except OSError as e:
+            # ESRCH: the process exited, since the scandir() or since its fd was
+            # opened, and the pid may already belong to another one.
+            if state.fd is None:
+                os.close(fd)
+            self._forget(state)
+            state.denied = isinstance(e, PermissionError)
+            return None
+        if state.fd is None:
+            os.close(fd)
+        return data
+
+    def _name(self, pid):
+        try:
+            with open(f"{self.proc}/{pid}/comm", 'rb') as f:
+                return f.read().strip().decode('utf-8', 'replace')
+        except OSError:
+            return str(pid)
+
+    def scan(self):
+        # Update every process and drop the ones that exited.
+        start = self.clock()
+        # After a pause longer than the window (an idle disk is not scanned), counters
+        # only become the new baseline, so the I/O of the pause is not put into the window.
+        fresh = self.lastscan is None or start - self.lastscan > self.window
+        processes = self.processes
+        seen = set()
+        try:
+            entries = os.scandir(self.proc)
+        except OSError as e:
+            sys.stderr.write(f"Error scanning '{self.proc}': {e}\n")
+            return
+        with entries:
+            for entry in entries:
+                name = entry.name
+                if not name.isdigit():
+                    continue
+                pid = int(name)
+                seen.add(pid)
+                state = processes.get(pid)
+                if state is None:
+                    state = processes[pid] = ProcessState(pid)
+                if state.denied:
+                    continue
+                data = self._read(state)
+                if data is None:
+                    continue
+                self._update(state, data, start, fresh)
+        for pid in [pid for pid in processes if pid not in seen]:
+            self._close(processes.pop(pid))
+        self.scans += 1
+        self.lastscan = start
+        self.duration = self.clock() - start
+
+    def _update(self, state, data, now, fresh):
+        pos = data.find(READBYTES)
+        end = data.find(b'\n', pos)
+        wpos = data.find(WRITEBYTES, end)
+        wend = data.find(b'\n', wpos)
+        if pos < 0 or wpos < 0:
+            return
+        read = int(data[pos + len(READBYTES):end])
+        written = int(data[wpos + len(WRITEBYTES):wend])
+        if not fresh and state.read is not None and (read != state.read or written != state.written):
+            if state.name is None:
+                state.name = self._name(state.pid)
+            state.history.append((now, read - state.read, written - state.written))
+        state.read, state.written = read, written
+
+    def top(self, n=TOP, now=None):
+        # The 'n' processes with the most bytes read plus written in the last 'window'
+        # seconds, busiest first. Updates their readrate and writerate (bytes/s).
+        now = self.clock() if now is None else now
+        limit = now - self.window
+        busy = []
+        for state in self.processes.values():
+            history = state.history
+            if not history:
+                continue
+            while history and history[0][0] < limit:
+                del history[0]
+            if history:
+                state.readrate = sum(entry[1] for entry in history) / self.window
+                state.writerate = sum(entry[2] for entry in history) / self.window
+                busy.append(state)
+        busy.sort(key=lambda state: state.readrate + state.writerate, reverse=True)
+        return busy[:n]
+
+
+class ProcessIoOutput(Output):
+    """Scans per-process I/O while its patterns are active, off the sampling thread."""
+
+    def __init__(self, scanner=None, n=TOP, onchange=None, interval=SCANINTERVAL):
+        self.scanner = scanner or ProcessIoScanner()
+        self.n = n
+        self.onchange = onchange
+        self.interval = interval
+        self.ranking = []  # ProcessState of the top processes, busiest first
+        self._cond = threading.Condition()
+        self._pending = False
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='dsklite-procio', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.scanner.close()
+
+    def update(self, states, now):
+        # Sampling thread: only wake the scanner. After the disk went idle it keeps
+        # scanning until the last processes have aged out of the window.
+        if self.ranking or any(state.active for state in states.values()):
+            with self._cond:
+                self._pending = True
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                self._pending = False
+            self.scanner.scan()
+            ranking = self.scanner.top(self.n)
+            if [state.pid for state in ranking] != [state.pid for state in self.ranking]:
+                self.ranking = ranking
+                if self.onchange is not None:
+                    try:
+                        self.onchange(ranking)
+                    except Exception as e:
+                        # Recovery: Keep scanning, the next change calls it again.
+                        sys.stderr.write(f"Error in process I/O callback: {e}\n")
+            else:
+                self.ranking = ranking
+
+
+def formatrate(rate):
+    # Bytes per second in human units.
+    for unit in ('B', 'KB', 'MB'):
+        if rate < 1024.0:
+            return f"{rate:.0f} {unit}/s"
+        rate /= 1024.0
+    return f"{rate:.1f} GB/s"
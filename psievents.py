@@ -0,0 +1,155 @@
+"""
+Event driven wakeups from Linux PSI (pressure stall information) triggers.
+
+tryinotify.py tried to be told about changes to /proc/diskstats, but procfs
+never generates inotify events, so the daemons have to poll. Kernels with
+PSI (4.20+, CONFIG_PSI) do offer a notification: a process writes a trigger
+such as "some 10000 1000000" (10 ms of I/O stall within any 1 s window) to
+/proc/pressure/io and then poll()s that fd for POLLPRI, which the kernel
+raises when the threshold is crossed.
+
+PsiEventSource wraps such a trigger. Its sleep() is a drop in for
+time.sleep() in scheduler.AdaptivePoller: short sleeps are plain sleeps,
+long idle sleeps block on the trigger instead and return True as soon as it
+fires, so the poller can go back to fast sampling at once. Without PSI (or
+without permission to create triggers) it behaves exactly like time.sleep().
+
+Run this file directly to log trigger events, like tryinotify.py does for
+inotify events.
+"""
+
+import logging
+import os
+import select
+import sys
+import time
+
+_DEFAULT_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_LOGGER = logging.getLogger(__name__)
+PRESSUREFILE = '/proc/pressure/io'
+PSITRIGGER = 'some 10000 1000000'
+# Without CAP_SYS_RESOURCE the kernel only accepts windows that are multiples of 2 s.
+UNPRIVILEGEDTRIGGER = 'some 20000 2000000'
+MINBLOCK = 0.1  # Sleeps shorter than this are not worth a poll() on the trigger
+
+
+class PsiEventSource(object):
+    """A PSI trigger on /proc/pressure/io, with time.sleep() as the fallback."""
+
+    def __init__(self, path=PRESSUREFILE, trigger=PSITRIGGER, minblock=MINBLOCK):
+        self.path = path
+        self.trigger = trigger
+        self.minblock = minblock
+        self._fd = None
+        self._poll = None
+        self.events = 0
+
+    @property
+    def available(self):
+        return self._fd is not None
+
+    def fileno(self):
+        return self._fd
+
+    def open(self):
+        # Returns True if the trigger is armed. Failing is not an error: the
+        # kernel may not have PSI, or may refuse triggers to this user.
+        candidates = [self.trigger]
+        if self.trigger == PSITRIGGER:
+            candidates.append(UNPRIVILEGEDTRIGGER)
+        for trigger in candidates:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+            except OSError as e:
+                _LOGGER.info("PSI not available at '%s' (%s), falling back to timed polling.", self.path, e)
+                return False
+            try:
+                # The trigger string is written with its terminating NUL, as in the kernel's example.
+                os.write(fd, trigger.encode('ascii') + b'\0')
+                break
+            except OSError as e:
+                _LOGGER.info("Cannot create PSI trigger '%s' on '%s' (%s).", trigger, self.path, e)
+                os.close(fd)
+        else:
+            _LOGGER.info("No PSI trigger accepted, falling back to timed polling.")
+            return False
+        self.trigger = trigger
+        self._fd = fd
+        self._poll = select.poll()
+        self._poll.register(fd, select.POLLPRI)
+        _LOGGER.debug("PSI trigger '%s' armed on '%s'.", self.trigger, self.path)
+        return True
+
+    def close(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+            self._poll = None
+
+    def wait(self, timeout):
+        # Block for up to 'timeout' seconds. Returns True if the trigger fired.
+        if self._fd is None:
+            time.sleep(timeout)
+            return False
+        try:
+            ready = self._poll.poll(max(0, int(timeout * 1000)))
+        except InterruptedError:
+            return False
+        for fd, event in ready:
+            if event & select.POLLERR:
+                # The monitor goes away with the cgroup or on kernel errors.
+                # Recovery: Drop the trigger and continue with timed polling.
+                _LOGGER.error("PSI trigger on '%s' failed, falling back to timed polling.", self.path)
+                self.close()
+                return False
+            if event & select.POLLPRI:
+                self.events += 1
+                return True
+        return False
+
+    def sleep(self, delay):
+        # time.sleep() replacement for AdaptivePoller. Only long (idle) sleeps
+        # block on the trigger.
+        if self._fd is None or delay < self.minblock:
+            time.sleep(delay)
+            return False
+        return self.wait(delay)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def _configure_logging():
+    _LOGGER.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    formatter = logging.Formatter(_DEFAULT_LOG_FORMAT)
+    ch.setFormatter(formatter)
+    _LOGGER.addHandler(ch)
+
+
+def _main():
+    trigger = sys.argv[1] if len(sys.argv) > 1 else PSITRIGGER
+    with PsiEventSource(trigger=trigger) as source:
+        if not source.available:
+            sys.exit(1)
+        _LOGGER.info("Waiting for '%s' on %s...", source.trigger, PRESSUREFILE)
+        while source.available:
+            if source.wait(60.0):
+                _LOGGER.info("EVENT: I/O pressure crossed '%s' (%d events).", source.trigger, source.events)
+
+
+if __name__ == '__main__':
+    _configure_logging()
+    try:
+        _main()
+    except KeyboardInterrupt:
+        pass
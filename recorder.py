@@ -0,0 +1,444 @@
+"""
+Compact binary recording of diskstats sessions, and replay.
+
+When the light "was stuck on all afternoon" there is nothing to look at
+afterwards. Recorder is an engine.SamplingEngine output that appends the
+counters of every sample to a log, and Recording reads such a log back.
+
+The log is a header followed by records of one fixed size (RECORD, 76
+bytes), so record i is at HEADER.size + i * RECORD.size and a reader can
+binary search it by time through an mmap without parsing anything before:
+
+  time      uint32, in TIMEUNIT (100 us) since the start of the file
+  device    uint16, numbered per file
+  kind      uint16, NAME, KEYLOW, KEYHIGH or DELTA
+  payload   17 x 32 bit: the device name (NAME), the low or high halves of
+            the absolute counters (KEYLOW, KEYHIGH) or the signed change of
+            every counter since the previous record of the device (DELTA)
+
+A device is written as a key (NAME, KEYLOW and KEYHIGH) the first time it
+is seen in a file and again at most every KEYINTERVAL seconds, and as a
+DELTA in between. A sample whose counters did not change writes nothing,
+so an idle disk costs no I/O at all, and a busy tick costs one write() for
+all of its devices. Kernels with fewer counter columns are padded with 0.
+The file is rotated like logging.handlers.RotatingFileHandler when it
+reaches 'maxbytes' (LOG, LOG.1 ... LOG.<backups>), and every engine start
+begins a new file.
+
+Replay rebuilds the counters from a Recording, from any point in time,
+and ReplayTable writes them as a diskstats table, paced at any speed, for
+the daemons to read with --diskstats:
+
+  python3 recorder.py replay /var/log/dsklite.rec /tmp/diskstats --speed 100 &
+  python3 main.py --diskstats /tmp/diskstats --sysfs ''
+
+'detect' runs activity.ActivityDetector over a recording as fast as it can,
+for benchmarking detectors on realistic input:
+
+usage: python3 recorder.py dump|replay|detect LOG [...]
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+
+from activity import ActivityDetector
+from engine import Output
+from fixtures import rewrite
+
+MAGIC = b'dsklite\x00'
+VERSION = 1
+COUNTERS = 17  # Counter columns of kernels since 5.5; older ones are padded
+HEADER = struct.Struct('<8sHHdd')  # magic, version, counters, wall clock and monotonic time at the start
+RECORD = struct.Struct('<IHH17i')
+KEYRECORD = struct.Struct('<IHH17I')
+NAMERECORD = struct.Struct('<IHH68s')
+STAMP = struct.Struct('<I')
+NAME, KEYLOW, KEYHIGH, DELTA = 1, 2, 3, 4
+TIMEUNIT = 1e-4
+MAXTIME = 0xFFFFFFFF  # About 119 hours of TIMEUNITs, the file is rotated before
+KEYINTERVAL = 60.0  # Seconds between keys of a device, bounds how far back a seek reads
+MAXBYTES = 16 * 1024 * 1024
+BACKUPS = 3
+MININT, MAXINT = -2 ** 31, 2 ** 31 - 1
+
+
+class Recorder(Output):
+    """Engine output that appends the counters of every sample to a binary log."""
+
+    def __init__(self, path, maxbytes=MAXBYTES, backups=BACKUPS):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.backups = backups
+        self.size = 0
+        self.records = 0
+        self._fd = None
+        self._epoch = 0.0
+        self._ids = {}  # Device number of every device in the current file
+        self._last = {}  # Counters of the last record of every device, updated in place
+        self._keytime = {}  # Time of the last key of every device
+        self._deltas = [0] * COUNTERS
+        self._buf = bytearray(RECORD.size * 64)  # Records of one tick, written at once
+        self._used = 0
+
+    def start(self):
+        self._rotate()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _rotate(self):
+        # Move the current file to LOG.1 (and LOG.1 to LOG.2 ...) and start a new one.
+        self.close()
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                if self.backups > 0:
+                    for i in range(self.backups - 1, 0, -1):
+                        if os.path.exists(f"{self.path}.{i}"):
+                            os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+                    os.replace(self.path, f"{self.path}.1")
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+            self._epoch = self.engine.clock() if self.engine is not None else time.monotonic()
+            os.write(self._fd, HEADER.pack(MAGIC, VERSION, COUNTERS, time.time(), self._epoch))
+        except OSError as e:
+            # Recovery: Stop recording, sampling and the other outputs carry on.
+            sys.stderr.write(f"Error starting recording '{self.path}': {e}\n")
+            self.close()
+            return
+        self.size = HEADER.size
+        self._ids.clear()
+        self._last.clear()
+        self._keytime.clear()
+
+    def _reserve(self, records):
+        if self._used + records * RECORD.size > len(self._buf):
+            self._buf.extend(bytes(max(len(self._buf), records * RECORD.size)))
+
+    def _key(self, device, counters, stamp, now):
+        number = self._ids.get(device)
+        if number is None:
+            number = self._ids[device] = len(self._ids)
+        self._reserve(3)
+        buf, used = self._buf, self._used
+        # The name goes with every key, so a reader that starts at a key knows the device.
+        NAMERECORD.pack_into(buf, used, stamp, number, NAME, device.encode('ascii'))
+        padding = [0] * (COUNTERS - len(counters))
+        KEYRECORD.pack_into(buf, used + RECORD.size, stamp, number, KEYLOW,
+                            *[value & 0xFFFFFFFF for value in counters], *padding)
+        KEYRECORD.pack_into(buf, used + 2 * RECORD.size, stamp, number, KEYHIGH,
+                            *[value >> 32 for value in counters], *padding)
+        self._used = used + 3 * RECORD.size
+        self._last[device] = list(counters)
+        self._keytime[device] = now
+
+    def _add(self, device, counters, stamp, now):
+        last = self._last.get(device)
+        if last == counters:
+            return
+        if last is None or len(last) != len(counters) or now - self._keytime[device] >= KEYINTERVAL:
+            self._key(device, counters, stamp, now)
+            return
+        deltas = self._deltas
+        for i, value in enumerate(counters):
+            delta = value - last[i]
+            if delta < MININT or delta > MAXINT:
+                # A counter reset, e.g. the device was removed and added again.
+                self._key(device, counters, stamp, now)
+                return
+            deltas[i] = delta
+        self._reserve(1)
+        RECORD.pack_into(self._buf, self._used, stamp, self._ids[device], DELTA, *deltas)
+        self._used += RECORD.size
+        last[:] = counters
+
+    def update(self, states, now):
+        if self._fd is None:
+            return
+        stamp = int((now - self._epoch) / TIMEUNIT)
+        if stamp > MAXTIME:
+            self._rotate()
+            stamp = 0
+        detectors = self.engine.detectors
+        for state in states.values():
+            for device in state.devices:
+                detector = detectors.get(device)
+                counters = detector.counters if detector is not None else None
+                if counters is not None:
+                    # Devices shared by several patterns write once, the second time nothing changed.
+                    self._add(device, counters, stamp, now)
+        if not self._used:
+            return
+        try:
+            os.write(self._fd, memoryview(self._buf)[:self._used])
+        except OSError as e:
+            # Recovery: Stop recording, sampling and the other outputs carry on.
+            sys.stderr.write(f"Error writing recording '{self.path}': {e}\n")
+            self.close()
+            return
+        finally:
+            self.records += self._used // RECORD.size
+            self.size += self._used
+            self._used = 0
+        if self.size >= self.maxbytes:
+            self._rotate()
+
+
+class Recording(object):
+    """Read only, random access view of a Recorder log through mmap."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < HEADER.size:
+            self.close()
+            raise ValueError(f"'{path}' is not a dsklite recording")
+        magic, version, counters, self.wallclock, self.epoch = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION or counters != COUNTERS:
+            self.close()
+            raise ValueError(f"'{path}' is not a version {VERSION} dsklite recording")
+        # A partly written last record is ignored.
+        self.records = (len(self._mmap) - HEADER.size) // RECORD.size
+
+    def close(self):
+        self._mmap.close()
+
+    def __len__(self):
+        return self.records
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def time(self, index):
+        # Seconds from the start of the recording to record 'index'.
+        return STAMP.unpack_from(self._mmap, HEADER.size + index * RECORD.size)[0] * TIMEUNIT
+
+    @property
+    def duration(self):
+        return self.time(self.records - 1) if self.records else 0.0
+
+    def find(self, seconds):
+        # Index of the first record at or after 'seconds'; records are in time order.
+        low, high = 0, self.records
+        while low < high:
+            middle = (low + high) // 2
+            if self.time(middle) < seconds:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def record(self, index):
+        # (seconds, device number, kind, payload) of record 'index'.
+        offset = HEADER.size + index * RECORD.size
+        stamp, number, kind = struct.unpack_from('<IHH', self._mmap, offset)
+        if kind == NAME:
+            payload = NAMERECORD.unpack_from(self._mmap, offset)[3].rstrip(b'\x00').decode('ascii')
+        elif kind == DELTA:
+            payload = RECORD.unpack_from(self._mmap, offset)[3:]
+        else:
+            payload = KEYRECORD.unpack_from(self._mmap, offset)[3:]
+        return stamp * TIMEUNIT, number, kind, payload
+
+
+class Replay(object):
+    """Counters of every device of a Recording, rebuilt up to a point in time."""
+
+    def __init__(self, recording, start=0.0):
+        self.recording = recording
+        self.counters = {}  # Current counters, keyed by device name
+        self._names = {}
+        self._low = {}  # KEYLOW halves waiting for their KEYHIGH
+        # Every device that changes after 'start' has a key at most KEYINTERVAL before its
+        # first change, and that change is at most KEYINTERVAL after the key before.
+        self.index = recording.find(start - 2 * KEYINTERVAL)
+        self.advance(start)
+        self.time = start
+
+    @property
+    def done(self):
+        return self.index >= self.recording.records
+
+    def step(self):
+        # Apply the next record. Returns the name of the device whose counters changed,
+        # or None.
+        seconds, number, kind, payload = self.recording.record(self.index)
+        self.index += 1
+        self.time = seconds
+        if kind == NAME:
+            self._names[number] = payload
+            return None
+        name = self._names.get(number)
+        if name is None:
+            return None
+        if kind == KEYLOW:
+            self._low[number] = payload
+        elif kind == KEYHIGH:
+            low = self._low.pop(number, None)
+            if low is not None:
+                self.counters[name] = [high << 32 | value for high, value in zip(payload, low)]
+                return name
+        elif kind == DELTA:
+            counters = self.counters.get(name)
+            if counters is not None:
+                for i, delta in enumerate(payload):
+                    counters[i] += delta
+                return name
+        return None
+
+    def advance(self, seconds):
+        # Apply every record up to 'seconds'. Returns the number of device changes.
+        changed = 0
+        recording = self.recording
+        while self.index < recording.records and recording.time(self.index) <= seconds:
+            if self.step() is not None:
+                changed += 1
+        self.time = seconds
+        return changed
+
+
+class ReplaySampler(object):
+    """Sampler interface (refresh() and counters()) over one device of a Replay."""
+
+    def __init__(self, replay, device):
+        self.replay = replay
+        self.device = device
+
+    def refresh(self):
+        return self.device in self.replay.counters
+
+    def counters(self, out=None):
+        counters = self.replay.counters.get(self.device)
+        if counters is None:
+            return None
+        if out is None:
+            out = []
+        out[:] = counters
+        return out
+
+    def close(self):
+        pass
+
+
+class ReplayTable(object):
+    """Writes the counters of a Replay as a diskstats table, in place."""
+
+    def __init__(self, replay, path):
+        self.replay = replay
+        self.path = path
+        self.writes = 0
+
+    def write(self):
+        lines = []
+        for minor, (name, counters) in enumerate(sorted(self.replay.counters.items())):
+            lines.append(f"   0 {minor:7d} {name} " + ' '.join(map(str, counters)) + '\n')
+        rewrite(self.path, ''.join(lines).encode('ascii'))
+        self.writes += 1
+
+    def run(self, speed=1.0, step=None):
+        # Play the recording from the replay's current time to the end, 'speed' times
+        # faster than it was recorded. The table is rewritten when a device changed,
+        # at most every 'step' seconds of recording (default: a quarter of a blink).
+        replay = self.replay
+        step = step if step is not None else 0.065 / 4.0
+        begin = time.monotonic()
+        origin = replay.time
+        self.write()
+        while not replay.done:
+            target = max(replay.recording.time(replay.index), replay.time + step)
+            delay = begin + (target - origin) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if replay.advance(target):
+                self.write()
+
+
+def dump(path):
+    with Recording(path) as recording:
+        started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(recording.wallclock))
+        print(f"{path}: started {started}, {recording.duration:.1f} s, {len(recording)} records")
+        low = {}  # KEYLOW record waiting for its KEYHIGH, keyed by device number
+        for index in range(len(recording)):
+            seconds, number, kind, payload = recording.record(index)
+            if kind != KEYHIGH and number in low:
+                # A key cut short, e.g. by a crash between the two halves.
+                print(f"{low[number][0]:12.4f} {number:5d} keylow " + ' '.join(map(str, low.pop(number)[1])))
+            if kind == NAME:
+                print(f"{seconds:12.4f} {number:5d} name {payload}")
+            elif kind == KEYLOW:
+                low[number] = (seconds, payload)
+            elif kind == KEYHIGH:
+                if number in low:
+                    # The absolute counters, from both halves.
+                    counters = [high << 32 | value for high, value in zip(payload, low.pop(number)[1])]
+                    print(f"{seconds:12.4f} {number:5d} key " + ' '.join(map(str, counters)))
+                else:
+                    print(f"{seconds:12.4f} {number:5d} keyhigh " + ' '.join(map(str, payload)))
+            elif kind == DELTA:
+                print(f"{seconds:12.4f} {number:5d} delta " + ' '.join(map(str, payload)))
+        for number, (seconds, payload) in sorted(low.items()):
+            print(f"{seconds:12.4f} {number:5d} keylow " + ' '.join(map(str, payload)))
+
+
+def detect(path):
+    # Run an ActivityDetector per device over every recorded change, as fast as possible.
+    with Recording(path) as recording:
+        replay = Replay(recording)
+        detectors = {}
+        active = 0
+        start = time.perf_counter()
+        while not replay.done:
+            device = replay.step()
+            if device is None:
+                continue
+            detector = detectors.get(device)
+            if detector is None:
+                detector = detectors[device] = ActivityDetector(ReplaySampler(replay, device))
+            if detector.sample():
+                active += 1
+        elapsed = time.perf_counter() - start
+        samples = sum(detector.samples for detector in detectors.values())
+        print(f"{len(recording)} records, {samples} samples of {len(detectors)} devices, {active} active "
+              f"in {elapsed:.3f} s ({elapsed / max(1, samples) * 1e6:.2f} us per sample, replay included)")
+        for device, detector in sorted(detectors.items()):
+            print(f"  {device}: {detector.active} active of {detector.samples}, "
+                  f"{detector.missed} seen only by counter deltas")
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Inspect and replay dsklite recordings.')
+    parser.add_argument('command', choices=('dump', 'replay', 'detect'))
+    parser.add_argument('log')
+    parser.add_argument('diskstats', nargs='?', help='replay: diskstats file to write')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay: times faster than recorded')
+    parser.add_argument('--start', type=float, default=0.0, metavar='SECONDS',
+                        help='replay: seconds into the recording to start at')
+    args = parser.parse_args()
+    try:
+        if args.command == 'dump':
+            dump(args.log)
+        elif args.command == 'detect':
+            detect(args.log)
+        else:
+            if args.diskstats is None:
+                parser.error('replay needs the diskstats file to write')
+            with Recording(args.log) as recording:
+                ReplayTable(Replay(recording, args.start), args.diskstats).run(args.speed)
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"Error: {e}\n")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    run()
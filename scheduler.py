@@ -0,0 +1,184 @@
+"""
+Single thread blink scheduler and adaptive sample pacing.
+
+The original design cancelled and restarted a threading.Timer on every
+active sample, which creates a new OS thread up to 60 times a second under
+sustained I/O and lets the sampler and timer threads race on a shared
+global. BlinkScheduler instead runs one long lived thread that owns the
+output state and a single "turn off at time T" deadline on the monotonic
+clock.
+
+trigger() is called by the sampler on activity. It only moves the deadline
+and, when the output is currently off, wakes the scheduler thread to turn
+it on. While the output is already on, extending the deadline does not
+wake the thread at all; it notices the new deadline when the old one
+expires and goes back to sleep.
+
+AdaptivePoller paces the sampling loop. It starts at the fast rate, backs
+off geometrically towards an idle interval while nothing changes, and
+snaps back to the fast rate on the first sample that shows activity. Sleeps
+are taken until absolute deadlines on the monotonic clock so the cadence
+does not drift with the time spent sampling. The sleep function can be
+replaced by one that returns True when it was woken early by an event, such
+as psievents.PsiEventSource.sleep; the poller then restarts its schedule
+from the wakeup at the fast rate.
+"""
+
+import sys
+import threading
+import time
+
+IDLEINTERVAL = 1.0
+BACKOFF = 1.5
+LATEOFF = 0.005  # An LED turned off this long after its deadline counts as late
+
+
+class BlinkScheduler(object):
+    """Owns an on/off output and turns it off 'duration' after the last trigger."""
+
+    def __init__(self, duration, on, off, clock=time.monotonic):
+        self.duration = duration
+        self.on = on
+        self.off = off
+        self.clock = clock
+        self._cond = threading.Condition()
+        self._deadline = 0.0
+        self._lit = False
+        self._pending = False
+        self._stopped = False
+        self._thread = None
+        self.blinks = 0
+        self.late = 0  # Turned off more than LATEOFF after the deadline
+
+    def start(self):
+        # Must be called after any fork(), threads do not survive it.
+        if self._thread is None:
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name='dsklite-blink', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def lit(self):
+        return self._lit
+
+    def trigger(self):
+        # Called from the sampler on activity. Keeps the output on until
+        # 'duration' after this call.
+        with self._cond:
+            self._deadline = self.clock() + self.duration
+            if not self._lit and not self._pending:
+                self._pending = True
+                self._cond.notify()
+
+    def _next_action(self):
+        # Block until there is something to do, and update the state for it.
+        # Runs with the condition held.
+        cond = self._cond
+        while True:
+            if self._stopped:
+                if self._lit:
+                    self._lit = False
+                    return self.off
+                return None
+            if self._pending:
+                self._pending = False
+                self._lit = True
+                self.blinks += 1
+                return self.on
+            if self._lit:
+                remaining = self._deadline - self.clock()
+                if remaining <= 0:
+                    if remaining < -LATEOFF:
+                        self.late += 1
+                    self._lit = False
+                    return self.off
+                cond.wait(remaining)
+            else:
+                cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                action = self._next_action()
+            if action is None:
+                return
+            # The output callbacks run without the lock held so that a slow
+            # sysfs or tray update never blocks the sampler in trigger().
+            try:
+                action()
+            except Exception as e:
+                # Log error if an output callback fails.
+                # Recovery: Keep the scheduler running, the next transition retries the output.
+                sys.stderr.write(f"Error in blink scheduler callback: {e}\n")
+
+
+class AdaptivePoller(object):
+    """Deadline based sleep whose interval backs off while the disk is idle."""
+
+    def __init__(self, fast, idle=IDLEINTERVAL, backoff=BACKOFF, clock=time.monotonic, sleep=time.sleep):
+        self.fast = fast
+        self.idle = max(idle, fast)
+        self.backoff = backoff
+        self.clock = clock
+        self._sleep = sleep
+        self.interval = fast
+        self._deadline = clock()
+        self.wakeups = 0
+        # Wakeup rate, recomputed about once a second.
+        self._window_start = self._deadline
+        self._window_wakeups = 0
+        self._rate = 0.0
+        self.stats = None  # selfstats.LoopStats that records the wakeup jitter, if any
+
+    def update(self, active):
+        # Record the outcome of the last sample and choose the next interval.
+        if active:
+            self.interval = self.fast
+        elif self.interval < self.idle:
+            self.interval = min(self.interval * self.backoff, self.idle)
+        return self.interval
+
+    def sleep(self):
+        # Sleep until one interval after the previous deadline. If the loop
+        # fell a whole interval behind (e.g. after a suspend) the schedule is
+        # restarted from now instead of firing a burst of catch-up samples.
+        now = self.clock()
+        self._deadline += self.interval
+        if self._deadline < now - self.interval:
+            self._deadline = now
+        delay = self._deadline - now
+        if delay > 0 and self._sleep(delay):
+            self.interval = self.fast
+            self._deadline = self.clock()
+        elif self.stats is not None:
+            self.stats.wakeup(self.clock() - self._deadline)
+        self.record()
+
+    def record(self):
+        # Count a wakeup. sleep() does this itself; event loops that only use
+        # update() and do the sleeping call it once per sample.
+        self.wakeups += 1
+        self._window_wakeups += 1
+        now = self.clock()
+        elapsed = now - self._window_start
+        if elapsed >= 1.0:
+            self._rate = self._window_wakeups / elapsed
+            self._window_start = now
+            self._window_wakeups = 0
+
+    def wait(self, active):
+        self.update(active)
+        self.sleep()
+
+    @property
+    def wakeups_per_second(self):
+        return self._rate
@@ -0,0 +1,240 @@
+"""
+What the daemon costs: wakeup jitter, CPU per tick, LED writes, late blinks.
+
+dsklite runs on many machines and should be measurable without a profiler.
+LoopStats collects, on the hot path, only what is cheap to collect:
+
+  - Wakeup jitter: how late each sample ran against the deadline the
+    poller asked for (BLINKRATE / 4.0 while busy, longer when backed off),
+    recorded by scheduler.AdaptivePoller.sleep() and by the asyncio
+    runtime's timer callback.
+  - CPU time per tick: time.thread_time_ns() around engine.SamplingEngine
+    .tick(), which covers the kernel reads, the activity detection and the
+    outputs updated in that tick.
+
+Both go into a Histogram, an HdrHistogram style log-linear array of
+counters: a few integer operations and one array increment per value, no
+allocation, no lock. Everything else is read from counters the code
+already keeps, and only when somebody asks for a report: sysfs writes from
+the LedDriver / LedTrigger 'writes' counters, late LED-off deadlines from
+the 'late' counter of every blink scheduler of the engine's outputs.
+
+The report is printed on SIGUSR1 (main.py) or written to every client of
+a StatsSocket, a UNIX socket whose listening thread sleeps in accept(), so
+collection costs nothing more while nobody reads:
+
+  python3 -c "import socket; s = socket.socket(socket.AF_UNIX); s.connect('/run/dsklite.sock'); print(s.makefile().read())"
+"""
+
+import array
+import os
+import socket
+import sys
+import threading
+import time
+
+SUBBITS = 4  # Significant bits per value: the buckets are at most 1/8 wide (12.5 %)
+MAXBITS = 40  # Values up to 2**40 ns, about 18 minutes, land in the last bucket
+PERCENTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Histogram(object):
+    """Log-linear histogram of non-negative integers, e.g. nanoseconds."""
+
+    _half = 1 << (SUBBITS - 1)
+
+    def __init__(self, name, unit=1e-6, suffix='ms'):
+        # 'unit' converts a recorded value to the reported one, ns to ms by default.
+        self.name = name
+        self.unit = unit
+        self.suffix = suffix
+        self.counts = array.array('Q', bytes(8 * self._index(1 << MAXBITS) + 8))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @classmethod
+    def _index(cls, value):
+        # Values below 2**SUBBITS get a bucket each; above that each power of two is
+        # split into 2**(SUBBITS - 1) buckets of equal width.
+        shift = value.bit_length() - SUBBITS
+        if shift <= 0:
+            return value
+        return (shift + 1) * cls._half + (value >> shift) - cls._half
+
+    @classmethod
+    def _lowest(cls, index):
+        # Smallest value that lands in bucket 'index'.
+        if index < 2 * cls._half:
+            return index
+        shift = index // cls._half - 1
+        return (index - shift * cls._half) << shift
+
+    def record(self, value):
+        # _index() inlined, this runs on every tick.
+        if value < 0:
+            value = 0
+        shift = value.bit_length() - SUBBITS
+        index = value if shift <= 0 else (shift + 1) * self._half + (value >> shift) - self._half
+        counts = self.counts
+        if index >= len(counts):
+            index = len(counts) - 1
+        counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = self.total = self.max = 0
+
+    def percentile(self, fraction):
+        # Upper edge of the bucket holding the value at 'fraction', capped at the maximum.
+        if not self.count:
+            return 0
+        rank = max(1, int(fraction * self.count + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._lowest(index + 1) - 1, self.max)
+        return self.max
+
+    def buckets(self):
+        # (lowest, highest, count) of every bucket with values in it.
+        return [(self._lowest(index), self._lowest(index + 1) - 1, count)
+                for index, count in enumerate(self.counts) if count]
+
+    def format(self, buckets=False):
+        if not self.count:
+            return f"{self.name}: no samples"
+        unit = self.unit
+        parts = [f"p{fraction * 100:g} {self.percentile(fraction) * unit:.3f}" for fraction in PERCENTILES]
+        text = (f"{self.name}: mean {self.total / self.count * unit:.3f} " + ' '.join(parts) +
+                f" max {self.max * unit:.3f} {self.suffix} ({self.count} samples)")
+        if buckets:
+            text += ''.join(f"\n  {low * unit:10.3f} - {high * unit:10.3f} {self.suffix} {count:10d}"
+                            for low, high, count in self.buckets())
+        return text
+
+
+class LoopStats(object):
+    """Self-instrumentation of one sampling loop."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.jitter = Histogram('wakeup jitter')
+        self.cpu = Histogram('CPU per tick')
+        self.writers = []  # Objects with a 'writes' counter, e.g. LedDriver
+        self.blinkers = []  # Objects with 'late' and 'blinks' counters, e.g. BlinkScheduler
+        self._lastreport = self.started
+        self._lastwrites = 0
+
+    def wakeup(self, lateness):
+        # Seconds between the deadline a sleep was meant to end at and the wakeup.
+        self.jitter.record(int(lateness * 1e9))
+
+    def watch(self, writer):
+        if writer is not None and writer not in self.writers:
+            self.writers.append(writer)
+        return writer
+
+    def writes(self):
+        return sum(writer.writes for writer in self.writers)
+
+    def report(self, engine=None, buckets=False):
+        # Text of the report. Also collects the blink schedulers of 'engine's outputs.
+        now = self.clock()
+        blinkers = list(self.blinkers)
+        if engine is not None:
+            for output in engine.outputs:
+                blinker = getattr(output, 'blinker', None)
+                if blinker is not None and blinker not in blinkers:
+                    blinkers.append(blinker)
+        writes = self.writes()
+        uptime = now - self.started
+        since = now - self._lastreport
+        lines = [f"up {uptime:.1f} s" + (f", {engine.ticks} ticks" if engine is not None else ''),
+                 self.jitter.format(buckets), self.cpu.format(buckets),
+                 f"sysfs writes: {(writes - self._lastwrites) / since if since > 0 else 0.0:.2f}/s since "
+                 f"the last report, {writes / uptime if uptime > 0 else 0.0:.2f}/s overall, {writes} total"]
+        if blinkers:
+            late = sum(getattr(blinker, 'late', 0) for blinker in blinkers)
+            blinks = sum(blinker.blinks for blinker in blinkers)
+            lines.append(f"LED off late: {late} of {blinks} blinks")
+        self._lastreport = now
+        self._lastwrites = writes
+        return '\n'.join(lines) + '\n'
+
+
+class StatsSocket(object):
+    """UNIX socket that writes a LoopStats report to every client that connects."""
+
+    def __init__(self, path, report):
+        # 'report' is a callable returning the text to send.
+        self.path = path
+        self.report = report
+        self._sock = None
+        self._thread = None
+
+    def fileno(self):
+        return self._sock.fileno() if self._sock is not None else None
+
+    def open(self):
+        # Returns False if the socket cannot be created, e.g. in a directory of root's.
+        try:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self.path)
+            os.chmod(self.path, 0o600)
+            sock.listen(4)
+        except OSError as e:
+            # Recovery: Run without the socket, SIGUSR1 still prints the report.
+            sys.stderr.write(f"Error creating stats socket '{self.path}': {e}\n")
+            return False
+        self._sock = sock
+        return True
+
+    def start(self):
+        # Serve from a thread that sleeps in accept(). Event loops add fileno() as a
+        # reader and call serve() instead.
+        if self._sock is not None and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='dsklite-stats', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while self._sock is not None:
+            if not self.serve():
+                return
+
+    def serve(self):
+        # Accept one client and send it a report. Returns False once the socket is closed.
+        try:
+            client, _ = self._sock.accept()
+        except (OSError, AttributeError):
+            return self._sock is not None
+        try:
+            with client:
+                client.sendall(self.report().encode('utf-8'))
+        except OSError as e:
+            # Recovery: Drop the client, the next one gets a fresh report.
+            sys.stderr.write(f"Error writing to stats socket client: {e}\n")
+        return True
+
+    def close(self):
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
@@ -1,13 +1,199 @@
+"""
+Disk activity light as an AppIndicator, driven entirely by the GTK main loop.
+
+pystray (main_stray.py) runs its own thread for the tray, another for the
+sampler and one per blink scheduler, and every icon change sends a freshly
+encoded image to the tray host. This backend does the same job in the one
+thread that runs gtk.main():
+
+  - Sampling runs from GLib.timeout_add(), which calls the tick() of an
+    engine.SamplingEngine, paced by its AdaptivePoller (only update() is
+    used, the main loop does the sleeping).
+  - The blink deadline is another main loop timeout instead of a thread.
+  - When a PSI trigger on /proc/pressure/io can be armed, its fd is a GLib
+    source (POLLPRI), so an idle indicator sleeps for PSIIDLEINTERVAL and is
+    woken by I/O pressure.
+  - Icons are PNG files written once at startup into a private directory
+    that is added to the indicator's icon theme path. Switching the icon
+    only sends its name over D-Bus. Without PIL the themed icon names
+    ONICON and OFFICON are used instead.
+
+Send SIGUSR1 to print the icon updates and the process CPU time used, to
+compare with main_stray.py.
+
+usage: python3 simplegtkapp.py [PATTERN ...]
+"""
+
+import argparse
+import os
+import resource
+import signal
+import sys
+import tempfile
+import time
+
+import gi
+gi.require_version('Gtk', '3.0')
+gi.require_version('AppIndicator3', '0.1')
+from gi.repository import GLib
 from gi.repository import Gtk as gtk
 from gi.repository import AppIndicator3 as appindicator
 
-APPINDICATOR_ID = 'myappindicator'
+from engine import SamplingEngine, Output
+from psievents import PsiEventSource
+
+try:
+    from PIL import Image
+    from trayicon import IconCache
+except ImportError:
+    Image = None
+
+APPINDICATOR_ID = 'dsklite'
+STATSFILE = '/proc/diskstats'
+BLINKRATE = 0.065
+DEVICE = 'sda'
+IDLEINTERVAL = 1.0 # Longest sleep between samples once the disk has been idle for a while
+PSIIDLEINTERVAL = 10.0 # The same when the PSI trigger can wake the main loop
+ICONWIDTH = 32
+ICONHEIGHT = 32
+ONCOLOUR = '#FF0000'
+OFFCOLOUR = '#000000'
+ONICON = 'media-record' # Themed icons used when PIL is not available
+OFFICON = 'drive-harddisk'
+
+
+class IndicatorBackend(Output):
+    """Engine output that switches the indicator icon, driven by GLib sources."""
+
+    def __init__(self, patterns, indicator, icons):
+        self.indicator = indicator
+        self.icons = icons # Icon name of the off and on states
+        self.psi = PsiEventSource()
+        self.engine = SamplingEngine(STATSFILE, BLINKRATE / 4.0, IDLEINTERVAL)
+        self.engine.add(self, patterns)
+        self._tick = None # Source id of the next sample
+        self._blink = None # Source id of the blink deadline check
+        self._deadline = 0.0
+        self._lit = None
+        self.pushed = 0
+        self.suppressed = 0
+
+    def start(self):
+        # Called by the engine when it starts.
+        self.show(False)
+
+    def run(self):
+        if self.psi.open():
+            self.engine.poller.idle = PSIIDLEINTERVAL
+            GLib.unix_fd_add_full(GLib.PRIORITY_DEFAULT, self.psi.fileno(),
+                                  GLib.IOCondition.PRI | GLib.IOCondition.ERR, self._pressure)
+        self.engine.start()
+        self._schedule(0)
+
+    def show(self, on):
+        # Only a change of state is sent to the indicator.
+        if on is self._lit:
+            self.suppressed += 1
+            return
+        self._lit = on
+        self.indicator.set_icon_full(self.icons[on], 'Disk activity' if on else 'Disk idle')
+        self.pushed += 1
+
+    def update(self, states, now):
+        for state in states.values():
+            if state.active:
+                self._deadline = now + BLINKRATE
+                self.show(True)
+                if self._blink is None:
+                    self._blink = GLib.timeout_add(int(BLINKRATE * 1000), self._expire)
+                return
+
+    def _schedule(self, interval):
+        self._tick = GLib.timeout_add(int(interval * 1000), self._sample)
+
+    def _sample(self):
+        # Timeout callback: take a sample and schedule the next one at the paced interval.
+        self._schedule(self.engine.poller.update(self.engine.tick()))
+        self.engine.poller.record()
+        return False
+
+    def _expire(self):
+        # Blink deadline: turn the icon off unless a later sample moved the deadline.
+        remaining = self._deadline - time.monotonic()
+        if remaining > 0:
+            self._blink = GLib.timeout_add(max(1, int(remaining * 1000)), self._expire)
+            return False
+        self._blink = None
+        self.show(False)
+        return False
+
+    def _pressure(self, fd, condition):
+        # PSI trigger fired: sample now and go back to the fast rate.
+        if condition & GLib.IOCondition.ERR:
+            # Recovery: Drop the trigger, the idle interval stays as it was and sampling continues.
+            sys.stderr.write("Error: PSI trigger failed, continuing with timed polling.\n")
+            self.psi.close()
+            return False
+        self.psi.events += 1
+        if self._tick is not None:
+            GLib.source_remove(self._tick)
+        self.engine.poller.update(True)
+        self._sample()
+        return True
+
+    def report(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        sys.stderr.write(f"dsklite: {self.pushed} icon updates pushed, {self.suppressed} suppressed, "
+                         f"{usage.ru_utime + usage.ru_stime:.2f} s CPU, "
+                         f"{self.psi.events} PSI wakeups\n")
+        return True
+
+
+def create_icons(directory):
+    # Write the icon of each state once and return their names, which the indicator
+    # looks up in 'directory'. Falls back to themed icons without PIL.
+    if Image is None:
+        return (OFFICON, ONICON)
+    cache = IconCache({False: Image.new('RGB', (ICONWIDTH, ICONHEIGHT), OFFCOLOUR),
+                       True: Image.new('RGB', (ICONWIDTH, ICONHEIGHT), ONCOLOUR)})
+    names = []
+    for state in (False, True):
+        name = f"{APPINDICATOR_ID}-{'on' if state else 'off'}"
+        with open(os.path.join(directory, name + '.png'), 'wb') as f:
+            f.write(cache.png(state))
+        names.append(name)
+    return tuple(names)
+
 
 def main():
-    indicator = appindicator.Indicator.new(APPINDICATOR_ID, 'whatever', appindicator.IndicatorCategory.SYSTEM_SERVICES)
-    indicator.set_status(appindicator.IndicatorStatus.ACTIVE)
-    indicator.set_menu(gtk.Menu())
-    gtk.main()
+    parser = argparse.ArgumentParser(description='Drive activity light as an AppIndicator.')
+    parser.add_argument('devices', nargs='*', default=[DEVICE], metavar='PATTERN',
+                        help=f"device name or glob such as 'nvme*n1' (default: {DEVICE})")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='dsklite-') as icondir:
+        try:
+            icons = create_icons(icondir)
+        except Exception as e:
+            # Recovery: Use the themed icons, which need nothing written to disk.
+            sys.stderr.write(f"Error creating icon files in '{icondir}': {e}\n")
+            icons = (OFFICON, ONICON)
+        indicator = appindicator.Indicator.new(APPINDICATOR_ID, icons[0],
+                                               appindicator.IndicatorCategory.HARDWARE)
+        indicator.set_icon_theme_path(icondir)
+        indicator.set_status(appindicator.IndicatorStatus.ACTIVE)
+        menu = gtk.Menu()
+        item = gtk.MenuItem(label='Quit')
+        item.connect('activate', lambda widget: gtk.main_quit())
+        menu.append(item)
+        menu.show_all()
+        indicator.set_menu(menu)
+
+        backend = IndicatorBackend(args.devices, indicator, icons)
+        backend.run()
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, backend.report)
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGINT, gtk.main_quit)
+        gtk.main()
 
 if __name__ == "__main__":
     main()
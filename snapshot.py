@@ -0,0 +1,329 @@
+"""
+NumPy snapshots of every device and every counter in /proc/diskstats.
+
+snapshot() parses the whole table into a preallocated 2D int64 array with
+one row per device and one column per counter, starting with 'reads
+completed' (diskstats.READS). Kernels differ in how many counters they
+print: 11 up to 4.18, 15 with the discard counters, 17 with the flush
+counters from 5.5 on. The array is always NFIELDS wide and columns a
+kernel does not provide stay 0; 'columns' tells how many were seen.
+
+The row of a device is stable: it is assigned when the device first shows
+up and kept for the life of the Snapshotter, so rows of two snapshots can
+be subtracted directly. Devices that disappear keep their row (with the
+last values seen) and new devices are appended. Every snapshot compares
+the name column with the one the index was built from (the first NAMEBYTES
+bytes of every name, gathered in one numpy.take()), and the index is
+rebuilt when a line was added or removed or one device took the place of
+another. Given a devwatch.DeviceWatcher, a hotplug event rebuilds it too.
+
+The numbers are converted with a handful of whole-buffer vectorized
+operations over the bytes read by diskstats.DiskStatsTable. Every one of
+them writes into scratch arrays that are sized to the table and reused
+between samples (out=, numpy.take(out=), numpy.cumsum(out=)), and the
+positions of the True elements of a mask are stored at their rank with
+one index assignment instead of numpy.flatnonzero(), so a sample
+allocates nothing that grows with the number of rows (bench_suite.py
+reports the peak bytes per sample).
+Each Snapshotter alternates between two result arrays: the array returned
+by snapshot() stays valid until the next-but-one call, which is what
+rates(prev, cur, dt) needs.
+"""
+
+import time
+
+import numpy
+
+from diskstats import DiskStatsTable, STATSFILE, DEVICENAME, FIRSTCOUNTER, IOINPROGRESS
+
+NFIELDS = 17  # Counters per device on current kernels
+INFLIGHT = IOINPROGRESS - FIRSTCOUNTER  # Column of the only gauge, all others are counters
+INITIALROWS = 256
+NAMEBYTES = 32  # DISK_NAME_LEN, the kernel's limit on the length of a device name
+
+
+class Snapshotter(object):
+    """Parses /proc/diskstats into reused (devices, NFIELDS) int64 arrays."""
+
+    def __init__(self, path=STATSFILE, table=None, watcher=None):
+        self.table = DiskStatsTable(path) if table is None else table
+        self.watcher = watcher if watcher is not None and watcher.available else None
+        self.devices = []  # Device name of every row, in row order
+        self.index = {}  # Device name -> row
+        self.columns = 0
+        self._results = [numpy.zeros((INITIALROWS, NFIELDS), numpy.int64) for _ in range(2)]
+        self._which = 0
+        self._lines = -1
+        self._rowof = numpy.zeros(0, numpy.intp)  # Row of every line of the table
+        self._names = numpy.zeros((0, NAMEBYTES), numpy.uint8)  # Name column the index is built from
+        self._scratchsize = 0
+        self._namesize = -1
+        self.time = None  # time.monotonic() of the last snapshot
+
+    def _scratch(self, n):
+        # Work arrays, grown with the table and reused otherwise: per byte, and per
+        # token (a token takes at least one byte and a separator, so at most half).
+        if n > self._scratchsize:
+            size = max(n, 2 * self._scratchsize)
+            tokens = size // 2 + 2
+            self._sep = numpy.empty(size + 1, bool)
+            self._newline = numpy.empty(size, bool)
+            self._mask = numpy.empty(size, bool)
+            self._flags = numpy.empty(size, numpy.int64)
+            self._rank = numpy.empty(size, numpy.int64)
+            self._linecum = numpy.empty(size, numpy.int64)
+            self._pos = numpy.arange(size, dtype=numpy.int64)
+            # Index arrays filled by _nonzero() have a spare last slot.
+            self._starts = numpy.empty(tokens + 1, numpy.int64)
+            self._counter = numpy.empty(tokens + 1, numpy.int64)
+            self._first = numpy.empty(tokens + 1, numpy.int64)  # Per line, plus one
+            self._line = numpy.empty(tokens, numpy.int64)
+            self._column = numpy.empty(tokens, numpy.int64)
+            self._index = numpy.empty(tokens, numpy.int64)
+            self._values = numpy.empty(tokens, numpy.int64)
+            self._digit = numpy.empty(tokens, numpy.int64)
+            self._scale = numpy.empty(tokens, numpy.int64)
+            self._bytes = numpy.empty(tokens, numpy.uint8)
+            self._tokenmask = numpy.empty(tokens, bool)
+            self._more = numpy.empty(tokens, bool)
+            self._scratchsize = size
+
+    def _namescratch(self, lines):
+        # Work arrays of the name check, one NAMEBYTES row per line. The line and the
+        # byte of every cell are precomputed, broadcasting would allocate buffers.
+        if lines > self._namesize:
+            size = max(lines, 2 * self._namesize)
+            self._nametoken = numpy.empty(size + 1, numpy.int64)
+            self._namestart = numpy.empty(size, numpy.int64)
+            self._nameline = numpy.repeat(numpy.arange(size, dtype=numpy.int64), NAMEBYTES).reshape(size, NAMEBYTES)
+            self._namepos = numpy.tile(numpy.arange(NAMEBYTES, dtype=numpy.int64), (size, 1))
+            self._namegrid = numpy.empty((size, NAMEBYTES), numpy.int64)
+            self._namelimit = numpy.empty((size, NAMEBYTES), numpy.int64)
+            self._namebytes = numpy.empty((size, NAMEBYTES), numpy.uint8)
+            self._nameend = numpy.empty((size, NAMEBYTES), bool)
+            self._namesize = size
+
+    def _namecolumn(self, b, starts, column, lines):
+        # The first NAMEBYTES bytes of the name of every line. Bytes past the end of
+        # a name are read from the separator after it, so that the counters that
+        # follow a short name do not count.
+        self._namescratch(lines)
+        mask = self._tokenmask[:len(column)]
+        numpy.equal(column, DEVICENAME - FIRSTCOUNTER, out=mask)
+        token = self._nonzero(mask, self._nametoken)
+        count = len(token)
+        namestart = self._namestart[:count]
+        numpy.take(starts, token, out=namestart, mode='clip')
+        line = self._nameline[:count]
+        grid = self._namegrid[:count]
+        numpy.take(namestart, line, out=grid, mode='clip')
+        grid += self._namepos[:count]
+        # The separator: the byte before the next token, a name is never last on its line.
+        token += 1
+        numpy.take(starts, token, out=namestart, mode='clip')
+        namestart -= 1
+        limit = self._namelimit[:count]
+        numpy.take(namestart, line, out=limit, mode='clip')
+        numpy.minimum(grid, limit, out=grid)
+        names = self._namebytes[:count]
+        numpy.take(b, grid, out=names, mode='clip')
+        return names
+
+    def _renamed(self, names):
+        # True when 'names' is not the name column the index was built from.
+        if names.shape != self._names.shape:
+            return True
+        end = self._nameend[:len(names)]
+        numpy.not_equal(names, self._names, out=end)
+        return bool(end.any())
+
+    def _cumsum(self, mask, out):
+        # Running count of the True elements of 'mask', into the int64 array 'out'.
+        # Casting first keeps numpy.cumsum() from allocating a cast copy of 'mask'.
+        numpy.copyto(out, mask)
+        numpy.cumsum(out, out=out)
+        return out
+
+    def _nonzero(self, mask, out):
+        # numpy.flatnonzero(mask) into 'out' without allocating: the position of every
+        # True element is stored at its rank, the others all at index -1, the spare
+        # last slot of 'out'.
+        m = len(mask)
+        if not m:
+            return out[:0]
+        flags = self._flags[:m]
+        numpy.copyto(flags, mask)
+        rank = self._rank[:m]
+        numpy.cumsum(flags, out=rank)
+        count = int(rank[m - 1])
+        rank *= flags
+        rank -= 1
+        out[rank] = self._pos[:m]
+        return out[:count]
+
+    def reindex(self):
+        # Map every line of the current table to a stable row. Only runs when
+        # the name column changes, when the watcher reports a hotplug event, or
+        # when called explicitly.
+        names = self.table.names()
+        rows = []
+        for name in names:
+            row = self.index.get(name)
+            if row is None:
+                row = self.index[name] = len(self.devices)
+                self.devices.append(name)
+            rows.append(row)
+        self._rowof = numpy.array(rows, numpy.intp)
+        self._lines = len(names)
+        for which, result in enumerate(self._results):
+            if len(result) < len(self.devices):
+                grown = numpy.zeros((max(len(self.devices), 2 * len(result)), NFIELDS), numpy.int64)
+                grown[:len(result)] = result
+                self._results[which] = grown
+
+    def snapshot(self):
+        # Read the table once and return a (len(devices), NFIELDS) view.
+        # Returns None if the table could not be read.
+        if not self.table.refresh():
+            return None
+        n = self.table.len
+        if not n:
+            if self._lines:
+                self.reindex()
+                self._names = self._names[:0]
+            return None
+        b = numpy.frombuffer(self.table.buf, numpy.uint8, count=n)
+        self._scratch(n)
+        newline = self._newline[:n]
+        numpy.equal(b, 10, out=newline)
+        linecum = self._cumsum(newline, self._linecum[:n])
+        lines = int(linecum[n - 1])
+        changed = self.watcher is not None and self.watcher.changed()
+        if not lines:
+            return None
+
+        # sep[i] is True when byte i - 1 separates tokens; sep[0] stands for the
+        # start of the buffer. A token starts at every byte that is not a separator
+        # and follows one.
+        sep = self._sep[:n + 1]
+        numpy.equal(b, 32, out=sep[1:])
+        numpy.logical_or(sep[1:], newline, out=sep[1:])
+        sep[0] = True
+        mask = self._mask[:n]
+        numpy.logical_not(sep[1:], out=mask)
+        numpy.logical_and(mask, sep[:n], out=mask)
+        starts = self._nonzero(mask, self._starts)
+        ntokens = len(starts)
+
+        # Line of every token from the number of newlines before its start, and its
+        # column, 0 at the first counter, from the first token of its line: one after
+        # the last token of the line before, which the last assignment per line
+        # leaves in 'first'.
+        position = self._pos[:ntokens]
+        line = self._line[:ntokens]
+        numpy.take(linecum, starts, out=line, mode='clip')
+        first = self._first[:lines + 1]
+        first[1:][line] = position
+        first[0] = -1
+        first += 1
+        column = self._column[:ntokens]
+        numpy.take(first, line, out=column, mode='clip')
+        numpy.subtract(position, column, out=column)
+        column -= FIRSTCOUNTER
+        names = self._namecolumn(b, starts, column, lines)
+        reindexed = changed or self._renamed(names)
+        if reindexed:
+            self.reindex()
+            self._names = names.copy()
+        tokenmask = self._tokenmask[:ntokens]
+        more = self._more[:ntokens]
+        numpy.greater_equal(column, 0, out=tokenmask)
+        numpy.less(column, NFIELDS, out=more)
+        tokenmask &= more
+        counter = self._nonzero(tokenmask, self._counter)
+        ncounters = len(counter)
+
+        # Horner's rule over the digits of all counters at once, one pass per digit
+        # position, for as long as any counter has digits left. Every token is
+        # followed by a space or a newline, which ends it.
+        index = self._index[:ncounters]
+        numpy.take(starts, counter, out=index, mode='clip')
+        values = self._values[:ncounters]
+        values.fill(0)
+        digit = self._digit[:ncounters]
+        digits = self._bytes[:ncounters]
+        more = self._more[:ncounters]
+        more.fill(True)
+        valid = self._tokenmask[:ncounters]
+        scale = self._scale[:ncounters]
+        while ncounters:
+            numpy.take(b, index, out=digits, mode='clip')
+            # Bytes below '0' wrap around, so one comparison finds the digits.
+            numpy.subtract(digits, 48, out=digits)
+            numpy.less(digits, 10, out=valid)
+            more &= valid
+            if not more.any():
+                break
+            # values = values * 10 + digit where 'more', unchanged elsewhere, without
+            # the slow where= ufunc loops: scale is 10 or 1, digit 0 where done.
+            numpy.copyto(scale, more)
+            numpy.copyto(digit, digits)
+            digit *= scale
+            scale *= 9
+            scale += 1
+            values *= scale
+            values += digit
+            index += 1
+
+        # Scatter into the result through flat indexes: row * NFIELDS + column.
+        which = self._which
+        self._which ^= 1
+        result = self._results[which]
+        if reindexed:
+            # Rows that are no longer in the table keep the values of the last snapshot,
+            # which is in the other array.
+            rows = len(self.devices)
+            numpy.copyto(result[:rows], self._results[which ^ 1][:rows])
+        numpy.take(line, counter, out=index, mode='clip')
+        numpy.take(self._rowof, index, out=index, mode='clip')
+        index *= NFIELDS
+        numpy.take(column, counter, out=digit, mode='clip')
+        index += digit
+        numpy.put(result, index, values, mode='clip')
+        self.columns = max(self.columns, int(digit.max()) + 1 if ncounters else 0)
+        self.time = time.monotonic()
+        return result[:len(self.devices)]
+
+    def close(self):
+        self.table.close()
+
+
+def rates(prev, cur, dt, out=None):
+    # Per-second deltas of every counter of every device between two
+    # snapshots taken 'dt' seconds apart, as float64. The in-flight column is
+    # a gauge and is copied from 'cur'. Rows only present in 'cur' are 0.
+    rows = min(len(prev), len(cur))
+    if out is None or out.shape != cur.shape:
+        out = numpy.zeros(cur.shape, numpy.float64)
+    else:
+        out[rows:] = 0
+    numpy.subtract(cur[:rows], prev[:rows], out=out[:rows], casting='unsafe')
+    out[:rows] /= dt
+    out[:, INFLIGHT] = cur[:, INFLIGHT]
+    return out
+
+
+_default = None
+
+
+def snapshot(path=STATSFILE):
+    # Module level convenience around one shared Snapshotter.
+    global _default
+    if _default is None or _default.table.path != path:
+        _default = Snapshotter(path)
+    return _default.snapshot()
+
+
+def devices():
+    # Device index of the shared Snapshotter: the name of every snapshot row.
+    return list(_default.devices) if _default is not None else []
@@ -0,0 +1,125 @@
+"""
+Scrolling bar graph of recent disk activity for the tray icon.
+
+The history is a fixed size ring buffer (an array of 'B', one slot per icon
+column) covering the last 'seconds' seconds. The sampler adds values with
+add(), which only takes the maximum into the current slot and moves the
+head when a column's period has passed, so sampling never touches pixels.
+
+The pixels live in a bytearray that a PIL image shares through
+Image.frombuffer() ('RGBA' is one of the modes PIL maps without copying).
+render() scrolls that buffer in place, moving the whole image left by the
+number of columns that passed since the last render with one slice
+assignment, and draws only the new columns. A column is written with one
+extended slice assignment per colour channel, from byte strings prepared
+for every bar height at startup. Nothing is drawn with ImageDraw and no
+image is created after startup.
+
+Sparkline implements image(state) like trayicon.IconCache, so a
+TrayIconUpdater can push it: the state is the version add() returns,
+and the image is rendered in the updater's thread when it pushes, which
+limits redraws to the updater's frame rate.
+
+Run bench_sparkline.py to measure the render time per frame.
+"""
+
+import array
+import threading
+import time
+
+from PIL import Image
+
+HISTORY = 32.0  # Seconds of history across the icon
+BARCOLOUR = (255, 0, 0, 255)
+BACKGROUND = (0, 0, 0, 255)
+FULLSCALE = 100.0  # Value drawn at the full icon height, e.g. %util
+
+
+class Sparkline(object):
+    """Ring buffer of recent values and an icon image scrolled in place."""
+
+    def __init__(self, width, height, seconds=HISTORY, fullscale=FULLSCALE, colour=BARCOLOUR,
+                 background=BACKGROUND, clock=time.monotonic):
+        self.width = width
+        self.height = height
+        self.period = seconds / width  # Seconds per column
+        self.scale = height / fullscale
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._history = array.array('B', bytes(width))  # Bar height of every column, a ring
+        self._head = 0  # Slot of the newest column
+        self.column = 0  # Number of the newest column, counts up forever
+        self.version = 0  # Changes whenever the graph does, the state pushed to the tray
+        self._slotend = clock() + self.period
+        self._rendered = 0  # Number of the newest column in the pixels
+        self._stride = width * 4
+        # The bytes of every colour channel of a column, top to bottom, for every bar height.
+        self._columns = [[bytes(background[channel] if y < height - bar else colour[channel]
+                                for y in range(height)) for channel in range(4)]
+                         for bar in range(height + 1)]
+        self._pixels = bytearray(bytes(background) * (width * height))
+        self._image = Image.frombuffer('RGBA', (width, height), self._pixels, 'raw', 'RGBA', 0, 1)
+        self.renders = 0
+
+    def add(self, value, now=None):
+        # Fold a sample into the newest column, starting new columns as their
+        # periods pass. Returns the version of the graph.
+        if now is None:
+            now = self.clock()
+        # Any activity is at least one pixel high.
+        bar = min(self.height, max(1, int(value * self.scale + 0.5))) if value > 0 else 0
+        with self._lock:
+            if now >= self._slotend:
+                passed = int((now - self._slotend) / self.period) + 1
+                self._slotend += passed * self.period
+                history = self._history
+                for _ in range(min(passed, self.width)):
+                    self._head = (self._head + 1) % self.width
+                    history[self._head] = 0
+                self.column += passed
+                self.version += 1
+            if bar > self._history[self._head]:
+                self._history[self._head] = bar
+                self.version += 1
+            return self.version
+
+    def render(self):
+        # Bring the pixels up to date with the ring buffer: scroll by the
+        # columns that passed and draw the newest ones. The newest column is
+        # always redrawn, it can still grow.
+        with self._lock:
+            column = self.column
+            head = self._head
+            history = self._history
+            width = self.width
+            new = min(column - self._rendered + 1, width)
+            bars = [history[(head - i) % width] for i in range(new - 1, -1, -1)]
+            self._rendered = column
+        pixels = self._pixels
+        stride = self._stride
+        shift = (new - 1) * 4
+        if shift:
+            # Moving the whole buffer wraps the first pixels of every row to the end of the
+            # row above, which are the new columns drawn below.
+            pixels[:len(pixels) - shift] = pixels[shift:]
+        x = stride - new * 4
+        for bar in bars:
+            column = self._columns[bar]
+            for channel in range(4):
+                pixels[x + channel::stride] = column[channel]
+            x += 4
+        self.renders += 1
+
+    def image(self, state=None):
+        # trayicon.IconCache interface: render and return the shared image.
+        self.render()
+        return self._image
+
+    def __contains__(self, state):
+        return True
+
+    def values(self):
+        # Bar heights of the history, oldest first.
+        with self._lock:
+            head = self._head + 1
+            return self._history[head:] + self._history[:head]
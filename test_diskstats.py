@@ -0,0 +1,96 @@
+"""
+Tests of the /proc/diskstats samplers against fixtures.DiskStatsFixture tables.
+
+usage: python3 -m pytest test_diskstats.py
+"""
+
+import os
+
+from diskstats import DiskStatsSampler, MultiSampler, IOINPROGRESS, READS
+from fixtures import DiskStatsFixture, rewrite, OLDCOUNTERS
+
+
+def fixture(tmp_path, ndevices=20, counters=17):
+    return DiskStatsFixture(os.path.join(tmp_path, 'diskstats'), ndevices, counters)
+
+
+def test_counters(tmp_path):
+    table = fixture(tmp_path)
+    with DiskStatsSampler('sdb', table.path) as sampler:
+        assert sampler.refresh()
+        assert sampler.counters() == table.values['sdb']
+        table.bump('sdb', reads=3, writes=2, inflight=4)
+        assert sampler.sample(IOINPROGRESS) == 4
+        assert sampler.counters() == table.values['sdb']
+
+
+def test_old_kernel_counters(tmp_path):
+    table = fixture(tmp_path, counters=OLDCOUNTERS)
+    with DiskStatsSampler('sdb', table.path) as sampler:
+        assert sampler.refresh()
+        assert sampler.counters() == table.values['sdb']
+
+
+def test_name_is_not_a_prefix(tmp_path):
+    # 'sda' must not match the line of 'sda1'.
+    table = fixture(tmp_path)
+    table.remove('sda')
+    with DiskStatsSampler('sda', table.path) as sampler:
+        assert not sampler.refresh()
+        assert sampler.counters() is None
+
+
+def test_device_removed_before(tmp_path):
+    # The line of the last device moves up, its old offset is past the end of the
+    # shorter table, where the buffer still holds the bytes of the longer read.
+    table = fixture(tmp_path)
+    last = table.names[-1]
+    with DiskStatsSampler(last, table.path) as sampler:
+        assert sampler.refresh()
+        assert sampler.counters() == table.values[last]
+        for name in ('sda1', 'sda2', 'sda3'):
+            table.remove(name)
+        table.bump(last, reads=5)
+        assert sampler.refresh()
+        assert sampler.sample(READS) == table.values[last][0]
+        assert sampler.counters() == table.values[last]
+
+
+def test_device_removed(tmp_path):
+    table = fixture(tmp_path)
+    with DiskStatsSampler('sdb', table.path) as sampler:
+        assert sampler.refresh()
+        table.remove('sdb')
+        assert not sampler.refresh()
+        assert sampler.sample(READS) == 0
+        assert sampler.counters() is None
+
+
+def test_shared_table_device_removed_before(tmp_path):
+    table = fixture(tmp_path)
+    last = table.names[-1]
+    with MultiSampler(['sd*', last], table.path) as multi:
+        assert multi.refresh()
+        view = multi.sampler(last)
+        assert view.counters() == table.values[last]
+        for name in ('sda', 'sda1', 'sda2'):
+            table.remove(name)
+        table.bump(last, writes=7)
+        assert multi.refresh()
+        assert view.counters() == table.values[last]
+        table.remove(last)
+        assert multi.refresh()
+        assert not view.refresh()
+        assert view.counters() is None
+
+
+def test_empty_table(tmp_path):
+    table = fixture(tmp_path)
+    with DiskStatsSampler('sdb', table.path) as sampler:
+        assert sampler.refresh()
+        rewrite(table.path, b'')
+        assert not sampler.refresh()
+        assert sampler.counters() is None
+        table.write()
+        assert sampler.refresh()
+        assert sampler.counters() == table.values['sdb']
@@ -0,0 +1,83 @@
+"""
+Tests of snapshot.Snapshotter against fixtures.DiskStatsFixture tables.
+
+usage: python3 -m pytest test_snapshot.py
+"""
+
+import os
+
+import pytest
+
+from fixtures import DiskStatsFixture, rewrite, OLDCOUNTERS
+
+numpy = pytest.importorskip('numpy')
+from snapshot import Snapshotter, NFIELDS  # noqa: E402  (needs numpy)
+
+
+def fixture(tmp_path, ndevices=20, counters=17):
+    return DiskStatsFixture(os.path.join(tmp_path, 'diskstats'), ndevices, counters)
+
+
+def check(snapshotter, result, table):
+    # Every device of 'table' is in the row the snapshotter's index gives it.
+    for name in table.names:
+        values = table.values[name]
+        assert list(result[snapshotter.index[name], :len(values)]) == values, name
+        assert not result[snapshotter.index[name], len(values):].any(), name
+
+
+def test_snapshot(tmp_path):
+    table = fixture(tmp_path)
+    snapshotter = Snapshotter(table.path)
+    result = snapshotter.snapshot()
+    assert result.shape == (len(table.names), NFIELDS)
+    assert snapshotter.devices == table.names
+    assert snapshotter.columns == 17
+    check(snapshotter, result, table)
+    table.bump('sdb', reads=123456789, writes=1, inflight=3)
+    check(snapshotter, snapshotter.snapshot(), table)
+
+
+def test_old_kernel(tmp_path):
+    table = fixture(tmp_path, counters=OLDCOUNTERS)
+    snapshotter = Snapshotter(table.path)
+    check(snapshotter, snapshotter.snapshot(), table)
+    assert snapshotter.columns == OLDCOUNTERS
+
+
+def test_empty_table(tmp_path):
+    table = fixture(tmp_path)
+    rewrite(table.path, b'')
+    snapshotter = Snapshotter(table.path)
+    assert snapshotter.snapshot() is None
+    table.write()
+    check(snapshotter, snapshotter.snapshot(), table)
+    rewrite(table.path, b'')
+    assert snapshotter.snapshot() is None
+    table.bump('sda')
+    check(snapshotter, snapshotter.snapshot(), table)
+
+
+def test_device_removed(tmp_path):
+    # Rows are stable: a device that goes away keeps its row, the others theirs.
+    table = fixture(tmp_path)
+    snapshotter = Snapshotter(table.path)
+    snapshotter.snapshot()
+    rows = dict(snapshotter.index)
+    table.remove('sda1')
+    table.bump('sdb', reads=9)
+    result = snapshotter.snapshot()
+    check(snapshotter, result, table)
+    assert snapshotter.index == rows
+
+
+def test_device_replaced(tmp_path):
+    # One device takes the line of another, the number of lines stays the same.
+    table = fixture(tmp_path)
+    snapshotter = Snapshotter(table.path)
+    before = snapshotter.snapshot()[snapshotter.index['sda']].copy()
+    table.replace('sda', 'sdz')
+    result = snapshotter.snapshot()
+    check(snapshotter, result, table)
+    assert snapshotter.devices[-1] == 'sdz'
+    assert (result[snapshotter.index['sda']] == before).all()
@@ -0,0 +1,146 @@
+"""
+Throttled, change-only updates of a system tray icon.
+
+Every assignment to pystray's Icon.icon makes the backend serialize the
+image and send it to the desktop's tray host, which costs CPU in this
+process and in the panel. Assigning it on every active sample, as the
+first versions of main_stray.py did, pushed up to 60 images a second that
+all looked the same.
+
+TrayIconUpdater owns the displayed state of one icon, like LedDriver owns
+the state of an LED. set() only records the state that should be shown and
+returns at once; a single long lived thread pushes it to the icon when it
+differs from what is displayed, and never more often than 'maxfps' times a
+second. States requested in between are coalesced into the last one, so a
+blink that is shorter than a frame still shows up for one frame and the
+final state is always displayed.
+
+States are keys into an IconCache built once at startup, so no image is
+created or encoded while sampling. 'pushed' counts updates sent to the
+tray, 'suppressed' the requests that did not need one.
+"""
+
+import io
+import sys
+import threading
+import time
+
+MAXFPS = 20.0
+
+
+class IconCache(object):
+    """Images for every state of an icon, with their PNG encoding, built once."""
+
+    def __init__(self, images):
+        # 'images' maps each state to a PIL image, or is a sequence indexed by state.
+        items = images.items() if hasattr(images, 'items') else enumerate(images)
+        self.images = dict(items)
+        self._png = {}
+        for state, image in self.images.items():
+            if image is None:
+                raise ValueError(f"No image for icon state {state!r}")
+            buf = io.BytesIO()
+            image.save(buf, 'PNG')
+            self._png[state] = buf.getvalue()
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, state):
+        return state in self.images
+
+    def image(self, state):
+        return self.images[state]
+
+    def png(self, state):
+        # Serialized image for backends that are handed bytes or files.
+        return self._png[state]
+
+
+class TrayIconUpdater(object):
+    """Pushes the state of a tray icon only when it changes, at most 'maxfps' times a second."""
+
+    def __init__(self, icon, cache, maxfps=MAXFPS, clock=time.monotonic):
+        self.icon = icon
+        self.cache = cache
+        self.frame = 1.0 / maxfps if maxfps else 0.0
+        self.clock = clock
+        self._cond = threading.Condition()
+        self._wanted = None
+        self._shown = None  # State last pushed, None before the first push
+        self._last = None  # clock() of the last push
+        self._stopped = False
+        self._thread = None
+        self.pushed = 0
+        self.suppressed = 0
+
+    def start(self):
+        # Must be called in the process that owns the icon, threads do not survive fork().
+        if self._thread is None:
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name='dsklite-tray', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def state(self):
+        return self._shown
+
+    def set(self, state):
+        # Request 'state' to be displayed. Never blocks on the tray.
+        with self._cond:
+            if state == self._wanted:
+                self.suppressed += 1
+                return
+            if self._wanted != self._shown:
+                # A previous request was not pushed yet and is replaced by this one.
+                self.suppressed += 1
+            self._wanted = state
+            self._cond.notify()
+
+    def _next_state(self):
+        # Block until a state needs pushing and its frame has come. Runs with
+        # the condition held.
+        cond = self._cond
+        while True:
+            if self._stopped:
+                return None
+            if self._wanted is None or self._wanted == self._shown:
+                cond.wait()
+                continue
+            if self._last is not None:
+                remaining = self._last + self.frame - self.clock()
+                if remaining > 0:
+                    cond.wait(remaining)
+                    continue
+            return self._wanted
+
+    def _run(self):
+        while True:
+            with self._cond:
+                state = self._next_state()
+            if state is None:
+                return
+            # The tray is updated without the lock held so that set() never waits on it.
+            try:
+                self.icon.icon = self.cache.image(state)
+                if self._shown is None:
+                    self.icon.visible = True
+            except Exception as e:
+                # Log error if updating the pystray icon fails during runtime.
+                # Recovery: Mark the state as shown anyway, the next change retries the icon.
+                # This prevents a glitch in the tray host from turning into a busy loop.
+                sys.stderr.write(f"Error updating tray icon to state {state!r}: {e}\n")
+            else:
+                self.pushed += 1
+            with self._cond:
+                self._shown = state
+                self._last = self.clock()